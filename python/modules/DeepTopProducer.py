@@ -10,11 +10,18 @@ import tarfile
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
 from PhysicsTools.NanoSUSYTools.modules.Stop0lObjectsProducer import DeepCSVMediumWP, DeepCSVLooseWP
 
-from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped, CollectionRemapped
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, cachedCollection, cachedObject, compileRemap, availableBranches
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.effTables import hist1DTable, cachedEffTable
+from PhysicsTools.NanoSUSYTools.modules.resolvedTopKernels import killSubjetOverlap, cleanSharedJets
 
 class DeepTopProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Jet", "FatJet", "SubJet") + ["MET_*"]
+
     def __init__(self, era, taggerWD, applyUncert=None, sampleName=None, isFastSim=False, isData=False):
         self.isFastSim = isFastSim
         self.isData = isData
@@ -63,6 +70,8 @@ class DeepTopProducer(Module):
             self.suffix = "_JESUp"
         elif self.applyUncert == "JESDown":
             self.suffix = "_JESDown"
+        self.jetMap = VariationRemap[self.applyUncert]["Jet"] if self.suffix else None
+        self.metMap = VariationRemap[self.applyUncert]["MET"] if self.suffix else None
 
     def beginJob(self):
         self.count = 1
@@ -71,6 +80,10 @@ class DeepTopProducer(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        if self.suffix:
+            branches = availableBranches(inputTree, wrappedOutputTree)
+            compileRemap("Jet", self.jetMap).resolve(branches)
+            compileRemap(self.metBranchName, self.metMap).resolve(branches)
         self.out.branch("FatJet_Stop0l", "I", lenVar="nFatJet")
         self.out.branch("ResolvedTop_Stop0l" + self.suffix, "O", lenVar="nResolvedTopCandidate" + self.suffix)
         self.out.branch("Stop0l_nTop" + self.suffix, "I")
@@ -105,43 +118,41 @@ class DeepTopProducer(Module):
                 # For QCD smear, using the orignal QCD
                 sample = self.sampleName.replace("Smear_", "")
     
-            tTagEffFile = ROOT.TFile.Open(tTagEffFileName)
+            self.resEffHists = cachedEffTable(tTagEffFileName, sample, "resTopEff", lambda: self.readResEffHists(tTagEffFileName, sample))
+
+    def readResEffHists(self, tTagEffFileName, sample):
+        """Resolved top tagging efficiencies of the signal and background for sample"""
+        tTagEffFile = ROOT.TFile.Open(tTagEffFileName)
+
+        defaultSampleName = "TTbarInc_%s"%self.era
+
+        h_res_sig_den = tTagEffFile.Get(sample + "/d_res_sig_" + sample)
+        h_res_sig = tTagEffFile.Get(sample + "/n_res_sig_" + sample)
+        h_res_bg_den = tTagEffFile.Get(sample + "/d_res_bg_" + sample)
+        h_res_bg = tTagEffFile.Get(sample + "/n_res_bg_" + sample)
+
+
+        try:
+            h_res_sig.Divide(h_res_sig_den)
+            h_res_bg.Divide(h_res_bg_den)
+        except AttributeError:
+            print("DeepTopProducer: Sample '%s' NOT found in '%s'!!! Instead trying default sample '%s'"%(sample, tTagEffFileName, defaultSampleName))  
+            sample = defaultSampleName
 
-            defaultSampleName = "TTbarInc_%s"%self.era
-    
             h_res_sig_den = tTagEffFile.Get(sample + "/d_res_sig_" + sample)
             h_res_sig = tTagEffFile.Get(sample + "/n_res_sig_" + sample)
             h_res_bg_den = tTagEffFile.Get(sample + "/d_res_bg_" + sample)
             h_res_bg = tTagEffFile.Get(sample + "/n_res_bg_" + sample)
-    
-    
-            try:
-                h_res_sig.Divide(h_res_sig_den)
-                h_res_bg.Divide(h_res_bg_den)
-            except AttributeError:
-                print("DeepTopProducer: Sample '%s' NOT found in '%s'!!! Instead trying default sample '%s'"%(sample, tTagEffFileName, defaultSampleName))  
-                sample = defaultSampleName
-
-                h_res_sig_den = tTagEffFile.Get(sample + "/d_res_sig_" + sample)
-                h_res_sig = tTagEffFile.Get(sample + "/n_res_sig_" + sample)
-                h_res_bg_den = tTagEffFile.Get(sample + "/d_res_bg_" + sample)
-                h_res_bg = tTagEffFile.Get(sample + "/n_res_bg_" + sample)
-
-                h_res_sig.Divide(h_res_sig_den)
-                h_res_bg.Divide(h_res_bg_den)
-
-            tTagEffFile.Close()
-
-            self.resEffHists = {
-                "res_sig_hist": {
-                    "edges": np.fromiter(h_res_sig.GetXaxis().GetXbins(), np.float),
-                    "values": np.array([h_res_sig.GetBinContent(iBin) for iBin in range(1, h_res_sig.GetNbinsX() + 1)])
-                    },
-                "res_bg_hist": {
-                    "edges": np.fromiter(h_res_bg.GetXaxis().GetXbins(), np.float),
-                    "values": np.array([h_res_bg.GetBinContent(iBin) for iBin in range(1, h_res_bg.GetNbinsX() + 1)])
-                    },
-                }
+
+            h_res_sig.Divide(h_res_sig_den)
+            h_res_bg.Divide(h_res_bg_den)
+
+        resEffHists = {
+            "res_sig_hist": hist1DTable(h_res_sig),
+            "res_bg_hist":  hist1DTable(h_res_bg),
+            }
+        tTagEffFile.Close()
+        return resEffHists
 
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
@@ -172,60 +183,30 @@ class DeepTopProducer(Module):
         #res here is a list with the resolved top and the existing Stop0l var
         return res[1] and (res[0].discriminator > self.DeepResolveWP)
 
-    def ResovleOverlapDeepAK8(self, res, fatj, jets, subjets):
-        ## Counting number of tops
-#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Getting jets ~~~~~
-        ### Subjet method
-        subjetides  = []
-        for i, j in enumerate(fatj):
-            if self.FatJet_Stop0l[i] > 0 :
-                subjetides.append(j.subJetIdx1)
-                subjetides.append(j.subJetIdx2)
-        ### Resolved AK4 jets
-        resjets = defaultdict(list)
-        for i, t in enumerate(res):
-            if self.ResolvedTop_Stop0l[i]:
-                resjets[t.j1Idx].append(i)
-                resjets[t.j2Idx].append(i)
-                resjets[t.j3Idx].append(i)
-#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Making correlation ~~~~~
-
-        if len(subjetides) > 0 and len(resjets) > 0:
-            combs = np.asarray([(x,y) for x in subjetides for y in resjets.keys() ])
-            subjet_eta = np.asarray([ subjets[x].eta for x in combs[:, 0] ])
-            subjet_phi = np.asarray([ subjets[x].phi for x in combs[:, 0] ])
-            jet_eta = np.asarray([ jets[x].eta for x in combs[:, 1] ])
-            jet_phi = np.asarray([ jets[x].phi for x in combs[:, 1] ])
-            ## Using ufunc for vector operation
-            deta = np.power(subjet_eta-jet_eta, 2)
-            dPhi = subjet_phi - jet_phi
-            np.subtract(dPhi, 2*math.pi, out = dPhi, where= (dPhi >=math.pi))
-            np.add(dPhi, 2*math.pi,  out =dPhi , where=(dPhi < -1*math.pi))
-            np.power(dPhi, 2, out=dPhi)
-            dR2 = np.add(deta, dPhi)
-            overlap = combs[np.where(dR2 < self.dR2AK4Subjet)]
+    def ResovleOverlapDeepAK8(self, event):
+        """Remove the resolved tops overlapping with the DeepAK8 tops and Ws, then
+        those sharing jets, with the compiled kernels on the arrays of the event"""
+        resPrefix = "ResolvedTopCandidate" + self.suffix
+        j1Idx = branchArray(getattr(event, resPrefix + "_j1Idx"), np.int64)
+        j2Idx = branchArray(getattr(event, resPrefix + "_j2Idx"), np.int64)
+        j3Idx = branchArray(getattr(event, resPrefix + "_j3Idx"), np.int64)
+        stop0l = np.array(self.ResolvedTop_Stop0l, dtype=bool)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Killing overlap ~~~~~
-            ## Has overlap
-            for j in overlap[:, 1]:
-                for overlapidx in resjets[j]:
-                    self.ResolvedTop_Stop0l[overlapidx] = False
+        ### Subjets of the selected DeepAK8 tops and Ws
+        fatjSel = np.array(self.FatJet_Stop0l, dtype=np.int64) > 0
+        if fatjSel.any() and stop0l.any():
+            subjetIdx = np.concatenate((branchArray(event.FatJet_subJetIdx1, np.int64)[fatjSel],
+                                        branchArray(event.FatJet_subJetIdx2, np.int64)[fatjSel]))
+            stop0l = killSubjetOverlap(stop0l, j1Idx, j2Idx, j3Idx, subjetIdx,
+                                       branchArray(event.SubJet_eta, float), branchArray(event.SubJet_phi, float),
+                                       branchArray(event.Jet_eta, float), branchArray(event.Jet_phi, float),
+                                       self.dR2AK4Subjet)
 
 #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Clean up double counting in DeepResolved ~~~~~
-        usedJets = set()
-        remainingtops = [iTop for iTop in xrange(len(self.ResolvedTop_Stop0l)) if self.ResolvedTop_Stop0l[iTop]]
-        #Sort remaining tops by discriminator value
-        remainingtops.sort(key=lambda x: -res[x].discriminator)
-        if len(remainingtops) > 1:
-            for iTop in remainingtops:
-                jetIndices = set( (res[iTop].j1Idx, res[iTop].j2Idx, res[iTop].j3Idx) )
-                if not (jetIndices & usedJets):
-                    #None of this top's jets are "used", its a good top, mark its jets as used
-                    usedJets |= jetIndices
-                else:
-                    #Top has duplicate jet, remove from consideration
-                    self.ResolvedTop_Stop0l[iTop] = False
-
+        stop0l = cleanSharedJets(stop0l, j1Idx, j2Idx, j3Idx,
+                                 branchArray(getattr(event, resPrefix + "_discriminator"), float))
+        self.ResolvedTop_Stop0l = stop0l.tolist()
         return True
 
     def Clear(self):
@@ -290,24 +271,33 @@ class DeepTopProducer(Module):
                 HOTtype.append(Type)
         return (HOTpt, HOTeta, HOTphi, HOTmass, HOTtype)
 
-    def calculateResTopSFWeight(self, res):
-        #res here is all resolved tops which survive the overlap removal procedure and final cuts, except the final discriminator cut
+    def resolvedTopColumns(self, event, names, mask):
+        """Arrays of the resolved top candidates selected by mask, one per branch"""
+        prefix = "ResolvedTopCandidate" + self.suffix + "_"
+        return dict((name, branchArray(getattr(event, prefix + name), float)[mask]) for name in names)
+
+    def calculateResTopSFWeight(self, event):
+        #the tops here are all resolved tops which survive the overlap removal procedure and final cuts, except the final discriminator cut
         resTopStop0l = np.array(self.ResolvedTop_Stop0l, dtype=bool)
-        resTopPt = np.array([topCand.pt for topCand in res])[resTopStop0l]
-        resTopSF = np.array([topCand.sf for topCand in res])[resTopStop0l]
-        resTopGM = np.array([topCand.genMatch for topCand in res], dtype=bool)[resTopStop0l]
-        resTopDisc = np.array([topCand.discriminator for topCand in res], dtype=float)[resTopStop0l]
+        systNames=["Btag", "Pileup", "CSPur", "Stat"]
+        names = ["pt", "sf", "genMatch", "discriminator"]
+        if not self.applyUncert:
+            names += ["syst_%s_%s" % (syst, var) for syst in systNames for var in ("Up", "Down")]
+        columns = self.resolvedTopColumns(event, names, resTopStop0l)
+        resTopPt = columns["pt"]
+        resTopSF = columns["sf"]
+        resTopGM = columns["genMatch"].astype(bool)
+        resTopDisc = columns["discriminator"]
 
         discCut = resTopDisc > self.DeepResolveWP
 
         #calculate uncertainties 
         if not self.applyUncert:
-            systNames=["Btag", "Pileup", "CSPur", "Stat"]
             uncert_up = np.zeros(len(resTopPt))
             uncert_dn = np.zeros(len(resTopPt))
             for syst in systNames:
-                var_up = np.array([getattr(topCand, "syst_"+syst+"_Up") for topCand in res])[resTopStop0l]
-                var_dn = np.array([getattr(topCand, "syst_"+syst+"_Down") for topCand in res])[resTopStop0l]
+                var_up = columns["syst_"+syst+"_Up"]
+                var_dn = columns["syst_"+syst+"_Down"]
                 # hack
                 uncert_up += var_up**2
                 uncert_dn += var_dn**2
@@ -326,30 +316,36 @@ class DeepTopProducer(Module):
         effBins_notTop = np.digitize(resTopPt_notTop, self.resEffHists["res_bg_hist"]["edges"][:-1]) - 1
         resTopEff[~resTopGM] = self.resEffHists["res_bg_hist"]["values"][effBins_notTop]
 
-        resTopSF_tagged = resTopSF[discCut]
-        resTopSF_notTagged = resTopSF[~discCut]
-
-        resTopEff_tagged = resTopEff[discCut]
-        resTopEff_notTagged = resTopEff[~discCut]
-
-        numerator = (resTopSF_tagged*resTopEff_tagged).prod() * (1 - (resTopSF_notTagged*resTopEff_notTagged)).prod()
-        denominator = resTopEff_tagged.prod() * (1 - resTopEff_notTagged).prod()
+        ## One row of (variation, top) factors per product of the weight, the
+        ## tops outside the product of a row padded with 1: nominal, up and down
+        ## of the systematics, fastsim up and down for the tagged tops (SF*eff)
+        ## and the untagged ones (1 - SF*eff), then the efficiencies of the
+        ## denominator. Each row keeps the factors and the order of the
+        ## per-variation products, so that the weights are unchanged.
+        if not self.applyUncert:
+            fastSimErr = 0.05
+            scales = np.array([np.ones(len(resTopSF)), 1 + uncert_up, 1 - uncert_dn,
+                               np.full(len(resTopSF), 1 + fastSimErr), np.full(len(resTopSF), 1 - fastSimErr)])
+            tagged = scales*resTopSF*resTopEff
+        else:
+            tagged = (resTopSF*resTopEff)[np.newaxis]
+        nVar = len(tagged)
+        factors = np.concatenate((np.where(discCut, tagged, 1.), np.where(discCut, 1., 1 - tagged),
+                                  np.where(discCut, resTopEff, 1.)[np.newaxis], np.where(discCut, 1., 1 - resTopEff)[np.newaxis]))
+        products = factors.prod(axis=1)
+        numerators = products[:nVar] * products[nVar:2*nVar]
+        numerator = numerators[0]
+        denominator = products[2*nVar] * products[2*nVar + 1]
 
         #calculate uncertainty variations of weight
         if not self.applyUncert:
-            uncert_up_tagged = uncert_up[discCut]
-            uncert_up_notTagged = uncert_up[~discCut]
-
-            uncert_dn_tagged = uncert_dn[discCut]
-            uncert_dn_notTagged = uncert_dn[~discCut]
-
-            numerator_up = ((1 + uncert_up_tagged)*resTopSF_tagged*resTopEff_tagged).prod() * (1 - ((1 + uncert_up_notTagged)*resTopSF_notTagged*resTopEff_notTagged)).prod()
-            numerator_dn = ((1 - uncert_dn_tagged)*resTopSF_tagged*resTopEff_tagged).prod() * (1 - ((1 - uncert_dn_notTagged)*resTopSF_notTagged*resTopEff_notTagged)).prod()
+            numerator_up, numerator_dn, numerator_fast_up, numerator_fast_dn = numerators[1:]
 
             # check if resolved top closure uncertainty is needed and apply it if necessary
             if ((resTopGM == 0) & discCut).any():
-                closure_up = np.array([getattr(topCand, "syst_Closure_Up") for topCand in res])[resTopStop0l]
-                closure_dn = np.array([getattr(topCand, "syst_Closure_Down") for topCand in res])[resTopStop0l]
+                closure = self.resolvedTopColumns(event, ["syst_Closure_Up", "syst_Closure_Down"], resTopStop0l)
+                closure_up = closure["syst_Closure_Up"]
+                closure_dn = closure["syst_Closure_Down"]
                 
                 try:
                     closure_up_cut = closure_up[0]
@@ -369,10 +365,6 @@ class DeepTopProducer(Module):
                 numerator_dn_closeure_uncert_sign = np.sign(numerator_dn_closeure_uncert)
                 numerator_dn_closeure_uncert = np.sqrt(np.power(numerator_dn_closeure_uncert, 2) + np.power(closure_dn_cut, 2))
                 numerator_dn = (1 + numerator_dn_closeure_uncert_sign*numerator_dn_closeure_uncert)*numerator
-
-            fastSimErr = 0.05
-            numerator_fast_up = ((1 + fastSimErr)*resTopSF_tagged*resTopEff_tagged).prod() * (1 - ((1 + fastSimErr)*resTopSF_notTagged*resTopEff_notTagged)).prod()
-            numerator_fast_dn = ((1 - fastSimErr)*resTopSF_tagged*resTopEff_tagged).prod() * (1 - ((1 - fastSimErr)*resTopSF_notTagged*resTopEff_notTagged)).prod()
         else:
             numerator_up = 0.0
             numerator_dn = 0.0
@@ -392,21 +384,12 @@ class DeepTopProducer(Module):
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         ## Getting objects
-        if self.applyUncert == "JESUp":
-            resolves  = Collection(event, "ResolvedTopCandidate_JESUp")
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalUp", "mass":"mass_jesTotalUp"})
-            met       = ObjectRemapped(event,     "MET", replaceMap={"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"})
-        elif self.applyUncert == "JESDown":
-            resolves  = Collection(event, "ResolvedTopCandidate_JESDown")
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalDown", "mass":"mass_jesTotalDown"})
-            met       = ObjectRemapped(event,     "MET", replaceMap={"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"})
-        else:
-            resolves  = Collection(event, "ResolvedTopCandidate")
-            jets      = Collection(event, "Jet")
-            met       = Object(event,     "MET")
+        resolves  = cachedCollection(event, "ResolvedTopCandidate" + self.suffix)
+        jets      = cachedCollection(event, "Jet", replaceMap=self.jetMap)
+        met       = cachedObject(event,     "MET", replaceMap=self.metMap)
 
-        fatjets  = Collection(event, "FatJet")
-        subjets  = Collection(event, "SubJet")
+        fatjets  = cachedCollection(event, "FatJet")
+        subjets  = cachedCollection(event, "SubJet")
         self.Clear()
 
         ## Selecting objects
@@ -414,10 +397,10 @@ class DeepTopProducer(Module):
         #apply initial selection to reduce combinatorics, discriminator cut moved later for SF calculation
         self.ResolvedTop_Stop0l = map(lambda x : self.SelDeepResolved(x, jets), resolves)
         #resolve overlap between resolved top candidates and between resovled tops and merged top/W
-        self.ResovleOverlapDeepAK8(resolves, fatjets, jets, subjets)
+        self.ResovleOverlapDeepAK8(event)
         #calcualte resolved top scaler factor (the merged top SF is calculated in SoftBDeepAK8SFProducer.py for ... reasons ...)
         if not self.isData:
-            resolvedTopSF, resolvedTopSF_Up, resolvedTopSF_Dn, resolvedTopSF_fast_Up, resolvedTopSF_fast_Dn = self.calculateResTopSFWeight(resolves)
+            resolvedTopSF, resolvedTopSF_Up, resolvedTopSF_Dn, resolvedTopSF_fast_Up, resolvedTopSF_fast_Dn = self.calculateResTopSFWeight(event)
         #we need all the overlap resolved candidates in the step above, so the discriminator filter is moved here
         self.ResolvedTop_Stop0l = map(lambda x : self.DeepResolvedDiscCut(x), zip(resolves, self.ResolvedTop_Stop0l))
         self.nTop = sum( [ i for i in self.FatJet_Stop0l if i == 1 ])
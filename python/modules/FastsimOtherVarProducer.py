@@ -5,9 +5,12 @@ import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, compileRemap, availableBranches
 
 class FastsimOtherVarProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = ["MET_*", "GenMET_*"]
+
     def __init__(self, isFastsim, applyUncert = None):
         self.metBranchName = "MET"
         self.isFastsim = isFastsim
@@ -21,6 +24,7 @@ class FastsimOtherVarProducer(Module):
             self.suffix = "_JESDown"
         elif self.applyUncert == "METUnClustDown":
             self.suffix = "_METUnClustDown"
+        self.metRemap = compileRemap(self.metBranchName, VariationRemap.get(self.applyUncert, VariationRemap[None])["MET"])
 
     def beginJob(self):
         pass
@@ -42,6 +46,8 @@ class FastsimOtherVarProducer(Module):
                 self.out.branch("MET_pt",            "F")
                 self.out.branch("MET_pt_fasterr",    "F")
 
+            self.metRemap.resolve(availableBranches(inputTree, wrappedOutputTree))
+
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
 
@@ -50,16 +56,7 @@ class FastsimOtherVarProducer(Module):
         if not self.isFastsim:
             return True
 
-        if self.applyUncert == "JESUp":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"})
-        elif self.applyUncert == "JESDown":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"})
-        elif self.applyUncert == "METUnClustUp":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnUp", "phi":"phi_unclustEnUp"})
-        elif self.applyUncert == "METUnClustDown":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnDown", "phi":"phi_unclustEnDown"})
-        else:
-            met       = Object(event, self.metBranchName)
+        met       = self.metRemap.object(event)
 
         genmet = Object(event, "GenMET")
 
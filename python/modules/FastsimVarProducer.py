@@ -5,7 +5,7 @@ import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, compileRemap, availableBranches
 
 class FastsimVarProducer(Module):
     def __init__(self, isFastsim, applyUncert = None):
@@ -21,6 +21,7 @@ class FastsimVarProducer(Module):
             self.suffix = "_JESDown"
         elif self.applyUncert == "METUnClustDown":
             self.suffix = "_METUnClustDown"
+        self.metRemap = compileRemap(self.metBranchName, VariationRemap.get(self.applyUncert, VariationRemap[None])["MET"])
 
     def beginJob(self):
         pass
@@ -44,6 +45,8 @@ class FastsimVarProducer(Module):
             self.out.branch("Stop0l_MotherMass", "F")
             self.out.branch("Stop0l_LSPMass",    "F")
 
+            self.metRemap.resolve(availableBranches(inputTree, wrappedOutputTree))
+
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
 
@@ -52,16 +55,7 @@ class FastsimVarProducer(Module):
         if not self.isFastsim:
             return True
 
-        if self.applyUncert == "JESUp":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"})
-        elif self.applyUncert == "JESDown":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"})
-        elif self.applyUncert == "METUnClustUp":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnUp", "phi":"phi_unclustEnUp"})
-        elif self.applyUncert == "METUnClustDown":
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnDown", "phi":"phi_unclustEnDown"})
-        else:
-            met       = Object(event, self.metBranchName)
+        met       = self.metRemap.object(event)
 
         genmet = Object(event, "GenMET")
         genpar = Collection(event, "GenPart")
@@ -4,8 +4,16 @@ import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import invalidateCache
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.genAncestry import genAncestry
 
 class GenPartFilter(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("GenPart")
+
     def __init__(self, statusFlags = None, statuses = None, pdgIds = None):
         statFlagLen = len(statusFlags) if statusFlags else 0
         statusLen   = len(statuses)    if statuses    else 0
@@ -31,8 +39,6 @@ class GenPartFilter(Module):
             if pdgIds: print "pdgId length does not match, ignoring pdgId"
             self.parentPdgIds = np.array([0]*length)
 
-        self.vector_recursiveMotherSearch = np.vectorize(self.recursiveMotherSearch, excluded=(1,2))
-
     def beginJob(self):
         pass
     def endJob(self):
@@ -54,39 +60,18 @@ class GenPartFilter(Module):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
 
-    def recursiveMotherSearch(self, startIdx, GenPartCut_genPartIdxMother, filterArray):
-        if startIdx < 0 or filterArray[startIdx]: 
-            return startIdx
-
-        mom = GenPartCut_genPartIdxMother[startIdx]
-
-        if mom < 0 or filterArray[mom]:
-            return mom
-        else:
-            return self.recursiveMotherSearch(mom, GenPartCut_genPartIdxMother, filterArray)
-        
-
-    class TTreeReaderArrayWrapper:
-        def __init__(self, ttarray):
-            self.ttarray = ttarray
-
-        def __iter__(self):
-            for i in xrange(len(self.ttarray)):
-                yield self.ttarray[i]
-            return
-
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         ## Getting objects
 
-        GenPartCut_eta              = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_eta),              dtype=float)
-        GenPartCut_mass             = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_mass),             dtype=float)
-        GenPartCut_phi              = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_phi),              dtype=float)
-        GenPartCut_pt               = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_pt),               dtype=float)
-        GenPartCut_genPartIdxMother = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_genPartIdxMother), dtype=int)
-        GenPartCut_pdgId            = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_pdgId),            dtype=int)
-        GenPartCut_status           = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_status),           dtype=int)
-        GenPartCut_statusFlags      = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_statusFlags),      dtype=int)
+        GenPartCut_eta              = branchArray(event.GenPart_eta)
+        GenPartCut_mass             = branchArray(event.GenPart_mass)
+        GenPartCut_phi              = branchArray(event.GenPart_phi)
+        GenPartCut_pt               = branchArray(event.GenPart_pt)
+        GenPartCut_genPartIdxMother = branchArray(event.GenPart_genPartIdxMother)
+        GenPartCut_pdgId            = branchArray(event.GenPart_pdgId)
+        GenPartCut_status           = branchArray(event.GenPart_status)
+        GenPartCut_statusFlags      = branchArray(event.GenPart_statusFlags)
 
         #mother pdg IDs 
         GenPartCut_momPdgId = GenPartCut_pdgId[GenPartCut_genPartIdxMother]
@@ -106,14 +91,8 @@ class GenPartFilter(Module):
         else:
             filterArray = np.logical_or.reduce(filterArrays)
 
-        #revise mother history to fill in the gaps left by the filtering 
-        GenPartCut_genPartIdxMother = self.vector_recursiveMotherSearch(GenPartCut_genPartIdxMother, GenPartCut_genPartIdxMother, filterArray)
-        #calculate new Idx in filtered list
-        oldIdx = np.where(filterArray)
-        mapDict = dict(zip(oldIdx[0], np.arange(len(oldIdx[0]))))
-        mapDict[-1] = -1
-        vMapDict = np.vectorize(mapDict.__getitem__)
-        GenPartCut_genPartIdxMother_filtered = vMapDict(GenPartCut_genPartIdxMother[filterArray])
+        #revise mother history to fill in the gaps left by the filtering, and re-index in the filtered list
+        GenPartCut_genPartIdxMother_filtered = genAncestry(event).slimmedMothers(filterArray)
 
         self.out.fillBranch("GenPart_pt",               GenPartCut_pt[filterArray])
         self.out.fillBranch("GenPart_eta",              GenPartCut_eta[filterArray])
@@ -125,6 +104,7 @@ class GenPartFilter(Module):
         self.out.fillBranch("GenPart_status",           GenPartCut_status[filterArray])
         self.out.fillBranch("GenPart_statusFlags",      GenPartCut_statusFlags[filterArray])
         self.out.fillBranch("GenPart_momPdgId",         GenPartCut_momPdgId[filterArray])
+        invalidateCache(event, "GenPart")
 
         return True
 
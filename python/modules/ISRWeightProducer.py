@@ -6,9 +6,16 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import cachedCollection
+from PhysicsTools.NanoSUSYTools.modules.genAncestry import genAncestry
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
 
 class ISRSFWeightProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Jet", "GenPart", "Electron", "Muon")
+
 
     def __init__(self, era, isSUSY, isFastsim, isrEffFile, sampleName, fileDirectory = os.environ['CMSSW_BASE'] + "/src/PhysicsTools/NanoSUSYTools/data/isrSF/"):
         self.era = era
@@ -32,7 +39,7 @@ class ISRSFWeightProducer(Module):
 
     def beginJob(self):
         ROOT.TH1.AddDirectory(False)
-        self.fin = ROOT.TFile.Open(self.fileDirectory + "/" + self.isrEffFile)
+        self.fin = openCalibFile(self.fileDirectory + "/" + self.isrEffFile)
         self.h_eff          = self.fin.Get(("NJetsISR_" + self.sampleName));
 
         if  (("TTbar" in self.sampleName and self.era == "2016") or self.isSUSY) and not self.isFastsim:
@@ -127,36 +134,33 @@ class ISRSFWeightProducer(Module):
         lepcleaned = np.setdiff1d(lepcleaned, muonidx, assume_unique=True)
         return lepcleaned
 
-    def RecursiveMother(self, genpar, daughter):
-        mother = daughter.genPartIdxMother
-        motherID = abs(mother.pdgId)
-        if motherID == -1:
-            return False
-        if mother_pdgId == 6 or mother_pdgId == 23 or mother_pdgId == 24 or \
-           mother_pdgId == 25 or mother_pdgId >1e6:
-            return True
-        return self.RecursiveMother(genpar, genpar[mother])
+    def FromResonance(self, ancestry):
+        """Whether each gen particle descends from a top, Z, W, Higgs or SUSY particle"""
+        resonance = (ancestry.absPdgId == 6) | (ancestry.absPdgId == 23) | (ancestry.absPdgId == 24) | \
+                    (ancestry.absPdgId == 25) | (ancestry.absPdgId > 1e6)
+        return ancestry.descendsFrom(resonance, key="resonance")
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Code for ISR jet cal from Scarlet ~~~~~
         # Looks like room for speed up
-        jets      = Collection(event, "Jet")
-        genParts  = Collection(event, "GenPart")
-        electrons = Collection(event, "Electron")
-        muons     = Collection(event, "Muon")
+        jets      = cachedCollection(event, "Jet")
+        genParts  = cachedCollection(event, "GenPart")
+        electrons = cachedCollection(event, "Electron")
+        muons     = cachedCollection(event, "Muon")
 
         # Follow babymaker code to produce nisr in the event, following the ICHEP recommendation
         # https://github.com/manuelfs/babymaker/blob/0136340602ee28caab14e3f6b064d1db81544a0a/bmaker/plugins/bmaker_full.cc#L1268-L1295
         jetidx = self.GetBabyJetList(jets, muons, electrons)
+        fromResonance = self.FromResonance(genAncestry(event)) if len(jetidx) else None
         nisr = 0
         for j in jetidx:
             jet = jets[j]
             matched = False 
-            for genPart in genParts:
+            for iGen, genPart in enumerate(genParts):
                 if genPart.statusFlags != 23 or abs(genPart.pdgId) > 5: 
                     continue
-                if self.RecursiveMother(genPart):
+                if fromResonance[iGen]:
                     dR = deltaR(jet,genPart)
                     if dR<0.3:
                         matched = True
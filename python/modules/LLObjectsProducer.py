@@ -8,9 +8,10 @@ import os
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped, CollectionRemapped
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, compileRemap, availableBranches
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
 from PhysicsTools.NanoSUSYTools.modules.Stop0lObjectsProducer import DeepCSVMediumWP, DeepCSVLooseWP
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 
 class LLObjectsProducer(Module):
     def __init__(self, era, Process, isData = False, applyUncert=None):
@@ -29,6 +30,9 @@ class LLObjectsProducer(Module):
             self.suffix = "_JESDown"
         elif self.applyUncert == "METUnClustDown":
             self.suffix = "_METUnClustDown"
+        remaps = VariationRemap.get(self.applyUncert, VariationRemap[None])
+        self.jetRemap = compileRemap("Jet", remaps["Jet"])
+        self.metRemap = compileRemap(self.metBranchName, remaps["MET"])
 
     def beginJob(self):
         pass
@@ -36,7 +40,7 @@ class LLObjectsProducer(Module):
         pass
 
     def loadhisto(self,filename,hname):
-        file =ROOT.TFile.Open(filename)
+        file =openCalibFile(filename)
         hist_ = file.Get(hname)
         hist_.SetDirectory(0)
         return hist_
@@ -44,6 +48,9 @@ class LLObjectsProducer(Module):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.isFirstEventOfFile = True
         self.out = wrappedOutputTree
+        branches = availableBranches(inputTree, wrappedOutputTree)
+        self.jetRemap.resolve(branches)
+        self.metRemap.resolve(branches)
         self.out.branch("Stop0l_MtLepMET"		+ self.suffix, 	"F")
         self.out.branch("Stop0l_nVetoElecMuon"		+ self.suffix, 	"I")
         self.out.branch("Stop0l_nVetoElectron"	        + self.suffix, 	"I")
@@ -257,25 +264,13 @@ class LLObjectsProducer(Module):
         SB        = Collection(event, "SB")
         restop    = Collection(event, "ResolvedTopCandidate")
         res       = Collection(event, "ResolvedTop", lenVar="nResolvedTopCandidate")
-        jets      = Collection(event, "Jet")
-        met       = Object(event, self.metBranchName)
+        jets      = self.jetRemap.collection(event)
+        met       = self.metRemap.object(event)
         lhe       = Object(event, "LHE")
         if "TTbar" in self.process and self.era == "2016":
             lhewgt = event.LHEScaleWeight
             lhevec = [lhewgt[0], lhewgt[1], lhewgt[3], lhewgt[4], lhewgt[5], lhewgt[7], lhewgt[8]]
 
-        if self.applyUncert == "JESUp":
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalUp", "mass":"mass_jesTotalUp"})
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"})
-        elif self.applyUncert == "JESDown":
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalDown", "mass":"mass_jesTotalDown"})
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"})
-        elif self.applyUncert == "METUnClustUp":
-            jets      = Collection(event, "Jet")
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnUp", "phi":"phi_unclustEnUp"})
-        elif self.applyUncert == "METUnClustDown":
-            jets      = Collection(event, "Jet")
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnDown", "phi":"phi_unclustEnDown"})
         
         ## Selecting objects
         mt                   = sum([ e.MtW for e in electrons if e.Stop0l ] + [ m.MtW for m in muons if m.Stop0l ])
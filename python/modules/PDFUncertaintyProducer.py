@@ -7,6 +7,9 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collect
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 
 class PDFUncertiantyProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = ["nLHEPdfWeight", "LHEPdfWeight", "Generator_*"]
+
     def __init__(self, isData, isSUSY):
         self.isData = isData
         self.isSUSY = isSUSY
@@ -6,12 +6,18 @@ import os
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection 
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import cachedCollection
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 
 ## This code is obtained from https://github.com/cms-nanoAOD/nanoAOD-tools/issues/136
 ## Modified for NanoSUSY framework
 
 
 class PrefCorr(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Jet", "Photon", "Electron")
+
     def __init__(self, era, UseEMpT=0):
 # UseEMpT: Set to 1 if the jet map is defined for energy deposited in ECAL (pT_EM vs pT). For jet map only, not photon!
 
@@ -36,13 +42,13 @@ class PrefCorr(Module):
         self.UseEMpT = UseEMpT
 
     def open_root(self, path):
-        r_file = ROOT.TFile.Open(path)
-        if not r_file.__nonzero__() or not r_file.IsOpen(): raise NameError('File ' + path + ' not open')
+        r_file = openCalibFile(path)
+        if not r_file or not r_file.IsOpen(): raise NameError('File ' + path + ' not open')
         return r_file
 
     def get_root_obj(self, root_file, obj_name):
         r_obj = root_file.Get(obj_name)
-        if not r_obj.__nonzero__(): raise NameError('Root Object ' + obj_name + ' not found')
+        if not r_obj: raise NameError('Root Object ' + obj_name + ' not found')
         return r_obj
 
     def beginJob(self):
@@ -63,7 +69,7 @@ class PrefCorr(Module):
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
 
-        jets = Collection(event,"Jet")
+        jets = cachedCollection(event,"Jet")
 
         # Options
         self.JetMinPt = 20 # Min/Max Values may need to be fixed for new maps
@@ -97,8 +103,8 @@ class PrefCorr(Module):
         return True
 
     def EGvalue(self, event, jid):
-      photons = Collection(event,"Photon")
-      electrons = Collection(event,"Electron")
+      photons = cachedCollection(event,"Photon")
+      electrons = cachedCollection(event,"Electron")
       phopf = 1.0
       PhotonInJet = []
 
@@ -1,12 +1,17 @@
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 import math
-import numba
 import os
 
 import numpy as np
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray, segmentProd
+from PhysicsTools.NanoSUSYTools.modules.genAncestry import genAncestry
+from PhysicsTools.NanoSUSYTools.modules.deepAK8Matching import fatJetGenMatchType, fatJetGenPartCount, eventOffsets
+from PhysicsTools.NanoSUSYTools.modules.effTables import hist1DTable, cachedEffTable
 
 ## Soft b tagging SF from Loukas
 ## https://indico.cern.ch/event/823731/contributions/3446301/attachments/1851612/3040016/lg-stop0L-softb-20190527.pdf
@@ -137,87 +142,90 @@ DeepW_Fake_SF = {
     ]
 }
 
-@numba.jit(nopython=True)
-def recursiveMotherSearch(startIdx, targetIdx, GenPartCut_genPartIdxMother):
-    if startIdx < 0:
-        return False
-
-    mom = GenPartCut_genPartIdxMother[startIdx]
-
-    if mom < 0:
-        return False
-    elif startIdx == targetIdx:
-        return True
-    else:
-        return recursiveMotherSearch(mom, targetIdx, GenPartCut_genPartIdxMother)
-
-@numba.jit(nopython=True)
-def genParticleAssociation(GenPart_genPartIdxMother, GenPart_pdgId, GenPart_statusFlags):
-    GenPart_momPdgId = GenPart_pdgId[GenPart_genPartIdxMother]
-    #set any particles with an index of -1 to id 0                                                                                                                      
-    GenPart_momPdgId[GenPart_genPartIdxMother < 0] = 0
-
-    genTopDaughters = []
-    genWDaughters = []
-    for iGP, pdgId in enumerate(GenPart_pdgId):
-        if (GenPart_statusFlags[iGP] & 0x2100) != 0x2100:
-            continue
-        if abs(pdgId) == 6:
-            gtd = []
-            for iGP2, pdgId2 in enumerate(GenPart_pdgId):
-                if abs(pdgId2) >= 1 and abs(pdgId2) <= 5 and (GenPart_statusFlags[iGP2] & 0x2100) == 0x2100:
-                    if recursiveMotherSearch(iGP2, iGP, GenPart_genPartIdxMother):
-                        gtd.append(iGP2)
-            if len(gtd) == 3:
-                genTopDaughters.extend(gtd)
-        elif abs(pdgId) == 24:
-            gwd = []
-            for iGP2, pdgId2 in enumerate(GenPart_pdgId):
-                if abs(pdgId2) >= 1 and abs(pdgId2) <= 5 and (GenPart_statusFlags[iGP2] & 0x2100) == 0x2100:
-                    if recursiveMotherSearch(iGP2, iGP, GenPart_genPartIdxMother):
-                        gwd.append(iGP2)
-            if len(gwd) == 2:
-                genWDaughters.extend(gwd)
-
-    return genTopDaughters, genWDaughters
-
-def deltaRMatch(fatJetEta, fatJetPhi, genTopDaughters_eta, genTopDaughters_phi, genWDaughters_eta, genWDaughters_phi):
-
-    matches = np.zeros(len(fatJetEta), dtype=int)
-
-    if len(genWDaughters_eta):
-
-        wEtaVals = np.array(np.meshgrid(fatJetEta, genWDaughters_eta)).T.reshape(-1,2)
-        wPhiVals = np.array(np.meshgrid(fatJetPhi, genWDaughters_phi)).T.reshape(-1,2)
-
-        ## Using ufunc for vector operation
-        deta = np.power(wEtaVals[:,0] - wEtaVals[:,1], 2)
-        dPhi = wPhiVals[:,0] - wPhiVals[:,1]
-        dR = np.sqrt((( abs(abs(dPhi)-np.pi)-np.pi )**2+(deta)**2)).reshape([-1,len(genWDaughters_eta)/2, 2])
-
-        matches[dR.max(axis=2).min(axis=1) < 0.6] = 2
-
-    if len(genTopDaughters_eta):
-
-        topEtaVals = np.array(np.meshgrid(fatJetEta, genTopDaughters_eta)).T.reshape(-1,2)
-        topPhiVals = np.array(np.meshgrid(fatJetPhi, genTopDaughters_phi)).T.reshape(-1,2)
-    
-        ## Using ufunc for vector operation
-        deta = np.power(topEtaVals[:,0] - topEtaVals[:,1], 2)
-        dPhi = topPhiVals[:,0] - topPhiVals[:,1]
-        dR = np.sqrt((( abs(abs(dPhi)-np.pi)-np.pi )**2+(deta)**2)).reshape([-1,len(genTopDaughters_eta)/3, 3])
-
-        matches[dR.max(axis=2).min(axis=1) < 0.6] = 1
-    
-    return matches
+## Variations of Stop0l_DeepAK8_SFWeight: (branch suffix, shifts in units of the
+## errors of the SF of the tagged tops, of the tagged Ws and of the veto SF of
+## the untagged jets, dense top variation, fastsim). The fastsim variations shift
+## the fastsim SF, applied on top of the nominal SF. The dense top variation
+## scales by 1.2 (+1) or 1/1.2 (-1) the SF of the tagged tops matched to at
+## least 4 gen partons.
+DeepAK8SFVariations = [
+    ("",                   ( 0,  0,  0),  0, False),
+    ("_total_up",          ( 1,  1,  1),  0, False),
+    ("_total_dn",          (-1, -1, -1),  0, False),
+    ("_top_up",            ( 1,  0,  0),  0, False),
+    ("_top_dn",            (-1,  0,  0),  0, False),
+    ("_w_up",              ( 0,  1,  0),  0, False),
+    ("_w_dn",              ( 0, -1,  0),  0, False),
+    ("_veto_up",           ( 0,  0,  1),  0, False),
+    ("_veto_dn",           ( 0,  0, -1),  0, False),
+    ("_densetop_up",       ( 0,  0,  0),  1, False),
+    ("_densetop_dn",       ( 0,  0,  0), -1, False),
+]
+DeepAK8FastSFVariations = [
+    ("_fast",              ( 0,  0,  0),  0, True),
+    ("_fast_total_up",     ( 1,  1,  1),  0, True),
+    ("_fast_total_dn",     (-1, -1, -1),  0, True),
+    ("_fast_top_up",       ( 1,  0,  0),  0, True),
+    ("_fast_top_dn",       (-1,  0,  0),  0, True),
+    ("_fast_w_up",         ( 0,  1,  0),  0, True),
+    ("_fast_w_dn",         ( 0, -1,  0),  0, True),
+    ("_fast_veto_up",      ( 0,  0,  1),  0, True),
+    ("_fast_veto_dn",      ( 0,  0, -1),  0, True),
+]
+
+def binIndex(cache, x, edges):
+    """Bin of each x in the bins of edges, the digitize being done once per binning"""
+    key = edges.tobytes()
+    if key not in cache:
+        cache[key] = np.digitize(x, edges[:-1]) - 1
+    return cache[key]
+
+def deepAK8SFWeights(offsets, jets, variations=DeepAK8SFVariations):
+    """Stop0l_DeepAK8_SFWeight and its variations for a batch of events, as
+    {suffix : weight of each event}. jets holds the flat arrays of the fat jets
+    (with offsets of the events): Stop0l, nGenPart, the SF of the tagged jets,
+    the tagging efficiencies and the veto SF as a top and a W of the untagged
+    jets, with their errors and fastsim SF. The per-jet factors of all the
+    variations are the rows of one matrix, multiplied along the jets once.
+    Each product has the same factors, in the same order, as the per-variation
+    products of the original code."""
+    stop0l = jets["stop0l"]
+    top, w, bg = stop0l == 1, stop0l == 2, stop0l == 0
+    shifts = np.array([v[1] for v in variations], dtype=float)
+    dense  = np.array([v[2] for v in variations])[:, np.newaxis]
+    fast   = np.array([v[3] for v in variations])[:, np.newaxis]
+    fullShift = np.where(fast, 0., shifts)
+    fastShift = np.where(fast, shifts, 0.)
+
+    ## (variation, jet) factors of the tagged tops and Ws
+    tagShift     = np.where(top, fullShift[:, 0:1], fullShift[:, 1:2])
+    tagFastShift = np.where(top, fastShift[:, 0:1], fastShift[:, 1:2])
+    tagSF = (jets["sf"] + tagShift*jets["sfErr"]) * np.where(fast, jets["fastSF"] + tagFastShift*jets["fastSFErr"], 1.)
+    denseTop = top & (jets["nGenPart"] >= 4)
+    tagSF = tagSF * np.where((dense > 0) & denseTop, 1 + 0.2, 1.) / np.where((dense < 0) & denseTop, 1 + 0.2, 1.)
+
+    ## and of the untagged jets
+    vetoT = jets["effT"]*(jets["vetoT"] + fullShift[:, 2:3]*jets["vetoTErr"]) * np.where(fast, jets["fastVetoT"] + fastShift[:, 2:3]*jets["fastVetoTErr"], 1.)
+    vetoW = jets["effW"]*(jets["vetoW"] + fullShift[:, 2:3]*jets["vetoWErr"]) * np.where(fast, jets["fastVetoW"] + fastShift[:, 2:3]*jets["fastVetoWErr"], 1.)
+
+    nVar = len(variations)
+    factors = np.concatenate((np.where(top, tagSF, 1.), np.where(w, tagSF, 1.), np.where(bg, 1 - vetoT - vetoW, 1.),
+                              np.where(bg, 1 - jets["effT"] - jets["effW"], 1.)[np.newaxis]))
+    products = segmentProd(factors, offsets)
+    weights = products[:nVar] * products[nVar:2*nVar] * products[2*nVar:3*nVar] / products[3*nVar]
+    return dict((v[0], weights[i]) for i, v in enumerate(variations))
 
 class SoftBDeepAK8SFProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("SB", "FatJet", "GenPart")
+
     def __init__(self, era, taggerWD, isData = False, isFastSim=False, sampleName=None):
         self.era = era
         self.taggerWD = taggerWD
         self.isFastSim = isFastSim
         self.isData = isData
         self.sampleName = sampleName
+        self.sfVariations = DeepAK8SFVariations + (DeepAK8FastSFVariations if isFastSim else [])
 
         ROOT.TH1.AddDirectory(False)
 
@@ -255,27 +263,8 @@ class SoftBDeepAK8SFProducer(Module):
         self.out.branch("FatJet_fastSF"    , "F", lenVar="nFatJet")
         self.out.branch("FatJet_fastSFerr" , "F", lenVar="nFatJet")
         if not self.isData:
-            self.out.branch("Stop0l_DeepAK8_SFWeight" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_total_up" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_total_dn" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_top_up" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_top_dn" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_w_up" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_w_dn" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_veto_up" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_veto_dn" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_densetop_up" , "F")
-            self.out.branch("Stop0l_DeepAK8_SFWeight_densetop_dn" , "F")
-            if self.isFastSim:
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_total_up", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_total_dn", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_top_up", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_top_dn", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_w_up", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_w_dn", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_veto_up", "F")
-                self.out.branch("Stop0l_DeepAK8_SFWeight_fast_veto_dn", "F")
+            for suffix, shifts, dense, fast in self.sfVariations:
+                self.out.branch("Stop0l_DeepAK8_SFWeight" + suffix, "F")
         self.out.branch("FatJet_nGenPart" , "I", lenVar="nFatJet", title="NO. of quarks and hard gluons matched to FatJet")
         self.out.branch("FatJet_GenMatch" , "I", lenVar="nFatJet", title="Type of Gen Match of FatJet: 1 match to top, 2 match to W")
 
@@ -306,26 +295,25 @@ class SoftBDeepAK8SFProducer(Module):
                     h_num.Divide(h_den)
     
     
-                retval = {
-                    "edges": np.fromiter(h_num.GetXaxis().GetXbins(), np.float),
-                    "values": np.array([h_num.GetBinContent(iBin) for iBin in range(1, h_num.GetNbinsX() + 1)])
-                    }
-                
-                return retval
+                return hist1DTable(h_num)
     
             tTagEffFileName = self.taggerWD + "/tTagEff_%(era)s.root"%{"era":self.era}
     
-            tTagEffFile = ROOT.TFile.Open(tTagEffFileName)
+            def readTopEffHists():
+                tTagEffFile = ROOT.TFile.Open(tTagEffFileName)
     
-            self.topEffHists = {}
-            self.topEffHists["t_as_t"] = getRatioHist("merged_t_as_t", sample, tTagEffFile)
-            self.topEffHists["t_as_w"] = getRatioHist("merged_t_as_w", sample, tTagEffFile)
-            self.topEffHists["w_as_t"] = getRatioHist("merged_w_as_t", sample, tTagEffFile)
-            self.topEffHists["w_as_w"] = getRatioHist("merged_w_as_w", sample, tTagEffFile)
-            self.topEffHists["bg_as_t"] = getRatioHist("merged_bg_as_t", sample, tTagEffFile)
-            self.topEffHists["bg_as_w"] = getRatioHist("merged_bg_as_w", sample, tTagEffFile)
+                topEffHists = {}
+                topEffHists["t_as_t"] = getRatioHist("merged_t_as_t", sample, tTagEffFile)
+                topEffHists["t_as_w"] = getRatioHist("merged_t_as_w", sample, tTagEffFile)
+                topEffHists["w_as_t"] = getRatioHist("merged_w_as_t", sample, tTagEffFile)
+                topEffHists["w_as_w"] = getRatioHist("merged_w_as_w", sample, tTagEffFile)
+                topEffHists["bg_as_t"] = getRatioHist("merged_bg_as_t", sample, tTagEffFile)
+                topEffHists["bg_as_w"] = getRatioHist("merged_bg_as_w", sample, tTagEffFile)
     
-            tTagEffFile.Close()
+                tTagEffFile.Close()
+                return topEffHists
+
+            self.topEffHists = cachedEffTable(tTagEffFileName, sample, "mergedTopEff", readTopEffHists)
 
 
 
@@ -358,79 +346,61 @@ class SoftBDeepAK8SFProducer(Module):
         self.top_fastsf    = np.ones(ntop)
         self.top_fastsferr = np.zeros(ntop)
 
-        bgFilter = stop0l==0
-        nbg = len(bgFilter[bgFilter])
-        self.top_sf_bg_t     = np.ones(nbg)
-        self.top_sf_bg_t_err = np.zeros(nbg)
-        self.top_sf_bg_w     = np.ones(nbg)
-        self.top_sf_bg_w_err = np.zeros(nbg)
+        #veto SF of the untagged jets, as a top and as a W (not used for the tagged jets)
+        self.top_sf_bg_t     = np.ones(ntop)
+        self.top_sf_bg_t_err = np.zeros(ntop)
+        self.top_sf_bg_w     = np.ones(ntop)
+        self.top_sf_bg_w_err = np.zeros(ntop)
 
-        self.top_fastsf_bg_t     = np.ones(nbg)
-        self.top_fastsf_bg_t_err = np.zeros(nbg)
-        self.top_fastsf_bg_w     = np.ones(nbg)
-        self.top_fastsf_bg_w_err = np.zeros(nbg)
+        self.top_fastsf_bg_t     = np.ones(ntop)
+        self.top_fastsf_bg_t_err = np.zeros(ntop)
+        self.top_fastsf_bg_w     = np.ones(ntop)
+        self.top_fastsf_bg_w_err = np.zeros(ntop)
 
         if self.isData:
             return
 
-        def setSF(jetPt, filt, SFMap, sf_top, sf_topErr):
-            sfBins = np.digitize(jetPt[filt], SFMap["edges"][:-1]) - 1
+        bins = {}
+        def setSF(filt, SFMap, sf_top, sf_topErr):
+            sfBins = binIndex(bins, jetPt, SFMap["edges"])[filt]
             sf_top[filt] = SFMap["values"][sfBins]
             sf_topErr[filt] = SFMap["errors"][sfBins]
+
+        bgFilter = stop0l==0
        
         #veto SF for non-tagged jets in computed below because it needs to be weighted by efficiency 
-        setSF(jetPt, (fatJetGenMatch == 1) & (stop0l == 1), self.topWSFMap["DeepTop_SF"],      self.top_sf, self.top_sferr)
-        setSF(jetPt, (fatJetGenMatch != 1) & (stop0l == 1), self.topWSFMap["DeepTop_Fake_SF"], self.top_sf, self.top_sferr)
-        setSF(jetPt, (fatJetGenMatch == 2) & (stop0l == 2), self.topWSFMap["DeepW_SF"],        self.top_sf, self.top_sferr)
-        setSF(jetPt, (fatJetGenMatch != 2) & (stop0l == 2), self.topWSFMap["DeepW_Fake_SF"],   self.top_sf, self.top_sferr)
+        setSF((fatJetGenMatch == 1) & (stop0l == 1), self.topWSFMap["DeepTop_SF"],      self.top_sf, self.top_sferr)
+        setSF((fatJetGenMatch != 1) & (stop0l == 1), self.topWSFMap["DeepTop_Fake_SF"], self.top_sf, self.top_sferr)
+        setSF((fatJetGenMatch == 2) & (stop0l == 2), self.topWSFMap["DeepW_SF"],        self.top_sf, self.top_sferr)
+        setSF((fatJetGenMatch != 2) & (stop0l == 2), self.topWSFMap["DeepW_Fake_SF"],   self.top_sf, self.top_sferr)
 
-        setSF(jetPt[bgFilter], fatJetGenMatch[bgFilter] == 1, self.topWSFMap["DeepTop_SF"],      self.top_sf_bg_t, self.top_sf_bg_t_err)
-        setSF(jetPt[bgFilter], fatJetGenMatch[bgFilter] != 1, self.topWSFMap["DeepTop_Fake_SF"], self.top_sf_bg_t, self.top_sf_bg_t_err)
-        setSF(jetPt[bgFilter], fatJetGenMatch[bgFilter] == 2, self.topWSFMap["DeepW_SF"],        self.top_sf_bg_w, self.top_sf_bg_w_err)
-        setSF(jetPt[bgFilter], fatJetGenMatch[bgFilter] != 2, self.topWSFMap["DeepW_Fake_SF"],   self.top_sf_bg_w, self.top_sf_bg_w_err)
+        setSF((fatJetGenMatch == 1) & bgFilter, self.topWSFMap["DeepTop_SF"],      self.top_sf_bg_t, self.top_sf_bg_t_err)
+        setSF((fatJetGenMatch != 1) & bgFilter, self.topWSFMap["DeepTop_Fake_SF"], self.top_sf_bg_t, self.top_sf_bg_t_err)
+        setSF((fatJetGenMatch == 2) & bgFilter, self.topWSFMap["DeepW_SF"],        self.top_sf_bg_w, self.top_sf_bg_w_err)
+        setSF((fatJetGenMatch != 2) & bgFilter, self.topWSFMap["DeepW_Fake_SF"],   self.top_sf_bg_w, self.top_sf_bg_w_err)
 
-        setSF(jetPt,                          stop0l == 1 , self.topWSFMap["DeepTop_fastSF"],  self.top_fastsf, self.top_fastsferr)
-        setSF(jetPt,                          stop0l == 2 , self.topWSFMap["DeepW_fastSF"],    self.top_fastsf, self.top_fastsferr)
+        setSF(stop0l == 1, self.topWSFMap["DeepTop_fastSF"],  self.top_fastsf, self.top_fastsferr)
+        setSF(stop0l == 2, self.topWSFMap["DeepW_fastSF"],    self.top_fastsf, self.top_fastsferr)
 
-        setSF(jetPt[bgFilter], np.ones(nbg).astype(bool) , self.topWSFMap["DeepTop_fastSF"],  self.top_fastsf_bg_t, self.top_fastsf_bg_t_err)
-        setSF(jetPt[bgFilter], np.ones(nbg).astype(bool) , self.topWSFMap["DeepW_fastSF"],    self.top_fastsf_bg_w, self.top_fastsf_bg_w_err)
+        setSF(bgFilter, self.topWSFMap["DeepTop_fastSF"],  self.top_fastsf_bg_t, self.top_fastsf_bg_t_err)
+        setSF(bgFilter, self.topWSFMap["DeepW_fastSF"],    self.top_fastsf_bg_w, self.top_fastsf_bg_w_err)
 
         return
 
-    class TTreeReaderArrayWrapper:
-        def __init__(self, ttarray):
-            self.ttarray = ttarray
-
-        def __iter__(self):
-            for i in xrange(len(self.ttarray)):
-                yield self.ttarray[i]
-            return
-
-    def nGenParts(self, event):
+    def nGenParts(self, event, fatJetEta, fatJetPhi):
         if not self.isData:
-            GenPart_pdgId = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_pdgId), int)
-            GenPart_statusFlags = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_statusFlags), int)
-            GenPart_eta = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_eta), float)
-            GenPart_phi = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_phi), float)
-
-            fatJet_eta = np.fromiter(self.TTreeReaderArrayWrapper(event.FatJet_eta), float)
-            fatJet_phi = np.fromiter(self.TTreeReaderArrayWrapper(event.FatJet_phi), float)
+            GenPart_pdgId = branchArray(event.GenPart_pdgId, dtype=int)
+            GenPart_statusFlags = branchArray(event.GenPart_statusFlags, dtype=int)
+            GenPart_eta = branchArray(event.GenPart_eta, dtype=float)
+            GenPart_phi = branchArray(event.GenPart_phi, dtype=float)
 
             # statusFlag 0x2100 corresponds to "isLastCopy and fromHardProcess"
             # statusFlag 0x2080 corresponds to "IsLastCopy and isHardProcess"
             genPartsFilt = (((abs(GenPart_pdgId) >= 1) & (abs(GenPart_pdgId) <= 5)) | (abs(GenPart_pdgId) == 21)) & (((GenPart_statusFlags & 0x2100) == 0x2100) | ((GenPart_statusFlags & 0x2080) == 0x2080))
 
             #calculate deltaR matches
-            etas = np.array(np.meshgrid(fatJet_eta, GenPart_eta[genPartsFilt])).T
-            deta = np.power(etas[:, :, 0] - etas[:, :, 1], 2)
-            phis = np.array(np.meshgrid(fatJet_phi, GenPart_phi[genPartsFilt])).T
-            dPhi = phis[:, :, 0] - phis[:, :, 1]
-            np.subtract(dPhi, 2*math.pi, out = dPhi, where= (dPhi >=math.pi))
-            np.add(dPhi, 2*math.pi,  out =dPhi , where=(dPhi < -1*math.pi))
-            np.power(dPhi, 2, out=dPhi)
-            dR2 = np.add(deta, dPhi)
-            nGenPartMatch = (dR2 < 0.6*0.6).sum(axis=1)
-            return nGenPartMatch
+            genEta = GenPart_eta[genPartsFilt]
+            return fatJetGenPartCount(eventOffsets(len(fatJetEta)), fatJetEta, fatJetPhi, eventOffsets(len(genEta)), genEta, GenPart_phi[genPartsFilt])
         else:
             return np.zeros(len(event.FatJet_pt)).astype(int)
 
@@ -439,156 +409,71 @@ class SoftBDeepAK8SFProducer(Module):
         if self.isData:
             return np.zeros(fatJetEta.shape).astype(int)
 
-        GenPart_eta              = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_eta),              dtype=float)
-        GenPart_phi              = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_phi),              dtype=float)
-
-        GenPart_genPartIdxMother = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_genPartIdxMother), dtype=int)
-        GenPart_pdgId            = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_pdgId),            dtype=int)
-        GenPart_statusFlags      = np.fromiter(self.TTreeReaderArrayWrapper(event.GenPart_statusFlags),      dtype=int)
-    
-        genTopDaughters_list, genWDaughters_list = genParticleAssociation(GenPart_genPartIdxMother, GenPart_pdgId, GenPart_statusFlags)
-    
-        genTopDaughters, genWDaughters = np.array(genTopDaughters_list), np.array(genWDaughters_list)
-    
-        if(len(genTopDaughters)):
-            genTopDaughters_eta = GenPart_eta[genTopDaughters]
-            genTopDaughters_phi = GenPart_phi[genTopDaughters]
-        else:
-            genTopDaughters_eta = np.array([])
-            genTopDaughters_phi = np.array([])
-    
-        if len(genWDaughters):
-            genWDaughters_eta = GenPart_eta[genWDaughters]
-            genWDaughters_phi = GenPart_phi[genWDaughters]
-        else:
-            genWDaughters_eta = np.array([])
-            genWDaughters_phi = np.array([])
-    
-        return deltaRMatch(fatJetEta, fatJetPhi, genTopDaughters_eta, genTopDaughters_phi, genWDaughters_eta, genWDaughters_phi)
-
-    def calculateTopSFWeight(self, fatJetStop0l, fatJetPt, fatJetGenMatch, nGenPart):
-
-        #Get efficiencies 
-        def setEff(topPt, catName, topEff, filterArray):
-            effBins_top = np.digitize(topPt[filterArray], self.topEffHists[catName]["edges"][:-1]) - 1
-            topEff[filterArray] =  self.topEffHists[catName]["values"][effBins_top]
+        GenPart_eta              = branchArray(event.GenPart_eta,              dtype=float)
+        GenPart_phi              = branchArray(event.GenPart_phi,              dtype=float)
 
-        topEff_t = np.ones(len(self.top_sf_bg_t))
-        topEff_w = np.ones(len(self.top_sf_bg_w))
+        genTopDaughters, genWDaughters = genAncestry(event).hardProcessDecays()
+        genTopDaughters, genWDaughters = np.array(genTopDaughters, dtype=int), np.array(genWDaughters, dtype=int)
 
-        recoBGFilter = fatJetStop0l == 0
+        return fatJetGenMatchType(eventOffsets(len(fatJetEta)), fatJetEta, fatJetPhi,
+                                  eventOffsets(len(genTopDaughters)), GenPart_eta[genTopDaughters], GenPart_phi[genTopDaughters],
+                                  eventOffsets(len(genWDaughters)),   GenPart_eta[genWDaughters],   GenPart_phi[genWDaughters])
 
-        setEff(fatJetPt[recoBGFilter], "t_as_t",  topEff_t, fatJetGenMatch[recoBGFilter] == 1)
-        setEff(fatJetPt[recoBGFilter], "w_as_t",  topEff_t, fatJetGenMatch[recoBGFilter] == 2)
-        setEff(fatJetPt[recoBGFilter], "bg_as_t", topEff_t, fatJetGenMatch[recoBGFilter] == 0)
-        setEff(fatJetPt[recoBGFilter], "t_as_w",  topEff_w, fatJetGenMatch[recoBGFilter] == 1)
-        setEff(fatJetPt[recoBGFilter], "w_as_w",  topEff_w, fatJetGenMatch[recoBGFilter] == 2)
-        setEff(fatJetPt[recoBGFilter], "bg_as_w", topEff_w, fatJetGenMatch[recoBGFilter] == 0)
+    def topTagEff(self, topPt, fatJetGenMatch):
+        """Efficiency of each jet to be tagged as a top and as a W, from its gen match"""
+        topEff_t = np.ones(len(topPt))
+        topEff_w = np.ones(len(topPt))
+        bins = {}
+        for match, cat in ((1, "t"), (2, "w"), (0, "bg")):
+            filt = fatJetGenMatch == match
+            for topEff, tag in ((topEff_t, "t"), (topEff_w, "w")):
+                hist = self.topEffHists[cat + "_as_" + tag]
+                topEff[filt] = hist["values"][binIndex(bins, topPt, hist["edges"])[filt]]
 
         #safety against very rare cases where eff = 0
         topEff_t[topEff_t <= 0.0001] = 0.0001
         topEff_w[topEff_w <= 0.0001] = 0.0001
+        return topEff_t, topEff_w
 
-        topSF_t_tagged  = self.top_sf[fatJetStop0l == 1]
-        topSF_w_tagged  = self.top_sf[fatJetStop0l == 2]
-
-        denseTopFilter = (nGenPart >= 4)[fatJetStop0l == 1].astype(float)
-
-        numerator = topSF_t_tagged.prod() * topSF_w_tagged.prod() * (1 - topEff_t*self.top_sf_bg_t - topEff_w*self.top_sf_bg_w).prod()
-
-        denominator = (1 - topEff_t - topEff_w).prod()
-
-        if self.isFastSim:
-            topSF_fast_t_tagged  = self.top_fastsf[fatJetStop0l == 1]
-            topSF_fast_w_tagged  = self.top_fastsf[fatJetStop0l == 2]
-
-            numerator_fast = (topSF_t_tagged*topSF_fast_t_tagged).prod() * (topSF_w_tagged*topSF_fast_w_tagged).prod() * (1 - topEff_t*self.top_sf_bg_t*self.top_fastsf_bg_t - topEff_w*self.top_sf_bg_w*self.top_fastsf_bg_w).prod()
-
-
-        #calculate uncertainty variations of weight
-        if not self.isData:
-            uncert_t = self.top_sferr[fatJetStop0l == 1]
-            uncert_w = self.top_sferr[fatJetStop0l == 2]
-        
-            numerator_up = (topSF_t_tagged + uncert_t).prod() * (topSF_w_tagged + uncert_w).prod() * (1 - topEff_t*(self.top_sf_bg_t + self.top_sf_bg_t_err) - topEff_w*(self.top_sf_bg_w + self.top_sf_bg_w_err)).prod()
-            numerator_dn = (topSF_t_tagged - uncert_t).prod() * (topSF_w_tagged - uncert_w).prod() * (1 - topEff_t*(self.top_sf_bg_t - self.top_sf_bg_t_err) - topEff_w*(self.top_sf_bg_w - self.top_sf_bg_w_err)).prod()
-
-            numerator_t_up = (topSF_t_tagged + uncert_t).prod() * (topSF_w_tagged).prod()            * (1 - topEff_t*(self.top_sf_bg_t)                        - topEff_w*(self.top_sf_bg_w)).prod()
-            numerator_t_dn = (topSF_t_tagged - uncert_t).prod() * (topSF_w_tagged).prod()            * (1 - topEff_t*(self.top_sf_bg_t)                        - topEff_w*(self.top_sf_bg_w)).prod()
-            numerator_w_up = (topSF_t_tagged).prod()            * (topSF_w_tagged + uncert_w).prod() * (1 - topEff_t*(self.top_sf_bg_t)                        - topEff_w*(self.top_sf_bg_w)).prod()
-            numerator_w_dn = (topSF_t_tagged).prod()            * (topSF_w_tagged - uncert_w).prod() * (1 - topEff_t*(self.top_sf_bg_t)                        - topEff_w*(self.top_sf_bg_w)).prod()
-            numerator_v_up = (topSF_t_tagged).prod()            * (topSF_w_tagged).prod()            * (1 - topEff_t*(self.top_sf_bg_t + self.top_sf_bg_t_err) - topEff_w*(self.top_sf_bg_w + self.top_sf_bg_w_err)).prod()
-            numerator_v_dn = (topSF_t_tagged).prod()            * (topSF_w_tagged).prod()            * (1 - topEff_t*(self.top_sf_bg_t - self.top_sf_bg_t_err) - topEff_w*(self.top_sf_bg_w - self.top_sf_bg_w_err)).prod()
-
-            numerator_densetop_up = (topSF_t_tagged*(1+0.2*denseTopFilter)).prod() * topSF_w_tagged.prod() * (1 - topEff_t*self.top_sf_bg_t - topEff_w*self.top_sf_bg_w).prod()
-            numerator_densetop_dn = (topSF_t_tagged/(1+0.2*denseTopFilter)).prod() * topSF_w_tagged.prod() * (1 - topEff_t*self.top_sf_bg_t - topEff_w*self.top_sf_bg_w).prod()
-
-            if self.isFastSim:
-                uncert_fast_t  = self.top_fastsferr[fatJetStop0l == 1]
-                uncert_fast_w  = self.top_fastsferr[fatJetStop0l == 2]
-
-                numerator_fast_up = (topSF_t_tagged*(topSF_fast_t_tagged + uncert_fast_t)).prod() * (topSF_w_tagged*(topSF_fast_w_tagged + uncert_fast_w)).prod() * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t + self.top_fastsf_bg_t_err) - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w + self.top_fastsf_bg_w_err)).prod()
-                numerator_fast_dn = (topSF_t_tagged*(topSF_fast_t_tagged - uncert_fast_t)).prod() * (topSF_w_tagged*(topSF_fast_w_tagged - uncert_fast_w)).prod() * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t - self.top_fastsf_bg_t_err) - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w - self.top_fastsf_bg_w_err)).prod()
-
-                numerator_fast_t_up = (topSF_t_tagged*(topSF_fast_t_tagged + uncert_fast_t)).prod() * (topSF_w_tagged*(topSF_fast_w_tagged)).prod()                 * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t)                            - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w)).prod()
-                numerator_fast_t_dn = (topSF_t_tagged*(topSF_fast_t_tagged - uncert_fast_t)).prod() * (topSF_w_tagged*(topSF_fast_w_tagged)).prod()                 * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t)                            - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w)).prod()
-                numerator_fast_w_up = (topSF_t_tagged*(topSF_fast_t_tagged)).prod()                 * (topSF_w_tagged*(topSF_fast_w_tagged + uncert_fast_w)).prod() * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t)                            - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w)).prod()
-                numerator_fast_w_dn = (topSF_t_tagged*(topSF_fast_t_tagged)).prod()                 * (topSF_w_tagged*(topSF_fast_w_tagged - uncert_fast_w)).prod() * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t)                            - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w)).prod()
-                numerator_fast_v_up = (topSF_t_tagged*(topSF_fast_t_tagged)).prod()                 * (topSF_w_tagged*(topSF_fast_w_tagged)).prod()                 * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t + self.top_fastsf_bg_t_err) - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w + self.top_fastsf_bg_w_err)).prod()
-                numerator_fast_v_dn = (topSF_t_tagged*(topSF_fast_t_tagged)).prod()                 * (topSF_w_tagged*(topSF_fast_w_tagged)).prod()                 * (1 - topEff_t*self.top_sf_bg_t*(self.top_fastsf_bg_t - self.top_fastsf_bg_t_err) - topEff_w*self.top_sf_bg_w*(self.top_fastsf_bg_w - self.top_fastsf_bg_w_err)).prod()
-
-
-
-
-            else:
-                numerator_fast_up = 0.0
-                numerator_fast_dn = 0.0
-
-                numerator_fast_t_up = 0.0
-                numerator_fast_t_dn = 0.0
-                numerator_fast_w_up = 0.0
-                numerator_fast_w_dn = 0.0
-                numerator_fast_v_up = 0.0
-                numerator_fast_v_dn = 0.0
-
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight" , numerator/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_total_up" , numerator_up/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_total_dn" , numerator_dn/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_top_up" , numerator_t_up/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_top_dn" , numerator_t_dn/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_w_up" , numerator_w_up/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_w_dn" , numerator_w_dn/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_veto_up" , numerator_v_up/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_veto_dn" , numerator_v_dn/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_densetop_up" , numerator_densetop_up/denominator)
-            self.out.fillBranch("Stop0l_DeepAK8_SFWeight_densetop_dn" , numerator_densetop_dn/denominator)
-            if self.isFastSim:
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast" , numerator_fast/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_total_up" , numerator_fast_up/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_total_dn" , numerator_fast_dn/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_top_up", numerator_fast_t_up/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_top_dn", numerator_fast_t_dn/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_w_up", numerator_fast_w_up/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_w_dn", numerator_fast_w_dn/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_veto_up", numerator_fast_v_up/denominator)
-                self.out.fillBranch("Stop0l_DeepAK8_SFWeight_fast_veto_dn", numerator_fast_v_dn/denominator)
-
+    def calculateTopSFWeight(self, fatJetStop0l, fatJetPt, fatJetGenMatch, nGenPart):
+        topEff_t, topEff_w = self.topTagEff(fatJetPt, fatJetGenMatch)
+        jets = {
+            "stop0l"       : fatJetStop0l,
+            "nGenPart"     : nGenPart,
+            "sf"           : self.top_sf,
+            "sfErr"        : self.top_sferr,
+            "fastSF"       : self.top_fastsf,
+            "fastSFErr"    : self.top_fastsferr,
+            "effT"         : topEff_t,
+            "effW"         : topEff_w,
+            "vetoT"        : self.top_sf_bg_t,
+            "vetoTErr"     : self.top_sf_bg_t_err,
+            "vetoW"        : self.top_sf_bg_w,
+            "vetoWErr"     : self.top_sf_bg_w_err,
+            "fastVetoT"    : self.top_fastsf_bg_t,
+            "fastVetoTErr" : self.top_fastsf_bg_t_err,
+            "fastVetoW"    : self.top_fastsf_bg_w,
+            "fastVetoWErr" : self.top_fastsf_bg_w_err,
+        }
+        weights = deepAK8SFWeights(eventOffsets(len(fatJetStop0l)), jets, self.sfVariations)
+        for suffix, shifts, dense, fast in self.sfVariations:
+            self.out.fillBranch("Stop0l_DeepAK8_SFWeight" + suffix, weights[suffix][0])
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
         isvs    = Collection(event, "SB")
         fatjets  = Collection(event, "FatJet")
 
-        fatJetStop0l = np.fromiter(self.TTreeReaderArrayWrapper(event.FatJet_Stop0l), dtype=int)
-        fatJetPt = np.fromiter(self.TTreeReaderArrayWrapper(event.FatJet_pt), dtype=float)
-        fatJetEta = np.fromiter(self.TTreeReaderArrayWrapper(event.FatJet_eta), dtype=float)
-        fatJetPhi = np.fromiter(self.TTreeReaderArrayWrapper(event.FatJet_phi), dtype=float)
+        fatJetStop0l = branchArray(event.FatJet_Stop0l, dtype=int)
+        fatJetPt = branchArray(event.FatJet_pt, dtype=float)
+        fatJetEta = branchArray(event.FatJet_eta, dtype=float)
+        fatJetPhi = branchArray(event.FatJet_phi, dtype=float)
 
         #gen match the fat jets
         fatJetGenMatch = self.fatJetGenMatch(event, fatJetEta, fatJetPhi)
 
         #add additional uncertainty for tops with more than 3 gen particles matched 
-        nGenPart = self.nGenParts(event)
+        nGenPart = self.nGenParts(event, fatJetEta, fatJetPhi)
 
         fatJetPtFilter = fatJetPt >= 200.0
         sb_sf, sb_sferr, sb_fastsf, sb_fastsferr = self.GetSoftBSF(isvs)
@@ -1,31 +1,151 @@
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 import math
+import operator
+import functools
 import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
-
-from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped, CollectionRemapped
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, parseVariations, remapView, cachedCollection, cachedObject
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import BatchReader, ColumnGroups, \
+        offsetsFromCounts, localIndex, segmentRank, segmentCount, segmentAny, segmentSum
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Cut table ~~~~~
+## The cuts below are read by both the per-event and the batch evaluation.
+## Flags are combined with "&", which works for python bools as well as for
+## NumPy arrays of a batch of events.
+
+# https://twiki.cern.ch/twiki/bin/viewauth/CMS/MissingETOptionalFiltersRun2#2016_data
+## Missing the latest ecalBadCalibReducedMINIAODFilter in 2017/2018, not in MiniAOD
+## But still using the old ecalBadCalibFilter from MiniAOD
+EventFilters = {
+    "2016" : ["goodVertices", "HBHENoiseFilter", "HBHENoiseIsoFilter", "EcalDeadCellTriggerPrimitiveFilter", "BadPFMuonFilter"],
+    "2017" : ["goodVertices", "HBHENoiseFilter", "HBHENoiseIsoFilter", "EcalDeadCellTriggerPrimitiveFilter", "BadPFMuonFilter", "ecalBadCalibFilter"],
+    "2018" : ["goodVertices", "HBHENoiseFilter", "HBHENoiseIsoFilter", "EcalDeadCellTriggerPrimitiveFilter", "BadPFMuonFilter", "ecalBadCalibFilter"],
+}
+DataOnlyFilters    = ["globalSuperTightHalo2016Filter", "eeBadScFilter"]
+FullSimOnlyFilters = ["globalSuperTightHalo2016Filter"]
+
+## Stop0l event variables used in the cuts, remapped per variation
+Stop0lVariables = ["HT", "nJets", "nbtags", "nTop", "nW", "nResolved", "Mtb", "ISRJetPt", "METSig"]
+
+CutOperators = {
+    ">=" : operator.ge,
+    ">"  : operator.gt,
+    "<"  : operator.lt,
+    "==" : operator.eq,
+}
+
+## Cuts on event variables: the Stop0l variables, plus MET and nJets30 (number of Stop0l jets)
+VariableCuts = {
+    "Pass_NJets30" : [("nJets30",   ">=", 2)],
+    "Pass_MET"     : [("MET",       ">=", 250)],
+    "Pass_HT"      : [("HT",        ">=", 300)],
+    "highDM"       : [("nJets",     ">=", 5), ("nbtags", ">=", 1)],
+    "lowDM"        : [("nTop",      "==", 0), ("nW",     "==", 0), ("nResolved", "==", 0),
+                      ("Mtb",       "<",  175), ("ISRJetPt", ">=", 200), ("METSig", ">", 10)],
+}
+
+## dPhi(jet, MET) cuts on the leading jets: (cuts, inverted)
+DPhiCuts = {
+    "Pass_dPhiMETLowDM"  : ([0.5, 0.15, 0.15],     False),
+    "Pass_dPhiMETHighDM" : ([0.5, 0.5, 0.5, 0.5],  False),
+    "dPhiQCD"            : ([0.1, 0.1, 0.1],       True),
+}
+## dPhi(jet, MET) windows on the leading jets: (low, high)
+DPhiWindows = {
+    "Pass_dPhiMETMedDM"  : ([0.15, 0.15, 0.15], [0.5, 4., 4.]), #Variable for LowDM Validation bins
+}
+
+## HEM veto 2018: (etalow, etahigh, philow, phihigh, ptcut)
+HEMVetoWindows = {
+    # "Pass_HEMVeto20"   : (-3,   -1.4, -1.57, -0.87, 20),
+    # "Pass_HEMVeto30"   : (-3,   -1.4, -1.57, -0.87, 30),
+    "Pass_exHEMVeto20" : (-3.2, -1.2, -1.77, -0.67, 20),
+    "Pass_exHEMVeto30" : (-3.2, -1.2, -1.77, -0.67, 30),
+}
+
+## Flags defined as the AND of other flags, evaluated in this order
+CombinedFlags = [
+    ("Pass_LeptonVeto",   ["Pass_ElecVeto", "Pass_MuonVeto", "Pass_IsoTrkVeto", "Pass_TauVeto"]),
+    ("Pass_dPhiMET",      ["Pass_dPhiMETLowDM"]),
+    ("Pass_Baseline",     ["Pass_EventFilter", "Pass_JetID", "Pass_LeptonVeto", "Pass_NJets30", "Pass_MET", "Pass_HT", "Pass_dPhiMETLowDM"]),
+    ("Pass_highDM",       ["Pass_Baseline", "highDM", "Pass_dPhiMETHighDM"]),
+    ("Pass_lowDM",        ["Pass_Baseline", "lowDM"]),
+    ("Pass_QCDCR",        ["Pass_EventFilter", "Pass_JetID", "Pass_LeptonVeto", "Pass_NJets30", "Pass_MET", "Pass_HT", "dPhiQCD"]),
+    ("Pass_QCDCR_highDM", ["Pass_QCDCR", "highDM"]),
+    ("Pass_QCDCR_lowDM",  ["Pass_QCDCR", "lowDM"]),
+    ("Pass_LLCR",         ["Pass_EventFilter", "Pass_JetID", "LLLep", "Pass_NJets30", "Pass_MET", "Pass_HT", "Pass_dPhiMETLowDM"]),
+    ("Pass_LLCR_highDM",  ["Pass_LLCR", "highDM", "Pass_dPhiMETHighDM"]),
+    ("Pass_LLCR_lowDM",   ["Pass_LLCR", "lowDM"]),
+]
+
+## Flags of the columnar path computed from the input file branches only,
+## without the Stop0l objects of the previous modules
+ColumnarFileFlags = ["Pass_EventFilter", "Pass_JetID", "Pass_CaloMETRatio"] + HEMVetoWindows.keys()
+
+## Stored flags and their branch titles
+OutputFlags = [
+    # ("Pass_LeptonTauVeto", ""),
+    ("Pass_JetID",         ""),
+    ("Pass_CaloMETRatio",  "ICHEP16 Filter: pfMET/CaloMET < 5"),
+    ("Pass_EventFilter",   ""),
+    ("Pass_ElecVeto",      ""),
+    ("Pass_MuonVeto",      ""),
+    ("Pass_IsoTrkVeto",    ""),
+    ("Pass_TauVeto",       ""),
+    ("Pass_LeptonVeto",    ""),
+    ("Pass_NJets30",       ""),
+    ("Pass_MET",           ""),
+    ("Pass_HT",            ""),
+    ("Pass_dPhiMET",       ""),
+    ("Pass_dPhiMETLowDM",  ""),
+    ("Pass_dPhiMETMedDM",  ""),
+    ("Pass_dPhiMETHighDM", ""),
+    ("Pass_Baseline",      ""),
+    ("Pass_highDM",        ""),
+    ("Pass_lowDM",         ""),
+    ("Pass_QCDCR",         ""),
+    ("Pass_QCDCR_highDM",  ""),
+    ("Pass_QCDCR_lowDM",   ""),
+    ("Pass_LLCR",          ""),
+    ("Pass_LLCR_highDM",   ""),
+    ("Pass_LLCR_lowDM",    ""),
+    # ("Pass_HEMVeto20",     "HEM Veto 2018: eta[-3, -1.4], phi[-1.57, -0.87], pt > 20"),
+    # ("Pass_HEMVeto30",     "HEM Veto 2018: eta[-3, -1.4], phi[-1.57, -0.87], pt > 30"),
+    ("Pass_exHEMVeto20",   "HEM Veto 2018: eta[-3.2, -1.2], phi[-1.77, -0.67], pt > 20"),
+    ("Pass_exHEMVeto30",   "HEM Veto 2018: eta[-3.2, -1.2], phi[-1.77, -0.67], pt > 30"),
+]
+
+def passVariableCuts(cuts, variables):
+    return reduce(operator.and_, [CutOperators[op](variables[var], val) for var, op, val in cuts])
+
+def combineFlags(flags):
+    for name, terms in CombinedFlags:
+        flags[name] = reduce(operator.and_, [flags[t] for t in terms])
+    return flags
 
 class Stop0lBaselineProducer(Module):
-    def __init__(self, era, isData = False, isFastSim=False, applyUncert=None):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Jet", "Electron", "Muon", "IsoTrack", "Tau") + ["MET_*", "CaloMET_*", "Flag_*"]
+
+    def __init__(self, era, isData = False, isFastSim=False, applyUncert=None, batchSize = 0):
         self.era = era
         self.isFastSim = isFastSim
         self.isData = isData
+        self.eventFilters = EventFilters[era] + (DataOnlyFilters if isData else [] if isFastSim else FullSimOnlyFilters)
 
-        self.applyUncert = applyUncert
-
-        self.suffix = ""
+        ## With batchSize > 0 the flags are evaluated on batches of events with
+        ## NumPy, see beginColumnar
+        self.batchSize = batchSize
 
-        if self.applyUncert == "JESUp":
-            self.suffix = "_JESUp"
-        elif self.applyUncert == "METUnClustUp":
-            self.suffix = "_METUnClustUp"
-        elif self.applyUncert == "JESDown":
-            self.suffix = "_JESDown"
-        elif self.applyUncert == "METUnClustDown":
-            self.suffix = "_METUnClustDown"
+        ## applyUncert is either a single variation, or a list of variations
+        ## (e.g. ["nominal", "JESUp", "JESDown"]) evaluated together in one pass
+        self.applyUncert = applyUncert
+        self.variations = parseVariations(applyUncert)
 
         self.branchMap = {}
 
@@ -36,45 +156,29 @@ class Stop0lBaselineProducer(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
-        #self.out.branch("Pass_LeptonTauVeto", "O")
-        self.out.branch("Pass_JetID"         + self.suffix, "O")
-        self.out.branch("Pass_CaloMETRatio"  + self.suffix, "O", title="ICHEP16 Filter: pfMET/CaloMET < 5")
-        self.out.branch("Pass_EventFilter"   + self.suffix, "O")
-        self.out.branch("Pass_ElecVeto"      + self.suffix, "O")
-        self.out.branch("Pass_MuonVeto"      + self.suffix, "O")
-        self.out.branch("Pass_IsoTrkVeto"    + self.suffix, "O")
-        self.out.branch("Pass_TauVeto"       + self.suffix, "O")
-        self.out.branch("Pass_LeptonVeto"    + self.suffix, "O")
-        self.out.branch("Pass_NJets30"       + self.suffix, "O")
-        self.out.branch("Pass_MET"           + self.suffix, "O")
-        self.out.branch("Pass_HT"            + self.suffix, "O")
-        self.out.branch("Pass_dPhiMET"       + self.suffix, "O")
-        self.out.branch("Pass_dPhiMETLowDM"  + self.suffix, "O")
-        self.out.branch("Pass_dPhiMETMedDM"  + self.suffix, "O")
-        self.out.branch("Pass_dPhiMETHighDM" + self.suffix, "O")
-        self.out.branch("Pass_Baseline"      + self.suffix, "O")
-        self.out.branch("Pass_highDM"        + self.suffix, "O")
-        self.out.branch("Pass_lowDM"         + self.suffix, "O")
-        self.out.branch("Pass_QCDCR"         + self.suffix, "O")
-        self.out.branch("Pass_QCDCR_highDM"  + self.suffix, "O")
-        self.out.branch("Pass_QCDCR_lowDM"   + self.suffix, "O")
-        self.out.branch("Pass_LLCR"          + self.suffix, "O")
-        self.out.branch("Pass_LLCR_highDM"   + self.suffix, "O")
-        self.out.branch("Pass_LLCR_lowDM"    + self.suffix, "O")
-        # self.out.branch("Pass_HEMVeto20"     + self.suffix, "O", title="HEM Veto 2018: eta[-3, -1.4], phi[-1.57, -0.87], pt > 20")
-        # self.out.branch("Pass_HEMVeto30"     + self.suffix, "O", title="HEM Veto 2018: eta[-3, -1.4], phi[-1.57, -0.87], pt > 30")
-        self.out.branch("Pass_exHEMVeto20"   + self.suffix, "O", title="HEM Veto 2018: eta[-3.2, -1.2], phi[-1.77, -0.67], pt > 20")
-        self.out.branch("Pass_exHEMVeto30"   + self.suffix, "O", title="HEM Veto 2018: eta[-3.2, -1.2], phi[-1.77, -0.67], pt > 30")
-        self.out.branch("Jet_sortedIdx"      + self.suffix, "I", lenVar="Jet_nsortedIdx" + self.suffix)
-
-        # Construct Stop0l map
-        lob = wrappedOutputTree._branches.keys()
-        for bn in lob:
-            if self.suffix and "Stop0l" == bn[0:6] and self.suffix in bn:
-                self.branchMap[bn[len("Stop0l_"):-len(self.suffix)]] = bn[len("Stop0l_"):]
+        for uncert in self.variations:
+            suffix = VariationRemap[uncert]["suffix"]
+            for name, title in OutputFlags:
+                if title:
+                    self.out.branch(name + suffix, "O", title=title)
+                else:
+                    self.out.branch(name + suffix, "O")
+            self.out.branch("Jet_sortedIdx"      + suffix, "I", lenVar="Jet_nsortedIdx" + suffix)
+
+            # Construct Stop0l map
+            branchMap = {}
+            lob = wrappedOutputTree._branches.keys()
+            for bn in lob:
+                if suffix and "Stop0l" == bn[0:6] and suffix in bn:
+                    branchMap[bn[len("Stop0l_"):-len(suffix)]] = bn[len("Stop0l_"):]
+            self.branchMap[uncert] = branchMap
+
+        if self.batchSize > 0:
+            self.beginColumnar(inputFile, wrappedOutputTree)
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.batchSize > 0:
+            self.batchReader.endFile()
 
     def calculateNLeptons(self, eles, muons, isks, taus):
         countEle = sum([e.Stop0l for e in eles])
@@ -85,35 +189,7 @@ class Stop0lBaselineProducer(Module):
 
     def PassEventFilter(self, flags):
         # https://twiki.cern.ch/twiki/bin/viewauth/CMS/MissingETOptionalFiltersRun2#2016_data
-        passEventFilter = None
-
-        #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ 2016 ~~~~~
-        if self.era == "2016":
-            ## Common filters
-            passEventFilter = flags.goodVertices and flags.HBHENoiseFilter and \
-                    flags.HBHENoiseIsoFilter and flags.EcalDeadCellTriggerPrimitiveFilter \
-                    and flags.BadPFMuonFilter 
-            ## Only data
-            if self.isData:
-                passEventFilter = passEventFilter and flags.globalSuperTightHalo2016Filter and flags.eeBadScFilter
-            elif not self.isFastSim:
-                passEventFilter = passEventFilter and flags.globalSuperTightHalo2016Filter
-
-        #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ 2017 ~~~~~
-        if self.era == "2017" or self.era == "2018":
-            ## Common filters
-            ## Missing the latest ecalBadCalibReducedMINIAODFilter, not in MiniAOD
-            ## But still using the old ecalBadCalibFilter from MiniAOD
-            passEventFilter = flags.goodVertices and flags.HBHENoiseFilter and \
-                    flags.HBHENoiseIsoFilter and flags.EcalDeadCellTriggerPrimitiveFilter \
-                    and flags.BadPFMuonFilter and flags.ecalBadCalibFilter  
-            ## Only data
-            if self.isData:
-                passEventFilter = passEventFilter and flags.globalSuperTightHalo2016Filter and flags.eeBadScFilter
-            elif not self.isFastSim:
-                passEventFilter = passEventFilter and flags.globalSuperTightHalo2016Filter
-
-        return passEventFilter
+        return all(getattr(flags, f) for f in self.eventFilters)
 
     def PassJetID(self, jets):
         # In case of fastsim, it has been observed with lower efficiency
@@ -131,10 +207,6 @@ class Stop0lBaselineProducer(Module):
         return (0 not in jetIDs)
 
 
-    def PassNjets(self, jets):
-        countJets = sum([j.Stop0l for j in jets])
-        return countJets >= 2
-
     def GetJetSortedIdx(self, jets):
         ptlist = []
         etalist = []
@@ -168,121 +240,252 @@ class Stop0lBaselineProducer(Module):
                 return False
         return True
 
-    def analyze(self, event):
-        """process event, return True (go to next module) or False (fail, go to next event)"""
-        if self.applyUncert == "JESUp":
-            isotracks = CollectionRemapped(event, "IsoTrack", replaceMap={"Stop0l":"Stop0l_JESUp"})
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalUp", "mass":"mass_jesTotalUp", "dPhiMET":"dPhiMET_JESUp", "Stop0l":"Stop0l_JESUp"})
-            met       = ObjectRemapped(event,     "MET", replaceMap={"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"})
-            stop0l    = ObjectRemapped(event,     "Stop0l", replaceMap=self.branchMap)
-        elif self.applyUncert == "JESDown":
-            isotracks = CollectionRemapped(event, "IsoTrack", replaceMap={"Stop0l":"Stop0l_JESDown"})
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalDown", "mass":"mass_jesTotalDown", "dPhiMET":"dPhiMET_JESDown", "Stop0l":"Stop0l_JESDown"})
-            met       = ObjectRemapped(event,     "MET", replaceMap={"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"})
-            stop0l    = ObjectRemapped(event,     "Stop0l", replaceMap=self.branchMap)
-        elif self.applyUncert == "METUnClustUp":
-            isotracks = CollectionRemapped(event, "IsoTrack", replaceMap={"Stop0l":"Stop0l_METUnClustUp"})
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"dPhiMET":"dPhiMET_METUnClustUp"})
-            met       = ObjectRemapped(event,     "MET", replaceMap={"pt":"pt_unclustEnUp", "phi":"phi_unclustEnUp"})
-            stop0l    = ObjectRemapped(event,     "Stop0l", replaceMap=self.branchMap)
-        elif self.applyUncert == "METUnClustDown":
-            isotracks = CollectionRemapped(event, "IsoTrack", replaceMap={"Stop0l":"Stop0l_METUnClustDown"})
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"dPhiMET":"dPhiMET_METUnClustDown"})
-            met       = ObjectRemapped(event,     "MET", replaceMap={"pt":"pt_unclustEnDown", "phi":"phi_unclustEnDown"})
-            stop0l    = ObjectRemapped(event,     "Stop0l", replaceMap=self.branchMap)
-        else:
-            isotracks = Collection(event, "IsoTrack")
-            jets      = Collection(event, "Jet")
-            met       = Object(event,     "MET")
-            stop0l    = Object(event,     "Stop0l")
-
-        caloMET   = Object(event, "CaloMET")
-        flags     = Object(event,     "Flag")
-        electrons = Collection(event, "Electron")
-        muons     = Collection(event, "Muon")
-        isotracks = Collection(event, "IsoTrack")
-        taus      = Collection(event, "Tau")
+    def analyzeVariation(self, uncert, jets, met, stop0l, caloMET, PassEventFilter, nLeptons, PassLLLep):
+        """Evaluate and store the baseline flags of one variation"""
+        suffix = VariationRemap[uncert]["suffix"]
+        jets   = remapView(jets, self.variationJetMap(uncert))
+        met    = remapView(met, VariationRemap[uncert]["MET"])
+        stop0l = remapView(stop0l, self.branchMap[uncert])
+
+        countEle, countMu, countIsk, countTauPOG = nLeptons
 
         ## Baseline Selection
-        PassJetID       = self.PassJetID(jets)
+        flags = {}
+        flags["Pass_EventFilter"] = PassEventFilter
+        flags["LLLep"]            = PassLLLep
+        flags["Pass_JetID"]       = self.PassJetID(jets)
         ## This was an old recommendation in ICHEP16, store this optional bit in case we need it
         ## https://twiki.cern.ch/twiki/bin/viewauth/CMS/SUSRecommendationsICHEP16 
-        PassCaloMETRatio= (met.pt / caloMET.pt ) < 5 if caloMET.pt > 0 else True
-        PassEventFilter = self.PassEventFilter(flags)
+        flags["Pass_CaloMETRatio"]= (met.pt / caloMET.pt ) < 5 if caloMET.pt > 0 else True
+        flags["Pass_ElecVeto"]    = countEle == 0
+        flags["Pass_MuonVeto"]    = countMu == 0
+        flags["Pass_IsoTrkVeto"]  = countIsk == 0
+        flags["Pass_TauVeto"]     = countTauPOG == 0
+
+        variables = dict((var, getattr(stop0l, var)) for var in Stop0lVariables)
+        variables["MET"]     = met.pt
+        variables["nJets30"] = sum([j.Stop0l for j in jets])
+        for name, cuts in VariableCuts.items():
+            flags[name] = passVariableCuts(cuts, variables)
 
-        countEle, countMu, countIsk, countTauPOG = self.calculateNLeptons(electrons, muons, isotracks, taus)
-        PassElecVeto   = countEle == 0
-        PassMuonVeto   = countMu == 0
-        PassIsoTrkVeto = countIsk == 0
-        PassTauVeto    = countTauPOG == 0
-        PassLeptonVeto  = PassElecVeto and PassMuonVeto and PassIsoTrkVeto and PassTauVeto
+        ## In case JEC changed jet pt order, resort jets
+        sortedIdx, sortedPhi = self.GetJetSortedIdx(jets)
+        for name, (cuts, invert) in DPhiCuts.items():
+            flags[name] = self.PassdPhi(sortedPhi, cuts, invertdPhi=invert)
+        for name, (low, high) in DPhiWindows.items():
+            flags[name] = self.PassdPhiVal(sortedPhi, low, high)
+        for name, window in HEMVetoWindows.items():
+            flags[name] = self.PassHEMVeto(jets, *window)
+        combineFlags(flags)
+
+        ### Store output
+        for name, title in OutputFlags:
+            self.out.fillBranch(name + suffix, flags[name])
+        self.out.fillBranch("Jet_nsortedIdx"     + suffix, len(sortedIdx))
+        self.out.fillBranch("Jet_sortedIdx"      + suffix, sortedIdx)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Columnar path ~~~~~
+    def variationJetMap(self, uncert):
+        suffix = VariationRemap[uncert]["suffix"]
+        jetMap = dict(VariationRemap[uncert]["Jet"] or {})
+        if uncert != None:
+            jetMap["dPhiMET"] = "dPhiMET" + suffix
+        if uncert != None and "JES" in uncert:
+            jetMap["Stop0l"]  = "Stop0l" + suffix
+        return jetMap
+
+    def beginColumnar(self, inputFile, wrappedOutputTree):
+        collections = {
+            "Jet"      : ["eta", "phi", "jetId"],
+            "Electron" : ["Stop0l", "MtW"],
+            "Muon"     : ["Stop0l", "MtW"],
+            "IsoTrack" : ["Stop0l"],
+            "Tau"      : ["Stop0l"],
+        }
+        scalars = ["CaloMET_pt"] + ["Flag_" + f for f in self.eventFilters]
+        for uncert in self.variations:
+            jetMap = self.variationJetMap(uncert)
+            for name in [jetMap.get(var, var) for var in ("pt", "Stop0l", "dPhiMET")]:
+                if name not in collections["Jet"]:
+                    collections["Jet"].append(name)
+            for name in [self.variationMET(uncert)] + self.variationStop0l(uncert):
+                if name not in scalars:
+                    scalars.append(name)
+        self.batchReader = BatchReader(self.batchSize, collections, scalars)
+        self.batchReader.beginFile(inputFile, wrappedOutputTree)
+
+        ## The flags of the event filters and of the jets and MET of the input
+        ## file are computed once per batch. The ones of the Stop0l objects and
+        ## variables, filled by the previous modules, for each event.
+        leptons = [coll + "_" + br for coll in ("Electron", "Muon", "IsoTrack", "Tau") for br in collections[coll]]
+        groups = []
+        for uncert in self.variations:
+            suffix = VariationRemap[uncert]["suffix"]
+            jetMap = self.variationJetMap(uncert)
+            jetInputs = ["Jet_eta", "Jet_phi", "Jet_jetId", "Jet_" + jetMap.get("pt", "pt")]
+            inputs  = ["Flag_" + f for f in self.eventFilters] + ["CaloMET_pt", self.variationMET(uncert)] + jetInputs
+            outputs = [name + suffix for name in ColumnarFileFlags]
+            groups.append((inputs, outputs, functools.partial(self.columnsFileFlags, uncert)))
+            inputs  = leptons + self.variationStop0l(uncert) + [self.variationMET(uncert)] + jetInputs + outputs
+            inputs += ["Jet_" + jetMap.get(var, var) for var in ("Stop0l", "dPhiMET")]
+            groups.append((inputs, [], functools.partial(self.columnsFlags, uncert)))
+        self.columnGroups = ColumnGroups(self.batchReader, groups)
+        self.columnGroups.beginFile()
+
+    def variationMET(self, uncert):
+        metMap = VariationRemap[uncert]["MET"] or {}
+        return "MET_" + metMap.get("pt", "pt")
+
+    def variationStop0l(self, uncert):
+        return ["Stop0l_" + self.branchMap[uncert].get(var, var) for var in Stop0lVariables]
+
+    def kthSorted(self, values, parents, rank, nEvents, k):
+        """Value of the k-th sorted jet of each event, and whether it exists"""
+        sel = rank == k
+        kth = np.zeros(nEvents)
+        has = np.zeros(nEvents, dtype=bool)
+        kth[parents[sel]] = values[sel]
+        has[parents[sel]] = True
+        return kth, has
+
+    def columnsFileFlags(self, uncert, batch, outputs, cache):
+        """Flags of the event filters, jet ID, CaloMET ratio and HEM veto"""
+        nEvents = batch.nEvents
+        suffix  = VariationRemap[uncert]["suffix"]
+        jetMap  = self.variationJetMap(uncert)
+        jet_pt  = batch["Jet_" + jetMap.get("pt", "pt")]
+        jet_eta, jet_phi = batch["Jet_eta"], batch["Jet_phi"]
+        met_pt  = batch[self.variationMET(uncert)]
+        caloMET = batch["CaloMET_pt"]
+
+        ## The event filters are the same for all variations
+        if "EventFilter" not in cache:
+            PassEventFilter = np.ones(nEvents, dtype=bool)
+            for f in self.eventFilters:
+                PassEventFilter &= batch["Flag_" + f] != 0
+            cache["EventFilter"] = PassEventFilter
+
+        flags = {}
+        flags["Pass_EventFilter"] = cache["EventFilter"]
+        if self.isFastSim:
+            flags["Pass_JetID"] = np.ones(nEvents, dtype=bool)
+        else:
+            badJet = (jet_pt > 30) & ((batch["Jet_jetId"].astype(np.int64) & 0b010) == 0)
+            flags["Pass_JetID"] = ~segmentAny(badJet, batch.offsets["Jet"])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            flags["Pass_CaloMETRatio"] = np.where(caloMET > 0, (met_pt / caloMET) < 5, True)
+        for name, (etalow, etahigh, philow, phihigh, ptcut) in HEMVetoWindows.items():
+            if self.era == "2016":
+                flags[name] = np.ones(nEvents, dtype=bool)
+                continue
+            inHEM = (jet_eta >= etalow) & (jet_eta <= etahigh) & (jet_phi >= philow) & (jet_phi <= phihigh) & (jet_pt > ptcut)
+            flags[name] = ~segmentAny(inHEM, batch.offsets["Jet"])
+        for name in ColumnarFileFlags:
+            outputs[name + suffix] = (flags[name], None)
+
+    def columnsLeptons(self, batch, cache):
+        """Number of selected leptons and the LLLep flag, from the nominal
+        leptons used for all variations"""
+        if "leptons" not in cache:
+            offsets = batch.offsets
+            nLeptons = {}
+            for coll in ("Electron", "Muon", "IsoTrack", "Tau"):
+                nLeptons[coll] = segmentCount(batch[coll + "_Stop0l"] != 0, offsets[coll])
+            lepMtW = np.zeros(batch.nEvents)
+            for coll in ("Electron", "Muon"):
+                sel = batch[coll + "_Stop0l"] != 0
+                lepMtW = lepMtW + segmentSum(np.where(sel, batch[coll + "_MtW"], 0.), offsets[coll])
+            PassLLLep = ((nLeptons["Electron"] + nLeptons["Muon"]) == 1) & (lepMtW < 100)
+            cache["leptons"] = (nLeptons, PassLLLep)
+        return cache["leptons"]
+
+    def columnsFlags(self, uncert, batch, outputs, cache):
+        """Columnar version of analyzeVariation(), from the flags of
+        columnsFileFlags()"""
+        nEvents = batch.nEvents
+        offsets = batch.offsets
+        suffix  = VariationRemap[uncert]["suffix"]
+        jetMap  = self.variationJetMap(uncert)
+        jet_pt  = batch["Jet_" + jetMap.get("pt", "pt")]
+        jet_eta = batch["Jet_eta"]
+        met_pt  = batch[self.variationMET(uncert)]
+        jetParents = batch.parents("Jet")
+        nLeptons, PassLLLep = self.columnsLeptons(batch, cache)
+
+        flags = dict((name, outputs[name + suffix][0]) for name in ColumnarFileFlags)
+        flags["LLLep"]            = PassLLLep
+        flags["Pass_ElecVeto"]    = nLeptons["Electron"] == 0
+        flags["Pass_MuonVeto"]    = nLeptons["Muon"] == 0
+        flags["Pass_IsoTrkVeto"]  = nLeptons["IsoTrack"] == 0
+        flags["Pass_TauVeto"]     = nLeptons["Tau"] == 0
+
+        variables = dict((var, batch[name]) for var, name in zip(Stop0lVariables, self.variationStop0l(uncert)))
+        variables["MET"]     = met_pt
+        variables["nJets30"] = segmentCount(batch["Jet_" + jetMap.get("Stop0l", "Stop0l")] != 0, offsets["Jet"])
+        for name, cuts in VariableCuts.items():
+            flags[name] = passVariableCuts(cuts, variables)
+
+        ## Jets sorted by decreasing pt then increasing |eta|, as GetJetSortedIdx
+        goodjet = ~((np.fabs(jet_eta) > 4.7) | (jet_pt < 30))
+        idx     = np.flatnonzero(goodjet)
+        order   = np.lexsort((np.fabs(jet_eta[idx]), -jet_pt[idx], jetParents[idx]))
+        sortedParents = jetParents[idx][order]
+        sortedIdx     = segmentRank(goodjet, offsets["Jet"])[idx][order]
+        sortedPhi     = batch["Jet_" + jetMap.get("dPhiMET", "dPhiMET")][idx][order]
+        sortedOffsets = offsetsFromCounts(segmentCount(goodjet, offsets["Jet"]))
+        rank = localIndex(sortedOffsets)
+
+        for name, (cuts, invert) in DPhiCuts.items():
+            passed = np.zeros(nEvents, dtype=bool) if invert else np.ones(nEvents, dtype=bool)
+            for k, cut in enumerate(cuts):
+                kth, has = self.kthSorted(sortedPhi, sortedParents, rank, nEvents, k)
+                if invert:
+                    passed |= has & (kth < cut)
+                else:
+                    passed &= ~has | (kth > cut)
+            flags[name] = passed
+        for name, (low, high) in DPhiWindows.items():
+            passed = np.ones(nEvents, dtype=bool)
+            for k in xrange(min(len(low), len(high))):
+                kth, has = self.kthSorted(sortedPhi, sortedParents, rank, nEvents, k)
+                passed &= ~has | ((low[k] < kth) & (kth < high[k]))
+            flags[name] = passed
+        combineFlags(flags)
+
+        for name, title in OutputFlags:
+            if name not in ColumnarFileFlags:
+                outputs[name + suffix] = (flags[name], None)
+        outputs["Jet_nsortedIdx" + suffix] = (np.diff(sortedOffsets), None)
+        outputs["Jet_sortedIdx"  + suffix] = (sortedIdx, "Jet_sortedIdx" + suffix)
+        offsets["Jet_sortedIdx"  + suffix] = sortedOffsets
+
+    def analyze(self, event):
+        """process event, return True (go to next module) or False (fail, go to next event)"""
+        if self.batchSize > 0:
+            self.columnGroups.fill(self.out, event)
+            return True
+
+        ## Getting objects, read once and shared by all the variations
+        jets      = cachedCollection(event, "Jet")
+        met       = cachedObject(event,     "MET")
+        stop0l    = cachedObject(event,     "Stop0l")
+        caloMET   = cachedObject(event, "CaloMET")
+        flags     = cachedObject(event,     "Flag")
+        electrons = cachedCollection(event, "Electron")
+        muons     = cachedCollection(event, "Muon")
+        isotracks = cachedCollection(event, "IsoTrack")
+        taus      = cachedCollection(event, "Tau")
+
+        ## Variation independent selections, the nominal leptons are used for all variations
+        PassEventFilter = self.PassEventFilter(flags)
+        nLeptons = self.calculateNLeptons(electrons, muons, isotracks, taus)
 
-        totlep = countEle + countMu
+        totlep = nLeptons[0] + nLeptons[1]
         PassLLLep = (totlep == 1) and sum([ e.MtW for e in electrons if e.Stop0l ] + 
                                           [ m.MtW for m in muons if m.Stop0l ]) < 100
 
-        PassNjets       = self.PassNjets(jets)
-        PassMET         = met.pt >= 250
-        PassHT          = stop0l.HT >= 300
-        ## In case JEC changed jet pt order, resort jets
-        sortedIdx, sortedPhi = self.GetJetSortedIdx(jets)
-        PassdPhiLowDM   = self.PassdPhi(sortedPhi, [0.5, 0.15, 0.15])
-
-        PassdPhiMedDM   = self.PassdPhiVal(sortedPhi, [0.15, 0.15, 0.15], [0.5, 4., 4.]) #Variable for LowDM Validation bins
-
-        PassdPhiHighDM  = self.PassdPhi(sortedPhi, [0.5, 0.5, 0.5, 0.5])
-        PassdPhiQCD     = self.PassdPhi(sortedPhi, [0.1, 0.1, 0.1], invertdPhi =True)
-
-        PassBaseline    = PassEventFilter and PassJetID and PassLeptonVeto and PassNjets and PassMET and PassHT and PassdPhiLowDM
-        PasshighDM      = PassBaseline and stop0l.nJets >= 5 and PassdPhiHighDM and stop0l.nbtags >= 1
-        PasslowDM       = PassBaseline and stop0l.nTop == 0 and stop0l.nW == 0 and stop0l.nResolved == 0 and \
-                stop0l.Mtb < 175 and stop0l.ISRJetPt >= 200 and stop0l.METSig > 10
-        PassQCDCR       = PassEventFilter and PassJetID and PassLeptonVeto and PassNjets and PassMET and PassHT and PassdPhiQCD
-        PassQCD_highDM  = PassQCDCR and stop0l.nJets >= 5 and stop0l.nbtags >= 1
-        PassQCD_lowDM   = PassQCDCR and stop0l.nTop == 0 and stop0l.nW == 0 and stop0l.nResolved == 0 and \
-                stop0l.Mtb < 175 and stop0l.ISRJetPt >= 200 and stop0l.METSig > 10
-
-        PassLLCR       = PassEventFilter and PassJetID and PassLLLep and PassNjets and PassMET and PassHT and PassdPhiLowDM
-        PassLL_highDM  = PassLLCR and stop0l.nJets >= 5 and PassdPhiHighDM and stop0l.nbtags >= 1
-        PassLL_lowDM   = PassLLCR and stop0l.nTop == 0 and stop0l.nW == 0 and stop0l.nResolved == 0 and \
-                stop0l.Mtb < 175 and stop0l.ISRJetPt >= 200 and stop0l.METSig > 10
-
-        PassHEMVeto20   = self.PassHEMVeto(jets, -3, -1.4, -1.57, -0.87, 20)
-        PassHEMVeto30   = self.PassHEMVeto(jets, -3, -1.4, -1.57, -0.87, 30)
-        PassexHEMVeto20 = self.PassHEMVeto(jets, -3.2, -1.2, -1.77, -0.67, 20)
-        PassexHEMVeto30 = self.PassHEMVeto(jets, -3.2, -1.2, -1.77, -0.67, 30)
-        ### Store output
-        #self.out.fillBranch("Pass_LeptonTauVeto", PassLeptonTauVeto)
-        self.out.fillBranch("Pass_JetID"         + self.suffix, PassJetID)
-        self.out.fillBranch("Pass_CaloMETRatio"  + self.suffix, PassCaloMETRatio)
-        self.out.fillBranch("Pass_EventFilter"   + self.suffix, PassEventFilter)
-        self.out.fillBranch("Pass_ElecVeto"      + self.suffix, PassElecVeto)
-        self.out.fillBranch("Pass_MuonVeto"      + self.suffix, PassMuonVeto)
-        self.out.fillBranch("Pass_IsoTrkVeto"    + self.suffix, PassIsoTrkVeto)
-        self.out.fillBranch("Pass_TauVeto"       + self.suffix, PassTauVeto)
-        self.out.fillBranch("Pass_LeptonVeto"    + self.suffix, PassLeptonVeto)
-        self.out.fillBranch("Pass_NJets30"       + self.suffix, PassNjets)
-        self.out.fillBranch("Pass_MET"           + self.suffix, PassMET)
-        self.out.fillBranch("Pass_HT"            + self.suffix, PassHT)
-        self.out.fillBranch("Pass_dPhiMET"       + self.suffix, PassdPhiLowDM)
-        self.out.fillBranch("Pass_dPhiMETLowDM"  + self.suffix, PassdPhiLowDM)
-        self.out.fillBranch("Pass_dPhiMETMedDM"  + self.suffix, PassdPhiMedDM)
-        self.out.fillBranch("Pass_dPhiMETHighDM" + self.suffix, PassdPhiHighDM)
-        self.out.fillBranch("Pass_Baseline"      + self.suffix, PassBaseline)
-        self.out.fillBranch("Pass_highDM"        + self.suffix, PasshighDM)
-        self.out.fillBranch("Pass_lowDM"         + self.suffix, PasslowDM)
-        self.out.fillBranch("Pass_QCDCR"         + self.suffix, PassQCDCR)
-        self.out.fillBranch("Pass_QCDCR_highDM"  + self.suffix, PassQCD_highDM)
-        self.out.fillBranch("Pass_QCDCR_lowDM"   + self.suffix, PassQCD_lowDM)
-        self.out.fillBranch("Pass_LLCR"          + self.suffix, PassLLCR)
-        self.out.fillBranch("Pass_LLCR_highDM"   + self.suffix, PassLL_highDM)
-        self.out.fillBranch("Pass_LLCR_lowDM"    + self.suffix, PassLL_lowDM)
-        # self.out.fillBranch("Pass_HEMVeto20"     + self.suffix, PassHEMVeto20)
-        # self.out.fillBranch("Pass_HEMVeto30"     + self.suffix, PassHEMVeto30)
-        self.out.fillBranch("Pass_exHEMVeto20"   + self.suffix, PassexHEMVeto20)
-        self.out.fillBranch("Pass_exHEMVeto30"   + self.suffix, PassexHEMVeto30)
-        self.out.fillBranch("Jet_nsortedIdx"     + self.suffix, len(sortedIdx))
-        self.out.fillBranch("Jet_sortedIdx"      + self.suffix, sortedIdx)
+        for uncert in self.variations:
+            self.analyzeVariation(uncert, jets, met, stop0l, caloMET, PassEventFilter, nLeptons, PassLLLep)
         return True
 
 
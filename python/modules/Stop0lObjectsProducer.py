@@ -1,13 +1,17 @@
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 import math
+import functools
 import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaR
 
-from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped, CollectionRemapped
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, parseVariations, remapView, cachedCollection, cachedObject
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import BatchReader, ColumnGroups, \
+        pairIndices, segmentRank, segmentCount, segmentSum, deltaPhi, calMtW, offsetsFromCounts
 
 #2016 MC: https://twiki.cern.ch/twiki/bin/viewauth/CMS/BtagRecommendation2016Legacy
 #2017 MC: https://twiki.cern.ch/twiki/bin/view/CMS/BtagRecommendation94X
@@ -30,23 +34,36 @@ CSVv2MediumWP = {
     "2018" : 0.8838  # Not recommended, use 2017 as temp
 }
 
+## Branches read by the columnar path
+ColumnarInputs = {
+    "Electron" : ["pt", "eta", "phi", "cutBasedNoIso", "miniPFRelIso_all"],
+    "Muon"     : ["pt", "eta", "phi", "miniPFRelIso_all"],
+    "IsoTrack" : ["pt", "phi", "pdgId", "pfRelIso03_chg"],
+    "Tau"      : ["pt", "eta", "phi", "idDecayMode", "idMVAoldDM2017v2"],
+    "Jet"      : ["pt", "eta", "phi", "btagDeepB"],
+    "SB"       : ["eta", "phi", "ntracks", "dxy", "dlenSig", "DdotP"],
+    "Photon"   : ["eta"],
+}
+
 class Stop0lObjectsProducer(Module):
-    def __init__(self, era, applyUncert = None):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Electron", "Muon", "IsoTrack", "Tau", "Jet", "SB", "Photon") + ["MET_*"]
+
+    def __init__(self, era, applyUncert = None, batchSize = 0):
         self.era = era
         self.metBranchName = "MET"
 
-        self.applyUncert = applyUncert
-
-        self.suffix = ""
+        ## With batchSize > 0 the columnar path is used: the inputs of batchSize
+        ## entries are read at once as jagged arrays and the outputs are
+        ## computed with array operations, see beginColumnar. analyze() stays
+        ## the reference.
+        self.batchSize = batchSize
 
-        if self.applyUncert == "JESUp":
-            self.suffix = "_JESUp"
-        elif self.applyUncert == "METUnClustUp":
-            self.suffix = "_METUnClustUp"
-        elif self.applyUncert == "JESDown":
-            self.suffix = "_JESDown"
-        elif self.applyUncert == "METUnClustDown":
-            self.suffix = "_METUnClustDown"
+        ## applyUncert is either a single variation, or a list of variations
+        ## (e.g. ["nominal", "JESUp", "JESDown"]) evaluated together in one pass,
+        ## sharing the collections and the variation independent selections
+        self.applyUncert = applyUncert
+        self.variations = parseVariations(applyUncert)
 
     def beginJob(self):
         pass
@@ -56,35 +73,42 @@ class Stop0lObjectsProducer(Module):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
 
-        if self.applyUncert == None:
-            self.out.branch("Electron_Stop0l" + self.suffix, "O", lenVar="nElectron", title="cutBased Veto ID with miniISO < 0.1, pT > 5")
-            self.out.branch("Muon_Stop0l"     + self.suffix, "O", lenVar="nMuon")
-            self.out.branch("Tau_Stop0l"      + self.suffix, "O", lenVar="nTau")
-            self.out.branch("Photon_Stop0l"   + self.suffix, "O", lenVar="nPhoton")
-            self.out.branch("SB_Stop0l"       + self.suffix, "O", lenVar="nSB")
-            self.out.branch("Photon_Stop0l"   + self.suffix, "O", lenVar="nPhoton")
-            self.out.branch("Stop0l_nSoftb"   + self.suffix, "I")
-        
-        if self.applyUncert == None or "JES" in self.applyUncert or "METUnClust" in self.applyUncert:
-            self.out.branch("Electron_MtW"    + self.suffix, "F", lenVar="nElectron")
-            self.out.branch("Muon_MtW"        + self.suffix, "F", lenVar="nMuon")
-            self.out.branch("IsoTrack_MtW"    + self.suffix, "F", lenVar="nIsoTrack")
-            self.out.branch("Tau_MtW"	      + self.suffix, "F", lenVar="nTau")
-            self.out.branch("Jet_dPhiMET"     + self.suffix, "F", lenVar="nJet")
-            self.out.branch("IsoTrack_Stop0l" + self.suffix, "O", lenVar="nIsoTrack")
-            self.out.branch("Stop0l_Mtb"      + self.suffix, "F")
-            self.out.branch("Stop0l_METSig"   + self.suffix, "F")
-
-        if self.applyUncert == None or "JES" in self.applyUncert:
-            self.out.branch("Jet_Stop0l" + self.suffix,      "O", lenVar="nJet")
-            self.out.branch("Jet_btagStop0l" + self.suffix,  "O", lenVar="nJet")
-            self.out.branch("Stop0l_HT" + self.suffix,       "F")
-            self.out.branch("Stop0l_Ptb" + self.suffix,      "F")
-            self.out.branch("Stop0l_nJets" + self.suffix,    "I")
-            self.out.branch("Stop0l_nbtags" + self.suffix,   "I")
+        if self.batchSize > 0:
+            self.beginColumnar(inputFile, wrappedOutputTree)
+
+        for uncert in self.variations:
+            suffix = VariationRemap[uncert]["suffix"]
+
+            if uncert == None:
+                self.out.branch("Electron_Stop0l" + suffix, "O", lenVar="nElectron", title="cutBased Veto ID with miniISO < 0.1, pT > 5")
+                self.out.branch("Muon_Stop0l"     + suffix, "O", lenVar="nMuon")
+                self.out.branch("Tau_Stop0l"      + suffix, "O", lenVar="nTau")
+                self.out.branch("Photon_Stop0l"   + suffix, "O", lenVar="nPhoton")
+                self.out.branch("SB_Stop0l"       + suffix, "O", lenVar="nSB")
+                self.out.branch("Photon_Stop0l"   + suffix, "O", lenVar="nPhoton")
+                self.out.branch("Stop0l_nSoftb"   + suffix, "I")
+
+            if uncert == None or "JES" in uncert or "METUnClust" in uncert:
+                self.out.branch("Electron_MtW"    + suffix, "F", lenVar="nElectron")
+                self.out.branch("Muon_MtW"        + suffix, "F", lenVar="nMuon")
+                self.out.branch("IsoTrack_MtW"    + suffix, "F", lenVar="nIsoTrack")
+                self.out.branch("Tau_MtW"         + suffix, "F", lenVar="nTau")
+                self.out.branch("Jet_dPhiMET"     + suffix, "F", lenVar="nJet")
+                self.out.branch("IsoTrack_Stop0l" + suffix, "O", lenVar="nIsoTrack")
+                self.out.branch("Stop0l_Mtb"      + suffix, "F")
+                self.out.branch("Stop0l_METSig"   + suffix, "F")
+
+            if uncert == None or "JES" in uncert:
+                self.out.branch("Jet_Stop0l" + suffix,      "O", lenVar="nJet")
+                self.out.branch("Jet_btagStop0l" + suffix,  "O", lenVar="nJet")
+                self.out.branch("Stop0l_HT" + suffix,       "F")
+                self.out.branch("Stop0l_Ptb" + suffix,      "F")
+                self.out.branch("Stop0l_nJets" + suffix,    "I")
+                self.out.branch("Stop0l_nbtags" + suffix,   "I")
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        pass
+        if self.batchSize > 0:
+            self.batchReader.endFile()
 
 
     def SelEle(self, ele):
@@ -196,84 +220,247 @@ class Stop0lObjectsProducer(Module):
             Mtb = 0
         return Mtb, Ptb
 
-    def analyze(self, event):
-        """process event, return True (go to next module) or False (fail, go to next event)"""
-        ## Getting objects
-        electrons = Collection(event, "Electron")
-        muons     = Collection(event, "Muon")
-        isotracks = Collection(event, "IsoTrack")
-        taus	  = Collection(event, "Tau")
-
-        if self.applyUncert == "JESUp":
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalUp", "mass":"mass_jesTotalUp"})
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"})
-        elif self.applyUncert == "JESDown":
-            jets      = CollectionRemapped(event, "Jet", replaceMap={"pt":"pt_jesTotalDown", "mass":"mass_jesTotalDown"})
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"})
-        elif self.applyUncert == "METUnClustUp":
-            jets      = Collection(event, "Jet")
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnUp", "phi":"phi_unclustEnUp"})
-        elif self.applyUncert == "METUnClustDown":
-            jets      = Collection(event, "Jet")
-            met       = ObjectRemapped(event, self.metBranchName, replaceMap={"pt":"pt_unclustEnDown", "phi":"phi_unclustEnDown"})
-        else:
-            jets      = Collection(event, "Jet")
-            met       = Object(event, self.metBranchName)
-
-        isvs    = Collection(event, "SB")
-        photons = Collection(event, "Photon")
-        flags   = Object(event,     "Flag")
-       
-        ## Selecting objects
-        self.Electron_Stop0l = map(self.SelEle, electrons)
-        self.Muon_Stop0l     = map(self.SelMuon, muons)
-        self.Tau_Stop0l      = map(lambda x : self.SelTauPOG(x, met), taus)
+    def analyzeVariation(self, uncert, electrons, muons, isotracks, taus, jets, jet_phi, met, jetCache):
+        """Compute and store the pt/mass/MET dependent quantities of one variation"""
+        suffix = VariationRemap[uncert]["suffix"]
+        jetMap = VariationRemap[uncert]["Jet"]
+        met    = remapView(met, VariationRemap[uncert]["MET"])
+
+        ## Jet selections only depend on the jet variation, shared by the MET ones
+        jetKey = jetMap["pt"] if jetMap else "pt"
+        if jetKey not in jetCache:
+            vjets = remapView(jets, jetMap)
+            self.Jet_Stop0l  = map(self.SelJets, vjets)
+            self.BJet_Stop0l = map(self.SelBtagJets, vjets)
+            ## TODO: Need to improve speed
+            jetCache[jetKey] = (vjets, self.Jet_Stop0l, self.BJet_Stop0l, self.CalHT(vjets))
+        jets, self.Jet_Stop0l, self.BJet_Stop0l, HT = jetCache[jetKey]
+
         self.Electron_MtW    = map(lambda x : self.CalMtW(x, met), electrons)
         self.Muon_MtW        = map(lambda x : self.CalMtW(x, met), muons)
         self.IsoTrack_MtW    = map(lambda x : self.CalMtW(x, met), isotracks)
         self.IsoTrack_Stop0l = map(lambda x : self.SelIsotrack(x, met), isotracks)
-        self.Tau_MtW	     = map(lambda x : self.CalMtW(x, met), taus)
-        self.Jet_Stop0l      = map(self.SelJets, jets)
-        self.BJet_Stop0l     = map(self.SelBtagJets, jets)
-        self.SB_Stop0l       = map(lambda x : self.SelSoftb(x, jets), isvs)
-        self.Photon_Stop0l   = map(self.SelPhotons, photons)
+        self.Tau_MtW         = map(lambda x : self.CalMtW(x, met), taus)
 
         ## Jet variables
-        jet_phi = np.asarray([jet.phi for jet in jets])
         Jet_dPhi = jet_phi - met.phi
         np.subtract(Jet_dPhi, 2*math.pi, out = Jet_dPhi, where= (Jet_dPhi >=math.pi))
         np.add(Jet_dPhi, 2*math.pi,  out =Jet_dPhi , where=(Jet_dPhi < -1*math.pi))
         np.fabs(Jet_dPhi, out=Jet_dPhi)
-        ## TODO: Need to improve speed
-        HT = self.CalHT(jets)
         Mtb, Ptb = self.CalMTbPTb(jets, met)
 
         ### Store output
-        if self.applyUncert == None:
-            self.out.fillBranch("Stop0l_nSoftb" + self.suffix,   sum(self.SB_Stop0l))
-            self.out.fillBranch("Electron_Stop0l" + self.suffix, self.Electron_Stop0l)
-            self.out.fillBranch("Muon_Stop0l" + self.suffix,     self.Muon_Stop0l)
-            self.out.fillBranch("Tau_Stop0l" + self.suffix,	 self.Tau_Stop0l)
-            self.out.fillBranch("SB_Stop0l" + self.suffix,       self.SB_Stop0l)
-            self.out.fillBranch("Photon_Stop0l" + self.suffix,   self.Photon_Stop0l)
-
-        if self.applyUncert == None or "JES" in self.applyUncert or "METUnClust" in self.applyUncert:
-            self.out.fillBranch("IsoTrack_Stop0l" + self.suffix, self.IsoTrack_Stop0l)
-            self.out.fillBranch("Electron_MtW" + self.suffix   , self.Electron_MtW)
-            self.out.fillBranch("Muon_MtW" + self.suffix       , self.Muon_MtW)
-            self.out.fillBranch("IsoTrack_MtW" + self.suffix   , self.IsoTrack_MtW)
-            self.out.fillBranch("Tau_MtW" + self.suffix	       , self.Tau_MtW)
-            self.out.fillBranch("Jet_dPhiMET" + self.suffix    , Jet_dPhi)
-            self.out.fillBranch("Stop0l_Mtb" + self.suffix     , Mtb)
-            self.out.fillBranch("Stop0l_METSig" + self.suffix  , met.pt / math.sqrt(HT) if HT > 0 else 0)
-
-        if self.applyUncert == None or "JES" in self.applyUncert:
-            self.out.fillBranch("Jet_btagStop0l" + self.suffix,  self.BJet_Stop0l)
-            self.out.fillBranch("Jet_Stop0l" + self.suffix,      self.Jet_Stop0l)
-            self.out.fillBranch("Stop0l_HT" + self.suffix,       HT)
-            self.out.fillBranch("Stop0l_Ptb" + self.suffix,      Ptb)
-            self.out.fillBranch("Stop0l_nJets" + self.suffix,    sum(self.Jet_Stop0l))
-            self.out.fillBranch("Stop0l_nbtags" + self.suffix,   sum(self.BJet_Stop0l))
+        if uncert == None or "JES" in uncert or "METUnClust" in uncert:
+            self.out.fillBranch("IsoTrack_Stop0l" + suffix, self.IsoTrack_Stop0l)
+            self.out.fillBranch("Electron_MtW" + suffix   , self.Electron_MtW)
+            self.out.fillBranch("Muon_MtW" + suffix       , self.Muon_MtW)
+            self.out.fillBranch("IsoTrack_MtW" + suffix   , self.IsoTrack_MtW)
+            self.out.fillBranch("Tau_MtW" + suffix        , self.Tau_MtW)
+            self.out.fillBranch("Jet_dPhiMET" + suffix    , Jet_dPhi)
+            self.out.fillBranch("Stop0l_Mtb" + suffix     , Mtb)
+            self.out.fillBranch("Stop0l_METSig" + suffix  , met.pt / math.sqrt(HT) if HT > 0 else 0)
+
+        if uncert == None or "JES" in uncert:
+            self.out.fillBranch("Jet_btagStop0l" + suffix,  self.BJet_Stop0l)
+            self.out.fillBranch("Jet_Stop0l" + suffix,      self.Jet_Stop0l)
+            self.out.fillBranch("Stop0l_HT" + suffix,       HT)
+            self.out.fillBranch("Stop0l_Ptb" + suffix,      Ptb)
+            self.out.fillBranch("Stop0l_nJets" + suffix,    sum(self.Jet_Stop0l))
+            self.out.fillBranch("Stop0l_nbtags" + suffix,   sum(self.BJet_Stop0l))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Columnar path ~~~~~
+    def variationMET(self, uncert):
+        metMap = VariationRemap[uncert]["MET"] or {}
+        return [self.metBranchName + "_" + metMap.get(var, var) for var in ("pt", "phi")]
+
+    def variationJetPt(self, uncert):
+        jetMap = VariationRemap[uncert]["Jet"]
+        return jetMap["pt"] if jetMap else "pt"
+
+    def beginColumnar(self, inputFile, wrappedOutputTree):
+        collections = dict((k, list(v)) for k, v in ColumnarInputs.items())
+        photonID = "cutBased" if self.era == "2016" else "cutBasedBitmap"
+        collections["Photon"].append(photonID)
+        scalars = []
+        for uncert in self.variations:
+            if self.variationJetPt(uncert) not in collections["Jet"]:
+                collections["Jet"].append(self.variationJetPt(uncert))
+            for name in self.variationMET(uncert):
+                if name not in scalars:
+                    scalars.append(name)
+        self.batchReader = BatchReader(self.batchSize, collections, scalars)
+        self.batchReader.beginFile(inputFile, wrappedOutputTree)
+
+        ## The groups reading a branch filled by a previous module (the electron
+        ## ID, the JES and MET variations, recalibrated jets...) are computed
+        ## for each event, the others once per batch
+        groups = []
+        if None in self.variations:
+            groups += [
+                (["Electron_pt", "Electron_eta", "Electron_cutBasedNoIso", "Electron_miniPFRelIso_all"], ["Electron_Stop0l"], self.columnsElectron),
+                (["Muon_pt", "Muon_eta", "Muon_miniPFRelIso_all"], ["Muon_Stop0l"], self.columnsMuon),
+                (["Tau_" + br for br in ColumnarInputs["Tau"]] + self.variationMET(None), ["Tau_Stop0l"], self.columnsTau),
+                (["Jet_pt", "Jet_eta", "Jet_phi"] + ["SB_" + br for br in ColumnarInputs["SB"]], ["SB_Stop0l", "Stop0l_nSoftb"], self.columnsSoftb),
+                (["Photon_eta", "Photon_" + photonID], ["Photon_Stop0l"], self.columnsPhoton),
+            ]
+        for uncert in self.variations:
+            inputs  = self.variationMET(uncert) + ["Jet_" + self.variationJetPt(uncert), "Jet_eta", "Jet_phi", "Jet_btagDeepB"]
+            inputs += [coll + "_" + br for coll in ("Electron", "Muon", "IsoTrack", "Tau") for br in ("pt", "phi")]
+            inputs += ["IsoTrack_pdgId", "IsoTrack_pfRelIso03_chg"]
+            groups.append((inputs, [], functools.partial(self.columnsVariation, uncert)))
+        self.columnGroups = ColumnGroups(self.batchReader, groups)
+        self.columnGroups.beginFile()
+
+    def columnsElectron(self, batch, outputs, cache):
+        pt, eta = batch["Electron_pt"], batch["Electron_eta"]
+        sel = ~((np.fabs(eta) > 2.5) | (pt < 5))
+        sel &= ~(batch["Electron_cutBasedNoIso"] < 1)
+        sel &= ~(batch["Electron_miniPFRelIso_all"] > 0.1)
+        outputs["Electron_Stop0l"] = (sel, "Electron")
+
+    def columnsMuon(self, batch, outputs, cache):
+        pt, eta = batch["Muon_pt"], batch["Muon_eta"]
+        sel = ~((np.fabs(eta) > 2.4) | (pt < 5))
+        sel &= ~(batch["Muon_miniPFRelIso_all"] > 0.2)
+        outputs["Muon_Stop0l"] = (sel, "Muon")
+
+    def columnsTau(self, batch, outputs, cache):
+        met_pt, met_phi = [batch[name] for name in self.variationMET(None)]
+        parents = batch.parents("Tau")
+        pt, eta, phi = batch["Tau_pt"], batch["Tau_eta"], batch["Tau_phi"]
+        sel = ~((pt < 20) | (np.fabs(eta) > 2.4) | (batch["Tau_idDecayMode"] == 0) |
+                ((batch["Tau_idMVAoldDM2017v2"].astype(np.int64) & 8) == 0))
+        sel &= ~(calMtW(met_pt[parents], met_phi[parents], pt, phi) > 100)
+        outputs["Tau_Stop0l"] = (sel, "Tau")
+
+    def columnsSoftb(self, batch, outputs, cache):
+        ## SV not associated with selected jets
+        offsets = batch.offsets
+        goodjet = (batch["Jet_pt"] >= 20) & (np.fabs(batch["Jet_eta"]) <= 2.4)
+        isv, ijet = pairIndices(offsets["SB"], offsets["Jet"])
+        ## Same operations as tools.deltaR, np.hypot can round differently at dR = 0.4
+        deta = batch["Jet_eta"][ijet] - batch["SB_eta"][isv]
+        dphi = deltaPhi(batch["Jet_phi"][ijet], batch["SB_phi"][isv])
+        dR = np.sqrt(deta*deta + dphi*dphi)
+        overlap = np.bincount(isv[goodjet[ijet] & (dR <= 0.4)], minlength=len(batch["SB_eta"])) > 0
+        sel = ~overlap
+        sel &= ~((batch["SB_ntracks"] < 3) | (np.fabs(batch["SB_dxy"]) > 3.) | (batch["SB_dlenSig"] < 4))
+        sel &= ~(batch["SB_DdotP"] < 0.98)
+        outputs["SB_Stop0l"] = (sel, "SB")
+        outputs["Stop0l_nSoftb"] = (segmentCount(sel, offsets["SB"]), None)
+
+    def columnsPhoton(self, batch, outputs, cache):
+        abeta = np.fabs(batch["Photon_eta"])
+        sel = ~(((abeta > 1.4442) & (abeta < 1.5660)) | (abeta > 2.5))
+        if self.era == "2016":
+            sel &= batch["Photon_cutBased"] > 1
+        else:
+            sel &= (batch["Photon_cutBasedBitmap"].astype(np.int64) & 2) != 0
+        outputs["Photon_Stop0l"] = (sel, "Photon")
+
+    def columnsVariation(self, uncert, batch, outputs, cache):
+        """Columnar version of analyzeVariation()"""
+        suffix  = VariationRemap[uncert]["suffix"]
+        offsets = batch.offsets
+        parents = dict((coll, batch.parents(coll)) for coll in ("Electron", "Muon", "IsoTrack", "Tau", "Jet"))
+        met_pt, met_phi = [batch[name] for name in self.variationMET(uncert)]
+
+        ## Jet selections only depend on the jet variation, shared by the MET ones
+        jetKey = self.variationJetPt(uncert)
+        jet_pt, jet_eta, jet_phi = batch["Jet_" + jetKey], batch["Jet_eta"], batch["Jet_phi"]
+        if jetKey not in cache:
+            jetSel  = ~((jet_pt < 30) | (np.fabs(jet_eta) > 2.4))
+            bjetSel = ~((jet_pt < 20) | (np.fabs(jet_eta) > 2.4)) & (batch["Jet_btagDeepB"] >= DeepCSVMediumWP[self.era])
+            HT  = segmentSum(np.where(jetSel, jet_pt, 0.), offsets["Jet"])
+            ## Leading two b jets in pt
+            Ptb = segmentSum(np.where(bjetSel & (segmentRank(bjetSel, offsets["Jet"]) < 2), jet_pt, 0.), offsets["Jet"])
+            cache[jetKey] = (jetSel, bjetSel, HT, Ptb)
+        jetSel, bjetSel, HT, Ptb = cache[jetKey]
+
+        mtw = {}
+        for coll in ("Electron", "Muon", "IsoTrack", "Tau"):
+            mtw[coll] = calMtW(met_pt[parents[coll]], met_phi[parents[coll]], batch[coll + "_pt"], batch[coll + "_phi"])
+
+        pt, iso = batch["IsoTrack_pt"], batch["IsoTrack_pfRelIso03_chg"]
+        pdgId = np.fabs(batch["IsoTrack_pdgId"])
+        reject = ((pdgId == 11) | (pdgId == 13)) & ((pt < 5) | (iso > 0.2))
+        reject |= (pdgId == 211) & ((pt < 10) | (iso > 0.1))
+        reject |= mtw["IsoTrack"] > 100
+        isoTrackSel = ~reject
+
+        Jet_dPhi = jet_phi - met_phi[parents["Jet"]]
+        np.subtract(Jet_dPhi, 2*math.pi, out = Jet_dPhi, where= (Jet_dPhi >=math.pi))
+        np.add(Jet_dPhi, 2*math.pi,  out =Jet_dPhi , where=(Jet_dPhi < -1*math.pi))
+        np.fabs(Jet_dPhi, out=Jet_dPhi)
+
+        ## Mtb of the two leading b jets in b discriminator, ties kept in pt order
+        ibjet = np.nonzero(bjetSel)[0]
+        order = np.lexsort((ibjet, -batch["Jet_btagDeepB"][ibjet], parents["Jet"][ibjet]))
+        ibjet = ibjet[order]
+        bparents = parents["Jet"][ibjet]
+        rank = np.arange(len(ibjet)) - offsetsFromCounts(np.bincount(bparents, minlength=batch.nEvents))[bparents]
+        ibjet, bparents = ibjet[rank < 2], bparents[rank < 2]
+        Mtb = np.full(batch.nEvents, np.inf)
+        np.minimum.at(Mtb, bparents, calMtW(met_pt[bparents], met_phi[bparents], jet_pt[ibjet], jet_phi[ibjet]))
+        Mtb[Mtb == np.inf] = 0
+
+        METSig = np.zeros(batch.nEvents)
+        np.divide(met_pt, np.sqrt(HT), out=METSig, where=HT > 0)
+
+        if uncert == None or "JES" in uncert or "METUnClust" in uncert:
+            outputs["IsoTrack_Stop0l" + suffix] = (isoTrackSel, "IsoTrack")
+            outputs["Electron_MtW" + suffix]    = (mtw["Electron"], "Electron")
+            outputs["Muon_MtW" + suffix]        = (mtw["Muon"], "Muon")
+            outputs["IsoTrack_MtW" + suffix]    = (mtw["IsoTrack"], "IsoTrack")
+            outputs["Tau_MtW" + suffix]         = (mtw["Tau"], "Tau")
+            outputs["Jet_dPhiMET" + suffix]     = (Jet_dPhi, "Jet")
+            outputs["Stop0l_Mtb" + suffix]      = (Mtb, None)
+            outputs["Stop0l_METSig" + suffix]   = (METSig, None)
+
+        if uncert == None or "JES" in uncert:
+            outputs["Jet_btagStop0l" + suffix]  = (bjetSel, "Jet")
+            outputs["Jet_Stop0l" + suffix]      = (jetSel, "Jet")
+            outputs["Stop0l_HT" + suffix]       = (HT, None)
+            outputs["Stop0l_Ptb" + suffix]      = (Ptb, None)
+            outputs["Stop0l_nJets" + suffix]    = (segmentCount(jetSel, offsets["Jet"]), None)
+            outputs["Stop0l_nbtags" + suffix]   = (segmentCount(bjetSel, offsets["Jet"]), None)
+
+    def analyze(self, event):
+        """process event, return True (go to next module) or False (fail, go to next event)"""
+        if self.batchSize > 0:
+            self.columnGroups.fill(self.out, event)
+            return True
+
+        ## Getting objects, read once and shared by all the variations
+        electrons = cachedCollection(event, "Electron")
+        muons     = cachedCollection(event, "Muon")
+        isotracks = cachedCollection(event, "IsoTrack")
+        taus      = cachedCollection(event, "Tau")
+        jets      = cachedCollection(event, "Jet")
+        met       = cachedObject(event, self.metBranchName)
+        isvs      = cachedCollection(event, "SB")
+        photons   = cachedCollection(event, "Photon")
+
+        ## Selecting objects, variation independent and only stored for nominal
+        if None in self.variations:
+            self.Electron_Stop0l = map(self.SelEle, electrons)
+            self.Muon_Stop0l     = map(self.SelMuon, muons)
+            self.Tau_Stop0l      = map(lambda x : self.SelTauPOG(x, met), taus)
+            self.SB_Stop0l       = map(lambda x : self.SelSoftb(x, jets), isvs)
+            self.Photon_Stop0l   = map(self.SelPhotons, photons)
+
+            self.out.fillBranch("Stop0l_nSoftb",   sum(self.SB_Stop0l))
+            self.out.fillBranch("Electron_Stop0l", self.Electron_Stop0l)
+            self.out.fillBranch("Muon_Stop0l",     self.Muon_Stop0l)
+            self.out.fillBranch("Tau_Stop0l",      self.Tau_Stop0l)
+            self.out.fillBranch("SB_Stop0l",       self.SB_Stop0l)
+            self.out.fillBranch("Photon_Stop0l",   self.Photon_Stop0l)
+
+        ## Jet phi is not changed by any variation
+        jet_phi = np.asarray([jet.phi for jet in jets])
+        jetCache = {}
+        for uncert in self.variations:
+            self.analyzeVariation(uncert, electrons, muons, isotracks, taus, jets, jet_phi, met, jetCache)
 
         return True
 
@@ -0,0 +1,65 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+import numpy as np
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import VariationRemap, availableBranches
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+
+class Stop0lPreselection(Module):
+    """Loose preselection on the MET and the number of jets, to reject before the
+    expensive modules the events which cannot pass Pass_MET and Pass_NJets30.
+    An event is kept if any of the systematic variations available passes: the
+    MET is the largest of its variations, and each jet takes its largest pt."""
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Jet") + ["MET_*"]
+
+    def __init__(self, minMET=250, minNJets=2, minJetPt=30, maxJetEta=2.4):
+        self.minMET    = minMET
+        self.minNJets  = minNJets
+        self.minJetPt  = minJetPt
+        self.maxJetEta = maxJetEta
+        self.nEvents   = 0
+        self.nPassMET  = 0
+        self.nPass     = 0
+
+    def beginJob(self):
+        pass
+
+    def endJob(self):
+        print "Stop0l preselection (MET >= %g, %d jets with pt >= %g, |eta| <= %g, any variation):" % (
+            self.minMET, self.minNJets, self.minJetPt, self.maxJetEta)
+        print "  %d events, %d pass the MET cut, %d kept: %.1f%% removed" % (self.nEvents, self.nPassMET, self.nPass,
+                100. * (self.nEvents - self.nPass) / self.nEvents if self.nEvents else 0.)
+
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        ## Variations produced by the previous modules, none for data
+        branches = availableBranches(inputTree, wrappedOutputTree)
+        self.metBranches = ["MET_pt"]
+        self.jetBranches = ["Jet_pt"]
+        for uncert in sorted(v for v in VariationRemap if v is not None):
+            for coll, names in (("MET", self.metBranches), ("Jet", self.jetBranches)):
+                replaceMap = VariationRemap[uncert][coll]
+                if replaceMap and coll + "_" + replaceMap["pt"] in branches and coll + "_" + replaceMap["pt"] not in names:
+                    names.append(coll + "_" + replaceMap["pt"])
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        pass
+
+    def analyze(self, event):
+        """process event, return True (go to next module) or False (fail, go to next event)"""
+        self.nEvents += 1
+        ## MET first, the cheapest
+        if max(getattr(event, name) for name in self.metBranches) < self.minMET:
+            return False
+        self.nPassMET += 1
+
+        eta = branchArray(event.Jet_eta, float)
+        pt  = branchArray(getattr(event, self.jetBranches[0]), float)
+        for name in self.jetBranches[1:]:
+            pt = np.maximum(pt, branchArray(getattr(event, name)))
+        if np.count_nonzero((pt >= self.minJetPt) & (np.abs(eta) <= self.maxJetEta)) < self.minNJets:
+            return False
+        self.nPass += 1
+        return True
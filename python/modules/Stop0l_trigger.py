@@ -6,8 +6,104 @@ import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import cachedCollection, cachedObject, availableBranches
+from PhysicsTools.NanoSUSYTools.modules.effTables import graphTable, graphPoint, graphValues
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
+
+## (efficiency graph, variable it is evaluated at) of the Stop0l_trigger_eff_* branches
+TriggerEffCategories = [
+    ("MET_loose_baseline",     "met"),
+    ("MET_low_dm",             "met"),
+    ("MET_high_dm",            "met"),
+    ("MET_loose_baseline_QCD", "met"),
+    ("MET_low_dm_QCD",         "met"),
+    ("MET_high_dm_QCD",        "met"),
+    ("Electron_pt",            "ele_pt"),
+    ("Electron_eta",           "ele_eta"),
+    ("Muon_pt",                "mu_pt"),
+    ("Muon_eta",               "mu_eta"),
+    ("Photon_pt",              "photon_pt"),
+    ("Photon_eta",             "photon_eta"),
+    ("Zee_pt",                 "zee_pt"),
+    ("Zmumu_pt",               "zmumu_pt"),
+]
+## Graph of the additional uncertainty of the MET efficiency in the low dm QCD CR
+METSigCategory = ("MET_low_dm_QCD", "MET_low_dm_QCD_METSig")
+
+def triggerEffBranches():
+    names = []
+    for name, var in TriggerEffCategories:
+        names += ["Stop0l_trigger_eff_" + name + suffix for suffix in ("", "_down", "_up")]
+        if name == METSigCategory[0]:
+            names += ["Stop0l_trigger_eff_" + name + suffix + "_METSig" for suffix in ("_down", "_up")]
+    return names
+
+def triggerEfficiencies(effs, kinematics):
+    """All the Stop0l_trigger_eff_* values, as {branch : array}, from the tables
+    of graphTable effs and the arrays of the variables kinematics, NaN where
+    the efficiency is not evaluated (the values are then 0)"""
+    values = {}
+    for name, var in TriggerEffCategories:
+        branch = "Stop0l_trigger_eff_" + name
+        idx = graphPoint(effs[name], kinematics[var])
+        central, down, up = graphValues(effs[name], idx)
+        values[branch], values[branch + "_down"], values[branch + "_up"] = central, down, up
+        if name == METSigCategory[0]:
+            #assign additional sys unc for MET trigger eff in low dm QCD CR
+            sigEff = effs[METSigCategory[1]]
+            sigIdx = graphPoint(sigEff, kinematics[var])
+            found = (idx >= 0) & (sigIdx >= 0)
+            diff = np.abs(central - sigEff["central"][np.maximum(sigIdx, 0)])
+            values[branch + "_down_METSig"] = np.where(found, np.maximum(central - diff, 0), 0.)
+            values[branch + "_up_METSig"]   = np.where(found, np.minimum(central + diff, 1), 0.)
+    return values
+
+## HLT paths of the OR of each Pass_trigger_* group
+TriggerGroups = [
+    ("MET", [
+        'PFMET100_PFMHT100_IDTight', 'PFMET110_PFMHT110_IDTight', 'PFMET120_PFMHT120_IDTight',
+        'PFMET130_PFMHT130_IDTight', 'PFMET140_PFMHT140_IDTight',
+        'PFMETNoMu100_PFMHTNoMu100_IDTight', 'PFMETNoMu110_PFMHTNoMu110_IDTight', 'PFMETNoMu120_PFMHTNoMu120_IDTight',
+        'PFMETNoMu130_PFMHTNoMu130_IDTight', 'PFMETNoMu140_PFMHTNoMu140_IDTight',
+        'PFMET100_PFMHT100_IDTight_PFHT60', 'PFMET110_PFMHT110_IDTight_PFHT60', 'PFMET120_PFMHT120_IDTight_PFHT60',
+        'PFMET130_PFMHT130_IDTight_PFHT60', 'PFMET140_PFMHT140_IDTight_PFHT60',
+        'PFMETNoMu100_PFMHTNoMu100_IDTight_PFHT60', 'PFMETNoMu110_PFMHTNoMu110_IDTight_PFHT60', 'PFMETNoMu120_PFMHTNoMu120_IDTight_PFHT60',
+        'PFMETNoMu130_PFMHTNoMu130_IDTight_PFHT60', 'PFMETNoMu140_PFMHTNoMu140_IDTight_PFHT60',
+        #'PFMET120_PFMHT120_IDTight_HFCleaned', 'PFMET120_PFMHT120_IDTight_PFHT60_HFCleaned', 'PFMETNoMu120_PFMHTNoMu120_IDTight_HFCleaned',
+    ]),
+    ("muon", [
+        'IsoMu20', 'IsoMu22', 'IsoMu24', 'IsoMu27', 'IsoMu22_eta2p1', 'IsoMu24_eta2p1',
+        'IsoTkMu22', 'IsoTkMu24', 'Mu50', 'Mu55',
+    ]),
+    ("electron", [
+        'Ele105_CaloIdVT_GsfTrkIdT', 'Ele115_CaloIdVT_GsfTrkIdT', 'Ele135_CaloIdVT_GsfTrkIdT', 'Ele145_CaloIdVT_GsfTrkIdT',
+        'Ele25_eta2p1_WPTight_Gsf', 'Ele20_eta2p1_WPLoose_Gsf', 'Ele27_eta2p1_WPLoose_Gsf', 'Ele27_WPTight_Gsf',
+        'Ele35_WPTight_Gsf', 'Ele20_WPLoose_Gsf', 'Ele45_WPLoose_Gsf',
+        'Ele23_Ele12_CaloIdL_TrackIdL_IsoVL', 'Ele23_Ele12_CaloIdL_TrackIdL_IsoVL_DZ',
+        'DoubleEle33_CaloIdL_GsfTrkIdVL', 'DoubleEle33_CaloIdL_GsfTrkIdVL_MW', 'DoubleEle25_CaloIdL_MW', 'DoubleEle33_CaloIdL_MW',
+    ]),
+    ("photon", [
+        'Photon175', 'Photon200',
+    ]),
+]
+
+## Branches of the paths of each group present in the input, by set of HLT branches of the input
+_resolvedGroups = {}
+
+def resolveTriggerGroups(branchNames):
+    """{group : [HLT branches of its paths present in branchNames]}, the paths
+    missing from an era being dropped once per input schema"""
+    hltBranches = frozenset(br for br in branchNames if br.startswith("HLT_"))
+    if hltBranches not in _resolvedGroups:
+        _resolvedGroups[hltBranches] = dict((group, ["HLT_" + path for path in paths if "HLT_" + path in hltBranches])
+                                            for group, paths in TriggerGroups)
+    return _resolvedGroups[hltBranches]
 
 class Stop0l_trigger(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Electron", "Muon", "Photon") + ["HLT_*", "MET_*"]
+
     def __init__(self, era, isData = False):
         self.maxEvents = -1
         self.nEvents = 0
@@ -15,17 +111,14 @@ class Stop0l_trigger(Module):
 	self.isData = isData
         eff_file = "%s/src/PhysicsTools/NanoSUSYTools/data/trigger_eff/" % os.environ['CMSSW_BASE']
         eff_file = eff_file + self.era + "_trigger_eff.root"
-        self.tf = ROOT.TFile.Open(eff_file)
+        self.tf = openCalibFile(eff_file)
 
-        ## Keep the TGraph in memory
-        histo_name_list = ["MET_loose_baseline", "MET_high_dm", "MET_low_dm",
-			   "MET_loose_baseline_QCD", "MET_high_dm_QCD", "MET_low_dm_QCD",
-			   "MET_low_dm_QCD_METSig",
-			   "Electron_pt", "Electron_eta", "Muon_pt", "Muon_eta", 
-                           "Photon_pt", "Photon_eta", "Zmumu_pt", "Zee_pt"]
+        ## Keep the TGraph as NumPy tables
+        histo_name_list = [name for name, var in TriggerEffCategories] + [METSigCategory[1]]
         self.effs = { }
         for histo_name in histo_name_list:
-            self.effs[histo_name] = self.tf.Get(histo_name)
+            self.effs[histo_name] = graphTable(self.tf.Get(histo_name))
+        self.tf.Close()
 
     def beginJob(self):
         pass
@@ -34,183 +127,37 @@ class Stop0l_trigger(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        self.triggerPaths = resolveTriggerGroups(availableBranches(inputTree, wrappedOutputTree))
         self.out.branch("Pass_trigger_MET", "O")
         self.out.branch("Pass_trigger_muon", "O")
         self.out.branch("Pass_trigger_electron", "O")
         self.out.branch("Pass_trigger_photon", "O")
 
-        self.out.branch("Stop0l_trigger_eff_MET_loose_baseline", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_loose_baseline_down", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_loose_baseline_up", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_down", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_up", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_high_dm", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_high_dm_down", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_high_dm_up", "F")
-
-        self.out.branch("Stop0l_trigger_eff_MET_loose_baseline_QCD", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_loose_baseline_QCD_down", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_loose_baseline_QCD_up", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_QCD", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_QCD_down", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_QCD_up", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_QCD_down_METSig", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_low_dm_QCD_up_METSig", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_high_dm_QCD", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_high_dm_QCD_down", "F")
-        self.out.branch("Stop0l_trigger_eff_MET_high_dm_QCD_up", "F")
-
-        self.out.branch("Stop0l_trigger_eff_Electron_pt", "F")
-        self.out.branch("Stop0l_trigger_eff_Electron_pt_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Electron_pt_up", "F")
-        self.out.branch("Stop0l_trigger_eff_Electron_eta", "F")
-        self.out.branch("Stop0l_trigger_eff_Electron_eta_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Electron_eta_up", "F")
-        self.out.branch("Stop0l_trigger_eff_Muon_pt", "F")
-        self.out.branch("Stop0l_trigger_eff_Muon_pt_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Muon_pt_up", "F")
-        self.out.branch("Stop0l_trigger_eff_Muon_eta", "F")
-        self.out.branch("Stop0l_trigger_eff_Muon_eta_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Muon_eta_up", "F")
-        self.out.branch("Stop0l_trigger_eff_Photon_pt", "F")
-        self.out.branch("Stop0l_trigger_eff_Photon_pt_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Photon_pt_up", "F")
-        self.out.branch("Stop0l_trigger_eff_Photon_eta", "F")
-        self.out.branch("Stop0l_trigger_eff_Photon_eta_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Photon_eta_up", "F")
-
-        self.out.branch("Stop0l_trigger_eff_Zee_pt", "F")
-        self.out.branch("Stop0l_trigger_eff_Zee_pt_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Zee_pt_up", "F")
-        self.out.branch("Stop0l_trigger_eff_Zmumu_pt", "F")
-        self.out.branch("Stop0l_trigger_eff_Zmumu_pt_down", "F")
-        self.out.branch("Stop0l_trigger_eff_Zmumu_pt_up", "F")
+        for branch in triggerEffBranches():
+            self.out.branch(branch, "F")
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
 
-    def mygetattr(self, my_obj, my_branch, default_bool):
-        try: getattr(my_obj, my_branch)
-        except RuntimeError:
-            #print my_branch, "not found"
-            return default_bool
-        else: return getattr(my_obj, my_branch)
-
-    def get_efficiency(self, trigger_name, kinematic):
-        if trigger_name not in self.effs:
-            #self.effs[trigger_name] = self.tf.Get(trigger_name)
-            print trigger_name, " not found. Talk to Hui"
-            return 0, 0, 0
-
-        eff = self.effs[trigger_name]  
-        my_xrange = np.array([eff.GetX()[i] - eff.GetErrorXlow(i) for i in range(eff.GetN()) ])
-        my_xrange = np.append(my_xrange, 99999)
-        findbix = np.searchsorted(my_xrange, kinematic)-1
-	#print " my_xrange is ", my_xrange
-        if findbix == -1:
-            return 0, 0, 0
-	
-	eff_central = eff.GetY()[findbix]
-	eff_down = eff_central - eff.GetErrorYlow(findbix)
-	eff_up = eff_central + eff.GetErrorYhigh(findbix)
-
-	if(trigger_name == "MET_low_dm_QCD"): 		#assign additional sys unc for MET trigger eff in low dm QCD CR
-		eff_METSig = self.effs["MET_low_dm_QCD_METSig"]
-        	my_xrange_METSig = np.array([eff_METSig.GetX()[i] - eff_METSig.GetErrorXlow(i) for i in range(eff_METSig.GetN()) ])
-        	my_xrange_METSig = np.append(my_xrange_METSig, 99999)
-        	findbix_METSig = np.searchsorted(my_xrange_METSig, kinematic)-1
-        	if findbix_METSig == -1:
-            		return eff_central, eff_down, eff_up, 0, 0
-		eff_diff = abs(eff_central - eff_METSig.GetY()[findbix_METSig])
-		eff_down_METSig = eff_central - eff_diff
-		if (eff_down_METSig < 0): eff_down_METSig = 0
-		eff_up_METSig = eff_central + eff_diff
-		if (eff_up_METSig > 1): eff_up_METSig = 1
-        	return eff_central, eff_down, eff_up, eff_down_METSig, eff_up_METSig
-			
-        return eff_central, eff_down, eff_up
-        #return eff.GetY()[findbix], eff.GetY()[findbix] - eff.GetErrorYlow(findbix), eff.GetY()[findbix] + eff.GetErrorYhigh(findbix)
-
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
     	self.nEvents += 1
         if (self.maxEvents != -1 and self.nEvents > self.maxEvents):
             return False
 
-        hlt       = Object(event, "HLT")
-        met       = Object(event, "MET")
-        electrons = Collection(event, "Electron")
-        muons	  = Collection(event, "Muon")
-        photons   = Collection(event, "Photon")
-
-	if not self.isData: Pass_trigger_MET = True
-        else: Pass_trigger_MET = (
-            self.mygetattr(hlt, 'PFMET100_PFMHT100_IDTight', False)
-            or self.mygetattr(hlt, 'PFMET110_PFMHT110_IDTight', False)
-            or self.mygetattr(hlt, 'PFMET120_PFMHT120_IDTight', False)
-            or self.mygetattr(hlt, 'PFMET130_PFMHT130_IDTight', False)
-            or self.mygetattr(hlt, 'PFMET140_PFMHT140_IDTight', False)
-            or self.mygetattr(hlt, 'PFMETNoMu100_PFMHTNoMu100_IDTight', False)
-            or self.mygetattr(hlt, 'PFMETNoMu110_PFMHTNoMu110_IDTight', False)
-            or self.mygetattr(hlt, 'PFMETNoMu120_PFMHTNoMu120_IDTight', False)
-            or self.mygetattr(hlt, 'PFMETNoMu130_PFMHTNoMu130_IDTight', False)
-            or self.mygetattr(hlt, 'PFMETNoMu140_PFMHTNoMu140_IDTight', False)
-            or self.mygetattr(hlt, 'PFMET100_PFMHT100_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMET110_PFMHT110_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMET120_PFMHT120_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMET130_PFMHT130_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMET140_PFMHT140_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMETNoMu100_PFMHTNoMu100_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMETNoMu110_PFMHTNoMu110_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMETNoMu120_PFMHTNoMu120_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMETNoMu130_PFMHTNoMu130_IDTight_PFHT60', False)
-            or self.mygetattr(hlt, 'PFMETNoMu140_PFMHTNoMu140_IDTight_PFHT60', False)
-            #or self.mygetattr(hlt, 'PFMET120_PFMHT120_IDTight_HFCleaned', False)
-            #or self.mygetattr(hlt, 'PFMET120_PFMHT120_IDTight_PFHT60_HFCleaned', False)
-            #or self.mygetattr(hlt, 'PFMETNoMu120_PFMHTNoMu120_IDTight_HFCleaned', False)
-        )
-
-	if not self.isData: Pass_trigger_muon = True
-        else: Pass_trigger_muon = (
-            self.mygetattr(hlt, 'IsoMu20', False)
-            or self.mygetattr(hlt, 'IsoMu22', False)
-            or self.mygetattr(hlt, 'IsoMu24', False)
-            or self.mygetattr(hlt, 'IsoMu27', False)
-            or self.mygetattr(hlt, 'IsoMu22_eta2p1', False)
-            or self.mygetattr(hlt, 'IsoMu24_eta2p1', False)
-            or self.mygetattr(hlt, 'IsoTkMu22', False)
-            or self.mygetattr(hlt, 'IsoTkMu24', False)
-            or self.mygetattr(hlt, 'Mu50', False)
-            or self.mygetattr(hlt, 'Mu55', False)
-        )
+        met       = cachedObject(event, "MET")
+        electrons = cachedCollection(event, "Electron")
+        muons	  = cachedCollection(event, "Muon")
+        photons   = cachedCollection(event, "Photon")
 
-	if not self.isData: Pass_trigger_electron = True
-        else: Pass_trigger_electron = (
-            self.mygetattr(hlt, 'Ele105_CaloIdVT_GsfTrkIdT', False)
-            or self.mygetattr(hlt, 'Ele115_CaloIdVT_GsfTrkIdT', False)
-            or self.mygetattr(hlt, 'Ele135_CaloIdVT_GsfTrkIdT', False)
-            or self.mygetattr(hlt, 'Ele145_CaloIdVT_GsfTrkIdT', False)
-            or self.mygetattr(hlt, 'Ele25_eta2p1_WPTight_Gsf', False)
-            or self.mygetattr(hlt, 'Ele20_eta2p1_WPLoose_Gsf', False)
-            or self.mygetattr(hlt, 'Ele27_eta2p1_WPLoose_Gsf', False)
-            or self.mygetattr(hlt, 'Ele27_WPTight_Gsf', False)
-            or self.mygetattr(hlt, 'Ele35_WPTight_Gsf', False)
-            or self.mygetattr(hlt, 'Ele20_WPLoose_Gsf', False)
-            or self.mygetattr(hlt, 'Ele45_WPLoose_Gsf', False)
-            or self.mygetattr(hlt, 'Ele23_Ele12_CaloIdL_TrackIdL_IsoVL', False)
-            or self.mygetattr(hlt, 'Ele23_Ele12_CaloIdL_TrackIdL_IsoVL_DZ', False)
-            or self.mygetattr(hlt, 'DoubleEle33_CaloIdL_GsfTrkIdVL', False)
-            or self.mygetattr(hlt, 'DoubleEle33_CaloIdL_GsfTrkIdVL_MW', False)
-            or self.mygetattr(hlt, 'DoubleEle25_CaloIdL_MW', False)
-            or self.mygetattr(hlt, 'DoubleEle33_CaloIdL_MW', False)
-        )
-
-	if not self.isData: Pass_trigger_photon = True
-        else: Pass_trigger_photon = (
-            self.mygetattr(hlt, 'Photon175', False)
-            or self.mygetattr(hlt, 'Photon200', False)
-        )
+	## OR of the paths present in the file, False if there is none
+	if not self.isData:
+		Pass_trigger_MET = Pass_trigger_muon = Pass_trigger_electron = Pass_trigger_photon = True
+	else:
+		Pass_trigger_MET      = any(getattr(event, br) for br in self.triggerPaths["MET"])
+		Pass_trigger_muon     = any(getattr(event, br) for br in self.triggerPaths["muon"])
+		Pass_trigger_electron = any(getattr(event, br) for br in self.triggerPaths["electron"])
+		Pass_trigger_photon   = any(getattr(event, br) for br in self.triggerPaths["photon"])
 
 	ele_veto = []
 	ele_mid = []
@@ -274,40 +221,18 @@ class Stop0l_trigger(Module):
         n_photon = len(photon_loose)
         n_photon_mid = len(photon_mid)
 
-	MET_trigger_eff_loose_baseline = MET_trigger_eff_loose_baseline_down = MET_trigger_eff_loose_baseline_up = 0
-	MET_trigger_eff_high_dm = MET_trigger_eff_high_dm_down = MET_trigger_eff_high_dm_up = 0
-	MET_trigger_eff_low_dm = MET_trigger_eff_low_dm_down = MET_trigger_eff_low_dm_up = 0
-	MET_trigger_eff_loose_baseline_QCD = MET_trigger_eff_loose_baseline_QCD_down = MET_trigger_eff_loose_baseline_QCD_up = 0
-	MET_trigger_eff_high_dm_QCD = MET_trigger_eff_high_dm_QCD_down = MET_trigger_eff_high_dm_QCD_up = 0
-	MET_trigger_eff_low_dm_QCD = MET_trigger_eff_low_dm_QCD_down = MET_trigger_eff_low_dm_QCD_up = MET_trigger_eff_low_dm_QCD_down_METSig = MET_trigger_eff_low_dm_QCD_up_METSig = 0
-
-	if (met.pt > 100):
-		MET_trigger_eff_loose_baseline, MET_trigger_eff_loose_baseline_down, MET_trigger_eff_loose_baseline_up = self.get_efficiency("MET_loose_baseline", met.pt)
-		MET_trigger_eff_high_dm, MET_trigger_eff_high_dm_down, MET_trigger_eff_high_dm_up = self.get_efficiency("MET_high_dm", met.pt)
-		MET_trigger_eff_low_dm, MET_trigger_eff_low_dm_down, MET_trigger_eff_low_dm_up = self.get_efficiency("MET_low_dm", met.pt)
-		MET_trigger_eff_loose_baseline_QCD, MET_trigger_eff_loose_baseline_QCD_down, MET_trigger_eff_loose_baseline_QCD_up = self.get_efficiency("MET_loose_baseline_QCD", met.pt)
-		MET_trigger_eff_high_dm_QCD, MET_trigger_eff_high_dm_QCD_down, MET_trigger_eff_high_dm_QCD_up = self.get_efficiency("MET_high_dm_QCD", met.pt)
-		MET_trigger_eff_low_dm_QCD, MET_trigger_eff_low_dm_QCD_down, MET_trigger_eff_low_dm_QCD_up, MET_trigger_eff_low_dm_QCD_down_METSig, MET_trigger_eff_low_dm_QCD_up_METSig = self.get_efficiency("MET_low_dm_QCD", met.pt)
-
-	Electron_trigger_eff_pt = Electron_trigger_eff_pt_down = Electron_trigger_eff_pt_up = 0
-	if (n_ele_mid >=1): Electron_trigger_eff_pt, Electron_trigger_eff_pt_down, Electron_trigger_eff_pt_up = self.get_efficiency("Electron_pt", ele_mid[0].pt)
-	Electron_trigger_eff_eta = Electron_trigger_eff_eta_down = Electron_trigger_eff_eta_up = 0
-	if (n_ele_mid >=1): Electron_trigger_eff_eta, Electron_trigger_eff_eta_down, Electron_trigger_eff_eta_up = self.get_efficiency("Electron_eta", ele_mid[0].eta)
-
-	Muon_trigger_eff_pt = Muon_trigger_eff_pt_down = Muon_trigger_eff_pt_up = 0
-	if (n_mu_mid >=1): Muon_trigger_eff_pt, Muon_trigger_eff_pt_down, Muon_trigger_eff_pt_up = self.get_efficiency("Muon_pt", mu_mid[0].pt)
-	Muon_trigger_eff_eta = Muon_trigger_eff_eta_down = Muon_trigger_eff_eta_up = 0
-	if (n_mu_mid >=1): Muon_trigger_eff_eta, Muon_trigger_eff_eta_down, Muon_trigger_eff_eta_up = self.get_efficiency("Muon_eta", mu_mid[0].eta)
-
-	Photon_trigger_eff_pt = Photon_trigger_eff_pt_down = Photon_trigger_eff_pt_up = 0
-	if (n_photon_mid >=1): Photon_trigger_eff_pt, Photon_trigger_eff_pt_down, Photon_trigger_eff_pt_up = self.get_efficiency("Photon_pt", photon_mid[0].pt)
-	Photon_trigger_eff_eta = Photon_trigger_eff_eta_down = Photon_trigger_eff_eta_up = 0
-	if (n_photon_mid >=1): Photon_trigger_eff_eta, Photon_trigger_eff_eta_down, Photon_trigger_eff_eta_up = self.get_efficiency("Photon_eta", photon_mid[0].eta)
-
-	Zee_trigger_eff_pt = Zee_trigger_eff_pt_down = Zee_trigger_eff_pt_up = 0
-	if (n_zee ==1): Zee_trigger_eff_pt, Zee_trigger_eff_pt_down, Zee_trigger_eff_pt_up = self.get_efficiency("Zee_pt", zee_mid[0].Pt())
-	Zmumu_trigger_eff_pt = Zmumu_trigger_eff_pt_down = Zmumu_trigger_eff_pt_up = 0
-	if (n_zmumu ==1): Zmumu_trigger_eff_pt, Zmumu_trigger_eff_pt_down, Zmumu_trigger_eff_pt_up = self.get_efficiency("Zmumu_pt", zmumu_mid[0].Pt())
+	kinematics = {
+		"met":        met.pt if met.pt > 100 else np.nan,
+		"ele_pt":     ele_mid[0].pt if n_ele_mid >= 1 else np.nan,
+		"ele_eta":    ele_mid[0].eta if n_ele_mid >= 1 else np.nan,
+		"mu_pt":      mu_mid[0].pt if n_mu_mid >= 1 else np.nan,
+		"mu_eta":     mu_mid[0].eta if n_mu_mid >= 1 else np.nan,
+		"photon_pt":  photon_mid[0].pt if n_photon_mid >= 1 else np.nan,
+		"photon_eta": photon_mid[0].eta if n_photon_mid >= 1 else np.nan,
+		"zee_pt":     zee_mid[0].Pt() if n_zee == 1 else np.nan,
+		"zmumu_pt":   zmumu_mid[0].Pt() if n_zmumu == 1 else np.nan,
+	}
+	trigger_effs = triggerEfficiencies(self.effs, dict((var, np.array([x])) for var, x in kinematics.items()))
 
         ### Store output
         self.out.fillBranch("Pass_trigger_MET", Pass_trigger_MET)
@@ -315,55 +240,9 @@ class Stop0l_trigger(Module):
         self.out.fillBranch("Pass_trigger_electron", Pass_trigger_electron)
         self.out.fillBranch("Pass_trigger_photon", Pass_trigger_photon)
 
-        self.out.fillBranch("Stop0l_trigger_eff_MET_loose_baseline", MET_trigger_eff_loose_baseline)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_loose_baseline_down", MET_trigger_eff_loose_baseline_down)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_loose_baseline_up", MET_trigger_eff_loose_baseline_up)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm", MET_trigger_eff_low_dm)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_down", MET_trigger_eff_low_dm_down)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_up", MET_trigger_eff_low_dm_up)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_high_dm", MET_trigger_eff_high_dm)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_high_dm_down", MET_trigger_eff_high_dm_down)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_high_dm_up", MET_trigger_eff_high_dm_up)
-
-        self.out.fillBranch("Stop0l_trigger_eff_MET_loose_baseline_QCD", MET_trigger_eff_loose_baseline_QCD)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_loose_baseline_QCD_down", MET_trigger_eff_loose_baseline_QCD_down)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_loose_baseline_QCD_up", MET_trigger_eff_loose_baseline_QCD_up)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_QCD", MET_trigger_eff_low_dm_QCD)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_QCD_down", MET_trigger_eff_low_dm_QCD_down)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_QCD_up", MET_trigger_eff_low_dm_QCD_up)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_QCD_down_METSig", MET_trigger_eff_low_dm_QCD_down_METSig)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_low_dm_QCD_up_METSig", MET_trigger_eff_low_dm_QCD_up_METSig)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_high_dm_QCD", MET_trigger_eff_high_dm_QCD)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_high_dm_QCD_down", MET_trigger_eff_high_dm_QCD_down)
-        self.out.fillBranch("Stop0l_trigger_eff_MET_high_dm_QCD_up", MET_trigger_eff_high_dm_QCD_up)
-
-        self.out.fillBranch("Stop0l_trigger_eff_Electron_pt", Electron_trigger_eff_pt)
-        self.out.fillBranch("Stop0l_trigger_eff_Electron_pt_down", Electron_trigger_eff_pt_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Electron_pt_up", Electron_trigger_eff_pt_up)
-        self.out.fillBranch("Stop0l_trigger_eff_Electron_eta", Electron_trigger_eff_eta)
-        self.out.fillBranch("Stop0l_trigger_eff_Electron_eta_down", Electron_trigger_eff_eta_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Electron_eta_up", Electron_trigger_eff_eta_up)
-        self.out.fillBranch("Stop0l_trigger_eff_Muon_pt", Muon_trigger_eff_pt)
-        self.out.fillBranch("Stop0l_trigger_eff_Muon_pt_down", Muon_trigger_eff_pt_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Muon_pt_up", Muon_trigger_eff_pt_up)
-        self.out.fillBranch("Stop0l_trigger_eff_Muon_eta", Muon_trigger_eff_eta)
-        self.out.fillBranch("Stop0l_trigger_eff_Muon_eta_down", Muon_trigger_eff_eta_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Muon_eta_up", Muon_trigger_eff_eta_up)
-        self.out.fillBranch("Stop0l_trigger_eff_Photon_pt", Photon_trigger_eff_pt)
-        self.out.fillBranch("Stop0l_trigger_eff_Photon_pt_down", Photon_trigger_eff_pt_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Photon_pt_up", Photon_trigger_eff_pt_up)
-        self.out.fillBranch("Stop0l_trigger_eff_Photon_eta", Photon_trigger_eff_eta)
-        self.out.fillBranch("Stop0l_trigger_eff_Photon_eta_down", Photon_trigger_eff_eta_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Photon_eta_up", Photon_trigger_eff_eta_up)
+        for branch in triggerEffBranches():
+            self.out.fillBranch(branch, trigger_effs[branch][0])
 
-        self.out.fillBranch("Stop0l_trigger_eff_Zee_pt", Zee_trigger_eff_pt)
-        self.out.fillBranch("Stop0l_trigger_eff_Zee_pt_down", Zee_trigger_eff_pt_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Zee_pt_up", Zee_trigger_eff_pt_up)
-        self.out.fillBranch("Stop0l_trigger_eff_Zmumu_pt", Zmumu_trigger_eff_pt)
-        self.out.fillBranch("Stop0l_trigger_eff_Zmumu_pt_down", Zmumu_trigger_eff_pt_down)
-        self.out.fillBranch("Stop0l_trigger_eff_Zmumu_pt_up", Zmumu_trigger_eff_pt_up)
-
-        self.tf.Close()
         return True
 
 
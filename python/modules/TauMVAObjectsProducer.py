@@ -10,14 +10,27 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collect
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
 from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import *
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.tauMVATools import pfcandMT, genTauDecayMatch
+from PhysicsTools.NanoSUSYTools.modules.trainingSample import ChunkedColumnWriter
 from rootpy.tree import Tree, TreeModel, IntCol, FloatArrayCol
 
 #2016 MC: https://twiki.cern.ch/twiki/bin/view/CMS/BtagRecommendation80XReReco#Data_MC_Scale_Factors_period_dep
 #2017 MC: https://twiki.cern.ch/twiki/bin/view/CMS/BtagRecommendation94X
 
+## Input variables of the tau MVA, in the order of the models
+TrainingFeatures = ['pt', 'abseta', 'chiso0p1', 'chiso0p2', 'chiso0p3', 'chiso0p4', 'totiso0p1', 'totiso0p2', 'totiso0p3', 'totiso0p4', 'neartrkdr', 'contjetdr', 'contjetcsv']
+## Columns of the training sample files: the branches of the tree output, and the event weight
+TrainingColumns = [(var, np.float32) for var in TrainingFeatures + ['mt', 'misset', 'absdz', 'ptmatch', 'etamatch']] + [('gentaumatch', np.bool_), ('weight', np.float32)]
+
 class TauMVAObjectsProducer(Module):
-    def __init__(self):
+    def __init__(self, trainingFile=None, chunkSize=200000):
         self.metBranchName = "MET"
+	## With trainingFile, the selected candidates are written to the chunks
+	## <trainingFile>_<job>_<n>/ instead of the output tree
+	self.trainingFile = trainingFile
+	self.chunkSize = chunkSize
+	self.writer = None
 	self.p_tauminus = 15
 	self.p_Z0       = 23
 	self.p_Wplus    = 24
@@ -34,12 +47,17 @@ class TauMVAObjectsProducer(Module):
 	self.pfhplus = 211
 
     def beginJob(self):
-        pass
+	if self.trainingFile:
+		self.writer = ChunkedColumnWriter(self.trainingFile, TrainingColumns, self.chunkSize)
     def endJob(self):
-        pass
+	if self.writer:
+		self.writer.close()
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+	self.hasGenWeight = bool(inputTree.GetBranch("genWeight"))
+	if self.writer:
+		return
 	self.out.branch("pt", "F")
 	self.out.branch("mt", "F")
 	self.out.branch("misset", "F")
@@ -65,37 +83,6 @@ class TauMVAObjectsProducer(Module):
     def isA(self, particleID, p):
 	return abs(p) == particleID
 
-    def getNearPhotonIndex(self, pfc, pfcands):
-	minPhotonPt = 0.5
-	maxPhotonDR = 0.2
-	photonInd = -1
-	maxPhotonPT = 0.0
-	
-	for ic in xrange(len(pfcands)):
-		c = pfcands[ic]
-		if(c.nearphopt < minPhotonPt): continue
-		dr = deltaR(c.eta, c.phi, pfc.nearphoeta, pfc.nearphophi)
-		if(dr > maxPhotonDR): continue;
-		if(c.nearphopt > maxPhotonPT):
-			maxPhotonPT = c.pt;
-			photonInd = ic;
-	
-	return photonInd;
-
-    def transverseMass(self, visible, invisible):
-	cosDPhi   = np.cos( deltaPhi(visible.Phi(), invisible.phi) );
-	return np.sqrt( 2 * visible.Pt() * invisible.pt * (1 - cosDPhi) );
-        
-    def computeMT(self, pfc, met, pfcands):
-	photonInd = self.getNearPhotonIndex(pfc, pfcands);
-	candP4 = ROOT.TLorentzVector()
-	candP4.SetPtEtaPhiM(pfc.pt, pfc.eta, pfc.phi, pfc.mass)
-	if(photonInd > -1): 
-		pfcand_buff = ROOT.TLorentzVector()
-		pfcand_buff.SetPtEtaPhiM(pfcands[photonInd].pt, pfcands[photonInd].eta, pfcands[photonInd].phi, pfcands[photonInd].mass)
-		candP4+=pfcand_buff;
-	return self.transverseMass(candP4, met);
-
     def analyze(self, event):
         ## Getting objects
 	met	  = Object(event, "MET")
@@ -131,29 +118,31 @@ class TauMVAObjectsProducer(Module):
 	misset = met.pt
 	nGenChHads = len(taudecayprods)
 
-	for pfc in pfcand:
+	#transverse mass of the preselected candidates with their near photon, for all of them at once
+	pfcPt  = branchArray(event.PFcand_pt,  dtype=float)
+	pfcEta = branchArray(event.PFcand_eta, dtype=float)
+	mtCands = np.nonzero((pfcPt > 10.0) & (np.abs(pfcEta) < 2.4))[0]
+	pfcMT = np.zeros(len(pfcPt))
+	pfcMT[mtCands] = pfcandMT(event, met, mtCands)
+	#truth matching of all the candidates to the charged hadrons of the tau decays
+	pfcMatch, pfcPtMatch, pfcEtaMatch = genTauDecayMatch(pfcPt, pfcEta, branchArray(event.PFcand_phi, dtype=float),
+	                                                     np.array([p.pt  for p in taudecayprods], dtype=float),
+	                                                     np.array([p.eta for p in taudecayprods], dtype=float),
+	                                                     np.array([p.phi for p in taudecayprods], dtype=float))
+
+	rows = []
+	for ipfc, pfc in enumerate(pfcand):
       
-		match = False
-		tmpDr = 0.05
-		kpt = 0.01
-		ptmatch = -1.0
-		etamatch = -10
+		match    = pfcMatch[ipfc]
+		ptmatch  = pfcPtMatch[ipfc]
+		etamatch = pfcEtaMatch[ipfc]
 		
 		
-		for genchhad in taudecayprods:
-			dpt = 0.0
-			if(genchhad.pt>0.5): 
-				dpt = abs(1.0 - pfc.pt/genchhad.pt)
-			if((deltaR(pfc.eta, pfc.phi, genchhad.eta, genchhad.phi) +  kpt*dpt) < tmpDr and dpt < 0.4):
-				tmpDr = deltaR(pfc.eta, pfc.phi, genchhad.eta, genchhad.phi) + kpt*dpt
-				match = True
-				ptmatch = genchhad.pt
-				etamatch = genchhad.eta
 		
 		if(pfc.pt > 10.0 and abs(pfc.eta) < 2.4):
 		
 			pt = min(pfc.pt,float(300.0))
-			mt = self.computeMT(pfc, met, pfcand)
+			mt = pfcMT[ipfc]
 			
 			abseta       = abs(pfc.eta)
 			absdz        = abs(pfc.dz)
@@ -177,6 +166,10 @@ class TauMVAObjectsProducer(Module):
 			if(match and nGenHadTaus > 0): gentaumatch = True
 			else:                          gentaumatch = False
 			
+			if self.writer:
+				rows.append((pt, abseta, chiso0p1, chiso0p2, chiso0p3, chiso0p4, totiso0p1, totiso0p2, totiso0p3, totiso0p4,
+				             neartrkdr, contjetdr, contjetcsv, mt, misset, absdz, ptmatch, etamatch, gentaumatch))
+				continue
 			self.out.fillBranch("pt",		pt)
 			self.out.fillBranch("abseta",		abseta)
 			self.out.fillBranch("absdz",		absdz)
@@ -198,6 +191,14 @@ class TauMVAObjectsProducer(Module):
 			self.out.fillBranch("etamatch", 	etamatch)
 			self.out.fill()
 		
+	if self.writer:
+		if rows:
+			columns = zip(*rows)
+			sample = dict((name, np.array(values)) for (name, dtype), values in zip(TrainingColumns, columns))
+			sample['weight'] = np.full(len(rows), event.genWeight if self.hasGenWeight else 1.0)
+			self.writer.append(**sample)
+		## Nothing is written to the output tree
+		return False
 	return True
 
 
@@ -10,6 +10,7 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collect
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped, CollectionRemapped
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 
 #2016 MC: https://twiki.cern.ch/twiki/bin/view/CMS/BtagRecommendation80XReReco#Data_MC_Scale_Factors_period_dep
 #2017 MC: https://twiki.cern.ch/twiki/bin/view/CMS/BtagRecommendation94X
@@ -69,7 +70,7 @@ class TopOtherWeightProducer(Module):
         pass
 
     def loadhisto(self,filename,hname):
-        file =ROOT.TFile.Open(filename)
+        file =openCalibFile(filename)
         hist_ = file.Get(hname)
         hist_.SetDirectory(0)
         return hist_
@@ -8,10 +8,17 @@ import os
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
 from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import ObjectRemapped, CollectionRemapped
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.genAncestry import genAncestry
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 
 class TopReweightProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("GenPart")
+
     def __init__(self, era, Process, isData = False):
         self.era = era
         self.sampleName = Process
@@ -27,7 +34,7 @@ class TopReweightProducer(Module):
         pass
 
     def loadhisto(self,filename,hname):
-        file =ROOT.TFile.Open(filename)
+        file =openCalibFile(filename)
         hist_ = file.Get(hname)
         hist_.SetDirectory(0)
         return hist_
@@ -85,50 +92,48 @@ class TopReweightProducer(Module):
 
         return up, dn
 
-    def topPTWeight(self, genparts):
+    def topPTWeight(self, event):
+        ancestry = genAncestry(event)
+        genPt = branchArray(event.GenPart_pt, dtype=float)
         genTops = []
         genTops_up = []
         genTops_dn = []
         mgpowheg = []
-        for gp in genparts:
-            if gp.statusFlags & 8192 == 0: continue
-            if abs(gp.pdgId) == 6:
-                genTops.append(gp)
-                mgpowheg.append(self.topMGPowheg.GetBinContent(self.topMGPowheg.GetNbinsX()) if gp.pt >= 1000 else self.topMGPowheg.GetBinContent(self.topMGPowheg.GetXaxis().FindBin(gp.pt)))
-                up, dn = self.topPTSyst(gp.pt)
-                genTops_up.append(up)
-                genTops_dn.append(dn)
-
-            if len(mgpowheg) != 0: topptWeight = 1.*mgpowheg[0]
-            else:                  topptWeight = 1.
-            topptWeight_only = 1.
-            if len(mgpowheg) != 0: topptWeight_mgpow = mgpowheg[0]
-            else:                  topptWeight_mgpow = 1.
-            if len(genTops_up) != 0: topptWeight_up = genTops_up[0]
-            else:                    topptWeight_up = 1.
-            if len(genTops_dn) != 0: topptWeight_dn = genTops_dn[0]
-            else:                    topptWeight_dn = 1.
-
-            if len(genTops) == 2:
-                def wgt(pt):
-                    return np.exp(0.0615 - 0.0005 * np.clip(pt, 0, 800))
-        
-                topptWeight = np.sqrt(wgt(genTops[0].pt) * mgpowheg[0] * wgt(genTops[1].pt) * mgpowheg[1])
-                topptWeight_only = np.sqrt(wgt(genTops[0].pt) * wgt(genTops[1].pt))
-                topptWeight_up = np.sqrt(wgt(genTops[0].pt) * genTops_up[0] * wgt(genTops[1].pt) * genTops_up[1])
-                topptWeight_dn = np.sqrt(wgt(genTops[0].pt) * genTops_dn[0] * wgt(genTops[1].pt) * genTops_dn[1])
-                topptWeight_mgpow = np.sqrt(mgpowheg[0] * mgpowheg[1])
-
-        #print("toppt1: {0}, mgpow2: {1}, toppt2: {2}, mgpow2: {3}".format(genTops[0].pt, mgpowheg[0], genTops[1].pt, mgpowheg[1]))
+        for i in np.nonzero(((ancestry.statusFlags & 8192) != 0) & (ancestry.absPdgId == 6))[0]:
+            pt = float(genPt[i])
+            genTops.append(pt)
+            mgpowheg.append(self.topMGPowheg.GetBinContent(self.topMGPowheg.GetNbinsX()) if pt >= 1000 else self.topMGPowheg.GetBinContent(self.topMGPowheg.GetXaxis().FindBin(pt)))
+            up, dn = self.topPTSyst(pt)
+            genTops_up.append(up)
+            genTops_dn.append(dn)
+
+        if len(mgpowheg) != 0: topptWeight = 1.*mgpowheg[0]
+        else:                  topptWeight = 1.
+        topptWeight_only = 1.
+        if len(mgpowheg) != 0: topptWeight_mgpow = mgpowheg[0]
+        else:                  topptWeight_mgpow = 1.
+        if len(genTops_up) != 0: topptWeight_up = genTops_up[0]
+        else:                    topptWeight_up = 1.
+        if len(genTops_dn) != 0: topptWeight_dn = genTops_dn[0]
+        else:                    topptWeight_dn = 1.
+
+        if len(genTops) == 2:
+            def wgt(pt):
+                return np.exp(0.0615 - 0.0005 * np.clip(pt, 0, 800))
+    
+            topptWeight = np.sqrt(wgt(genTops[0]) * mgpowheg[0] * wgt(genTops[1]) * mgpowheg[1])
+            topptWeight_only = np.sqrt(wgt(genTops[0]) * wgt(genTops[1]))
+            topptWeight_up = np.sqrt(wgt(genTops[0]) * genTops_up[0] * wgt(genTops[1]) * genTops_up[1])
+            topptWeight_dn = np.sqrt(wgt(genTops[0]) * genTops_dn[0] * wgt(genTops[1]) * genTops_dn[1])
+            topptWeight_mgpow = np.sqrt(mgpowheg[0] * mgpowheg[1])
+
+        #print("toppt1: {0}, mgpow2: {1}, toppt2: {2}, mgpow2: {3}".format(genTops[0], mgpowheg[0], genTops[1], mgpowheg[1]))
         return topptWeight, topptWeight_only, topptWeight_mgpow, topptWeight_up, topptWeight_dn
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
-        ## Getting objects
-        if not self.isData: genpart   = Collection(event, "GenPart")
-        
         if "TTbar" in self.sampleName:
-            toppt_wgt, toppt_only, toppt_mgpow, toppt_up, toppt_dn  = self.topPTWeight(genpart) 
+            toppt_wgt, toppt_only, toppt_mgpow, toppt_up, toppt_dn  = self.topPTWeight(event) 
         else:
             toppt_wgt = 1.
             toppt_only = 1.
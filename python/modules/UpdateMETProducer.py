@@ -3,11 +3,14 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import invalidateCache
 
 
 class UpdateMETProducer(Module):
     def __init__(self, metBranchName):
         self.metBranchName = metBranchName
+        ## Input branches read, see branchSelection
+        self.inputBranches = [metBranchName + "_*"]
 
     def beginJob(self):
         pass
@@ -40,6 +43,7 @@ class UpdateMETProducer(Module):
         self.out.fillBranch("MET_sumEt", met.sumEt)
         self.out.fillBranch("MET_MetUnclustEnUpDeltaX", met.MetUnclustEnUpDeltaX)
         self.out.fillBranch("MET_MetUnclustEnUpDeltaY", met.MetUnclustEnUpDeltaY)
+        invalidateCache(event, "MET")
 
         return True
 
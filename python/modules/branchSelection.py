@@ -0,0 +1,100 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+import os
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+
+## Input branch selection built from the branches declared by the modules.
+## Each module lists the input branches it reads in an inputBranches class
+## attribute (patterns as in keep_and_drop.txt). The branches kept in the output
+## are always read, so the selection is the output selection plus a keep
+## statement for each declared input: only the branches neither stored nor
+## read by any module are pruned.
+
+def collectionBranches(*collections):
+    """Patterns of all the branches of the collections"""
+    patterns = []
+    for coll in collections:
+        patterns += ["n" + coll, coll + "_*"]
+    return patterns
+
+## Inputs of the modules from other packages, which do not declare them
+ExternalModuleInputs = {
+    "jetmetUncertaintiesProducer" : collectionBranches("Jet", "GenJet", "Muon") + ["MET_*", "RawMET_*", "fixedGridRho*"],
+    "jetRecalib"                  : collectionBranches("Jet", "Muon") + ["MET_*", "RawMET_*", "fixedGridRho*"],
+    "jecUncertProducer"           : collectionBranches("Jet"),
+    "btagSFProducer"              : collectionBranches("Jet"),
+    "puWeightProducer"            : ["Pileup_*"],
+    "TopTaggerProducer"           : collectionBranches("Jet", "FatJet", "SubJet", "SB", "Electron", "Muon", "Photon") + ["MET_*"],
+}
+
+def moduleInputBranches(mod):
+    """Declared input branches of a module, None if unknown"""
+    patterns = getattr(mod, "inputBranches", None)
+    if patterns is None:
+        patterns = ExternalModuleInputs.get(mod.__class__.__name__)
+    return patterns
+
+def writeInputBranchSel(mods, outputbranchsel, fileName):
+    """Write the input branch selection of the modules to fileName and return it,
+    or None (all branches read) if some module does not declare its inputs"""
+    patterns = []
+    for mod in mods:
+        modPatterns = moduleInputBranches(mod)
+        if modPatterns is None:
+            print "Input branches of %s unknown, reading all the input branches" % mod.__class__.__name__
+            return None
+        for pattern in modPatterns:
+            if pattern not in patterns:
+                patterns.append(pattern)
+
+    with open(fileName, "w") as f:
+        f.write("# Generated from the inputs of the modules, on top of %s\n" % os.path.basename(outputbranchsel))
+        with open(outputbranchsel) as output:
+            for line in output:
+                f.write(line if line.endswith("\n") else line + "\n")
+        f.write("## Inputs of the modules\n")
+        for pattern in patterns:
+            f.write("keep %s\n" % pattern)
+    return fileName
+
+
+class BranchReadReport(Module):
+    """Report at the end of each file the bytes actually read from it (the
+    TFile counters, which include the TTreeCache prefetching), and the
+    compressed size on disk of the input branches enabled and of those disabled
+    by the input branch selection. The sizes on disk are those of all the
+    entries, not the bytes read: they only rank the branches."""
+    def __init__(self, nPrint = 20):
+        self.nPrint = nPrint
+
+    def beginJob(self):
+        pass
+    def endJob(self):
+        pass
+
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.bytesReadStart = inputFile.GetBytesRead()
+        self.readCallsStart = inputFile.GetReadCalls()
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        enabled, disabled = [], 0
+        for br in inputTree.GetListOfBranches():
+            if inputTree.GetBranchStatus(br.GetName()):
+                enabled.append((br.GetZipBytes(), br.GetName()))
+            else:
+                disabled += br.GetZipBytes()
+        enabled.sort(reverse=True)
+        totEnabled = sum(size for size, name in enabled)
+
+        print "Input branches of %s:" % inputFile.GetName()
+        print "  %.1f MB read from the file in %d read calls" % ((inputFile.GetBytesRead() - self.bytesReadStart)/1e6,
+                inputFile.GetReadCalls() - self.readCallsStart)
+        print "  %d branches enabled, %.1f MB compressed on disk; %d disabled, %.1f MB on disk" % (len(enabled), totEnabled/1e6,
+                inputTree.GetListOfBranches().GetEntries() - len(enabled), disabled/1e6)
+        print "  Largest enabled branches, compressed size on disk:"
+        for size, name in enabled[:self.nPrint]:
+            print "  %-40s %10.1f kB %6.1f%%" % (name, size/1e3, 100.*size/totEnabled if totEnabled else 0.)
+
+    def analyze(self, event):
+        return True
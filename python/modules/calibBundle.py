@@ -0,0 +1,454 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules.effTables import axisTable, axisBins
+
+## Calibration bundle: the histograms and graphs of the ROOT files of data/,
+## extracted once by processors/buildCalibBundle.py into a single binary file
+## holding their arrays and a JSON header describing them. The jobs map the
+## bundle read-only with one np.memmap and get the objects as views of it, so
+## that they open no TFile at construction, and the jobs of a node share the
+## pages of the bundle instead of each keeping its own copy of the histograms.
+##
+## Layout: CalibBundleMagic, the size of the header (uint64), the header, then
+## the arrays, each aligned to ArrayAlignment bytes. The header holds the
+## version, the SHA-256 of the content and, for each file of data/ (by its path
+## relative to data/), its size, modification time, SHA-1 and its objects:
+## class, attributes and arrays [dtype, shape, offset from the start of the
+## arrays].
+##
+## The bundle is a copy of data/: it has to be rebuilt whenever a file of data/
+## changes. A job reads a file from the bundle only if it is unchanged: same
+## size and modification time, or else same SHA-1 (computed once per file and
+## job, e.g. after a new checkout). A changed file is read with ROOT.
+
+CalibBundleMagic   = b"NSCALIB\0"
+## To be increased when the layout or the content of the objects changes
+CalibBundleVersion = 2
+ArrayAlignment     = 64
+
+DataDir = os.path.join(os.environ.get("CMSSW_BASE", ""), "src/PhysicsTools/NanoSUSYTools/data")
+## Bundle read by openCalibFile, if it exists (by default from $NANOSUSY_CALIB)
+CalibBundlePath = os.environ.get("NANOSUSY_CALIB", os.path.join(DataDir, "calib.bundle"))
+## Subdirectories of data/ extracted into the bundle
+CalibDirectories = ["btagSF", "isrSF", "leptonSF", "pileup", "prefire_maps", "qcdJetRes", "sigXSec", "toppt", "trigger_eff"]
+
+## dtype of the bin contents of the histogram classes, by their last letter
+HistStorageTypes = {"C" : "i1", "S" : "i2", "I" : "i4", "F" : "f4", "D" : "f8"}
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Objects ~~~~~
+class AxisBinEdges(list):
+    """Variable bin edges of an axis, as the TArrayD of TAxis::GetXbins"""
+    def GetSize(self):
+        return len(self)
+
+class TableAxis(object):
+    """TAxis of a bundle histogram, from the table of effTables.axisTable"""
+    def __init__(self, table):
+        self.table   = table
+        self.edges   = table["edges"]
+        self.uniform = table["uniform"]
+        self.nBins   = len(self.edges) - 1
+        self.xMin    = float(self.edges[0])
+        self.xMax    = float(self.edges[-1])
+
+    def GetNbins(self):
+        return self.nBins
+
+    def GetXmin(self):
+        return self.xMin
+
+    def GetXmax(self):
+        return self.xMax
+
+    def GetXbins(self):
+        return AxisBinEdges([] if self.uniform else self.edges.tolist())
+
+    def FindBin(self, x):
+        return int(axisBins(self.table, x))
+    FindFixBin = FindBin
+
+    def GetBinLowEdge(self, i):
+        if not self.uniform and 0 < i <= self.nBins:
+            return float(self.edges[i - 1])
+        return self.xMin + (i - 1) * ((self.xMax - self.xMin) / self.nBins)
+
+    def GetBinUpEdge(self, i):
+        if not self.uniform and 0 < i <= self.nBins:
+            return float(self.edges[i])
+        return self.GetBinLowEdge(i) + (self.xMax - self.xMin) / self.nBins
+
+    def GetBinWidth(self, i):
+        if self.uniform:
+            return (self.xMax - self.xMin) / self.nBins
+        i = min(max(i, 1), self.nBins)
+        return float(self.edges[i] - self.edges[i - 1])
+
+    def GetBinCenter(self, i):
+        if self.uniform or not 0 < i <= self.nBins:
+            width = (self.xMax - self.xMin) / self.nBins
+            return self.xMin + (i - 1) * width + 0.5 * width
+        return float(self.edges[i - 1]) + 0.5 * float(self.edges[i] - self.edges[i - 1])
+
+class TableHist(object):
+    """TH1 or TH2 of a bundle, with the methods of ROOT used by the modules. The
+    contents and errors are arrays over the global bins, with the flow bins."""
+    def __init__(self, name, className, axes, values, errors):
+        self.name      = name
+        self.className = className
+        self.axes      = [TableAxis(axis) for axis in axes]
+        if len(self.axes) == 1:
+            self.axes.append(TableAxis({"edges" : np.array([0., 1.]), "uniform" : True}))
+        self.values    = values
+        self.errors    = errors
+
+    def __nonzero__(self):
+        return True
+    __bool__ = __nonzero__
+
+    def GetName(self):
+        return self.name
+
+    def ClassName(self):
+        return self.className
+
+    def SetDirectory(self, directory):
+        pass
+
+    def GetXaxis(self):
+        return self.axes[0]
+
+    def GetYaxis(self):
+        return self.axes[1]
+
+    def GetNbinsX(self):
+        return self.axes[0].nBins
+
+    def GetNbinsY(self):
+        return self.axes[1].nBins
+
+    def GetNcells(self):
+        return len(self.values)
+
+    def GetBin(self, ix, iy=0):
+        return ix + (self.axes[0].nBins + 2) * iy
+
+    def FindBin(self, x, y=None):
+        return self.GetBin(self.axes[0].FindBin(x), 0 if y is None else self.axes[1].FindBin(y))
+    FindFixBin = FindBin
+
+    def globalBin(self, bins):
+        b = self.GetBin(*bins)
+        return min(max(b, 0), len(self.values) - 1)
+
+    def GetBinContent(self, *bins):
+        return float(self.values[self.globalBin(bins)])
+
+    def GetBinError(self, *bins):
+        return float(self.errors[self.globalBin(bins)])
+
+    def GetBinLowEdge(self, i):
+        return self.axes[0].GetBinLowEdge(i)
+
+    def GetBinWidth(self, i):
+        return self.axes[0].GetBinWidth(i)
+
+    def GetBinCenter(self, i):
+        return self.axes[0].GetBinCenter(i)
+
+    def Integral(self, first=1, last=None):
+        n = self.axes[0].nBins
+        if first < 0:
+            first = 0
+        if last is None:
+            last = n
+        elif last > n + 1 or last < first:
+            last = n + 1
+        ## Summed bin after bin, as TH1::Integral
+        total = 0.
+        for value in self.values[first:last + 1].tolist():
+            total += value
+        return total
+
+    def FindFirstBinAbove(self, threshold=0):
+        above = np.nonzero(self.values[1:self.axes[0].nBins + 1] > threshold)[0]
+        return int(above[0]) + 1 if len(above) else -1
+
+    def Divide(self, other):
+        """Bin by bin ratio to the histogram other as TH1::Divide, 0 where other
+        is 0, with the errors of the ratio of uncorrelated histograms"""
+        num, den = self.values.astype(float), other.values.astype(float)
+        nonZero = den != 0
+        safe = np.where(nonZero, den, 1.)
+        self.values = np.where(nonZero, num / safe, 0.).astype(self.values.dtype)
+        self.errors = np.where(nonZero, np.sqrt((self.errors**2 * den**2 + other.errors**2 * num**2) / safe**4), 0.)
+        return True
+
+class TableGraph(object):
+    """TGraph or TGraphAsymmErrors of a bundle"""
+    def __init__(self, name, className, x, y, exl, exh, eyl, eyh):
+        self.name      = name
+        self.className = className
+        self.x, self.y = x, y
+        self.exl, self.exh, self.eyl, self.eyh = exl, exh, eyl, eyh
+
+    def __nonzero__(self):
+        return True
+    __bool__ = __nonzero__
+
+    def GetName(self):
+        return self.name
+
+    def ClassName(self):
+        return self.className
+
+    def GetN(self):
+        return len(self.x)
+
+    def GetX(self):
+        return self.x
+
+    def GetY(self):
+        return self.y
+
+    def GetErrorXlow(self, i):
+        return float(self.exl[i])
+
+    def GetErrorXhigh(self, i):
+        return float(self.exh[i])
+
+    def GetErrorYlow(self, i):
+        return float(self.eyl[i])
+
+    def GetErrorYhigh(self, i):
+        return float(self.eyh[i])
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Reading ~~~~~
+class BundleFile(object):
+    """The objects of one file of data/ in a bundle, read as from its TFile"""
+    def __init__(self, bundle, fileName, objects):
+        self.bundle   = bundle
+        self.fileName = fileName
+        self.objects  = objects
+
+    def __nonzero__(self):
+        return True
+    __bool__ = __nonzero__
+
+    def GetName(self):
+        return self.fileName
+
+    def IsOpen(self):
+        return True
+
+    def IsZombie(self):
+        return False
+
+    def Get(self, name):
+        """New object name (views of the bundle arrays), None if not found"""
+        entry = self.objects.get(name)
+        if entry is None:
+            return None
+        return self.bundle.makeObject(name, entry)
+
+    def Close(self):
+        pass
+
+class CalibBundle(object):
+    """Bundle mapped read-only in memory"""
+    def __init__(self, path, verify=False):
+        self.path = path
+        with open(path, "rb") as f:
+            magic = f.read(len(CalibBundleMagic))
+            if magic != CalibBundleMagic:
+                raise IOError("%s is not a calibration bundle" % path)
+            headerSize, = struct.unpack("<Q", f.read(8))
+            header = json.loads(f.read(headerSize).decode("utf-8"))
+        if header["version"] != CalibBundleVersion:
+            raise IOError("Calibration bundle %s has version %d, %d expected: rebuild it with buildCalibBundle.py" % (path, header["version"], CalibBundleVersion))
+        self.files       = header["files"]
+        self.contentHash = header["hash"]
+        ## Whether each source file is unchanged, checked at its first opening
+        self.unchanged   = {}
+        self.data = np.memmap(path, dtype=np.uint8, mode="r", offset=alignedSize(len(CalibBundleMagic) + 8 + headerSize))
+        if verify and contentHash(self.data, self.files) != self.contentHash:
+            raise IOError("Calibration bundle %s is corrupted" % path)
+
+    def array(self, spec):
+        dtype, shape, offset = spec
+        return np.ndarray(tuple(shape), dtype=np.dtype(str(dtype)), buffer=self.data, offset=offset)
+
+    def makeObject(self, name, entry):
+        arrays = dict((key, self.array(spec)) for key, spec in entry["arrays"].items())
+        if entry["type"] == "graph":
+            return TableGraph(name, entry["class"], arrays["x"], arrays["y"], arrays["exl"], arrays["exh"], arrays["eyl"], arrays["eyh"])
+        axes = [{"edges" : arrays[axis], "uniform" : uniform} for axis, uniform in zip(("xedges", "yedges"), entry["uniform"])]
+        return TableHist(name, entry["class"], axes, arrays["values"], arrays["errors"])
+
+    def isUnchanged(self, fileName, entry):
+        """Whether fileName is the file the bundle was built from (true if it
+        does not exist, the bundle being then the only copy)"""
+        if not os.path.exists(fileName):
+            return True
+        if os.path.getsize(fileName) != entry["size"]:
+            return False
+        if os.path.getmtime(fileName) == entry["mtime"]:
+            return True
+        return fileDigest(fileName) == entry["sha1"]
+
+    def open(self, fileName):
+        """BundleFile of fileName, if it is a file of DataDir held by the bundle
+        and unchanged since the bundle was built"""
+        relName = os.path.relpath(os.path.realpath(fileName), os.path.realpath(DataDir))
+        entry = self.files.get(relName)
+        if entry is None:
+            return None
+        if relName not in self.unchanged:
+            self.unchanged[relName] = self.isUnchanged(fileName, entry)
+            if not self.unchanged[relName]:
+                print "%s changed since the calibration bundle %s was built, reading it with ROOT: rebuild the bundle with buildCalibBundle.py" % (fileName, self.path)
+        if not self.unchanged[relName]:
+            return None
+        return BundleFile(self, fileName, entry["objects"])
+
+_loadedBundles = {}
+
+def calibBundle():
+    """Bundle of CalibBundlePath, mapped once per job, None if it does not exist"""
+    if not CalibBundlePath or not os.path.exists(CalibBundlePath):
+        return None
+    if CalibBundlePath not in _loadedBundles:
+        _loadedBundles[CalibBundlePath] = CalibBundle(CalibBundlePath)
+    return _loadedBundles[CalibBundlePath]
+
+def openCalibFile(fileName):
+    """File fileName of data/ read from the calibration bundle, or opened with
+    ROOT when the bundle does not hold it. Get(name) of either returns a false
+    object if name is not found."""
+    bundle = calibBundle()
+    if bundle is not None:
+        bundleFile = bundle.open(fileName)
+        if bundleFile is not None:
+            return bundleFile
+    return ROOT.TFile.Open(fileName)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Building ~~~~~
+def alignedSize(size):
+    return (size + ArrayAlignment - 1) // ArrayAlignment * ArrayAlignment
+
+def fileDigest(fileName):
+    """SHA-1 of the content of fileName"""
+    digest = hashlib.sha1()
+    with open(fileName, "rb") as f:
+        for block in iter(lambda : f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def sourceFileInfo(fileName):
+    """Size, modification time and SHA-1 of a source file of the bundle"""
+    return {"size" : os.path.getsize(fileName), "mtime" : os.path.getmtime(fileName), "sha1" : fileDigest(fileName)}
+
+def contentHash(data, files):
+    digest = hashlib.sha256(json.dumps(files, sort_keys=True).encode("utf-8"))
+    digest.update(memoryview(np.ascontiguousarray(data)))
+    return digest.hexdigest()
+
+def objectArrays(obj):
+    """(type, class, {name : array}, uniform axes) of a TH1, TH2 or TGraph"""
+    className = obj.ClassName()
+    if obj.InheritsFrom("TGraph"):
+        n = obj.GetN()
+        arrays = {
+            "x"   : np.array([obj.GetX()[i] for i in xrange(n)], dtype=float),
+            "y"   : np.array([obj.GetY()[i] for i in xrange(n)], dtype=float),
+            "exl" : np.array([obj.GetErrorXlow(i) for i in xrange(n)], dtype=float),
+            "exh" : np.array([obj.GetErrorXhigh(i) for i in xrange(n)], dtype=float),
+            "eyl" : np.array([obj.GetErrorYlow(i) for i in xrange(n)], dtype=float),
+            "eyh" : np.array([obj.GetErrorYhigh(i) for i in xrange(n)], dtype=float),
+        }
+        return "graph", className, arrays, []
+    axes = [axisTable(obj.GetXaxis())] + ([axisTable(obj.GetYaxis())] if obj.GetDimension() == 2 else [])
+    storage = HistStorageTypes.get(className[-1], "f8") if className.startswith("TH") else "f8"
+    nCells = obj.GetNcells()
+    arrays = {
+        "values" : np.array([obj.GetBinContent(i) for i in xrange(nCells)], dtype=storage),
+        "errors" : np.array([obj.GetBinError(i) for i in xrange(nCells)], dtype=float),
+    }
+    for key, axis in zip(("xedges", "yedges"), axes):
+        arrays[key] = axis["edges"]
+    return "hist", className, arrays, [bool(axis["uniform"]) for axis in axes]
+
+def readObjects(directory, prefix=""):
+    """(path, object) of the TH1, TH2 and TGraph of a ROOT directory, recursively"""
+    seen = set()
+    for key in directory.GetListOfKeys():
+        name = prefix + key.GetName()
+        ## Only the highest cycle, which is listed first
+        if name in seen:
+            continue
+        seen.add(name)
+        obj = key.ReadObj()
+        if obj.InheritsFrom("TDirectory"):
+            for item in readObjects(obj, name + "/"):
+                yield item
+        elif obj.InheritsFrom("TGraph") or (obj.InheritsFrom("TH1") and obj.GetDimension() <= 2):
+            yield name, obj
+
+def writeCalibBundle(outName, files):
+    """Write the bundle of files {path : (sourceFileInfo, {name : objectArrays})}"""
+    header = {}
+    blocks = []
+    offset = 0
+    for fileName, (info, objects) in sorted(files.items()):
+        entries = {}
+        for name, (objType, className, arrays, uniform) in sorted(objects.items()):
+            specs = {}
+            for key, array in sorted(arrays.items()):
+                array = np.ascontiguousarray(array)
+                specs[key] = [array.dtype.str, list(array.shape), offset]
+                padded = alignedSize(array.nbytes)
+                blocks.append(array.tobytes() + b"\0" * (padded - array.nbytes))
+                offset += padded
+            entries[name] = {"type" : objType, "class" : className, "uniform" : uniform, "arrays" : specs}
+        header[fileName] = dict(info, objects=entries)
+    data = b"".join(blocks)
+    headerBytes = json.dumps({"version" : CalibBundleVersion,
+                              "hash"    : contentHash(np.frombuffer(data, dtype=np.uint8), header),
+                              "files"   : header}, sort_keys=True).encode("utf-8")
+    start = len(CalibBundleMagic) + 8 + len(headerBytes)
+    ## Written under a temporary name, as running jobs can be reading the bundle
+    tmpName = "%s.%d.tmp" % (outName, os.getpid())
+    with open(tmpName, "wb") as f:
+        f.write(CalibBundleMagic + struct.pack("<Q", len(headerBytes)) + headerBytes)
+        f.write(b"\0" * (alignedSize(start) - start))
+        f.write(data)
+    os.rename(tmpName, outName)
+
+def buildCalibBundle(dataDir, outName, directories=CalibDirectories):
+    """Extract the objects of the ROOT files of the directories of dataDir into
+    the bundle outName"""
+    ROOT.TH1.AddDirectory(False)
+    files = {}
+    for directory in directories:
+        for root, dirs, fileNames in sorted(os.walk(os.path.join(dataDir, directory))):
+            for fileName in sorted(fileNames):
+                if not fileName.endswith(".root"):
+                    continue
+                path = os.path.join(root, fileName)
+                ## Before reading, so that a file changed meanwhile is found stale
+                info = sourceFileInfo(path)
+                tf = ROOT.TFile.Open(path)
+                objects = dict((name, objectArrays(obj)) for name, obj in readObjects(tf))
+                tf.Close()
+                files[os.path.relpath(path, dataDir)] = (info, objects)
+    writeCalibBundle(outName, files)
+    bundle = CalibBundle(outName, verify=True)
+    print "Wrote %d objects of %d files to %s (%.1f MB, sha256 %s)" % (
+        sum(len(objects) for info, objects in files.values()), len(files), outName,
+        os.path.getsize(outName) / 1e6, bundle.contentHash)
+    return bundle
@@ -0,0 +1,368 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+import math
+import ctypes
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules.friendTree import FriendTreeName
+
+## Helpers for the columnar (batch) paths of the modules. A batch holds N events
+## as flat NumPy arrays: one content array per branch of a collection, and the
+## offsets of each event in it (offsets[i]:offsets[i+1] are the objects of event i).
+
+class ColumnBatch(object):
+    """Jagged NumPy columns of a range of entries"""
+    def __init__(self, firstEntry, nEvents):
+        self.firstEntry = firstEntry
+        self.nEvents    = nEvents
+        self.columns    = {}
+        self.offsets    = {}
+        ## Collection of each collection column
+        self.collectionOf = {}
+        self._parents     = {}
+
+    def __contains__(self, entry):
+        return self.firstEntry <= entry < self.firstEntry + self.nEvents
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def index(self, entry):
+        return entry - self.firstEntry
+
+    def counts(self, coll):
+        return np.diff(self.offsets[coll])
+
+    def parents(self, coll):
+        """Event index of each object of the collection"""
+        if coll not in self._parents:
+            self._parents[coll] = np.repeat(np.arange(self.nEvents), self.counts(coll))
+        return self._parents[coll]
+
+    def eventSlice(self, i):
+        """Batch of event i alone, with views of the columns"""
+        single = ColumnBatch(self.firstEntry + i, 1)
+        for coll, offsets in self.offsets.items():
+            single.offsets[coll] = offsets[i:i+2] - offsets[i]
+        for name, values in self.columns.items():
+            coll = self.collectionOf.get(name)
+            if coll is None:
+                single.columns[name] = values[i:i+1]
+            else:
+                single.columns[name] = values[self.offsets[coll][i]:self.offsets[coll][i+1]]
+        single.collectionOf.update(self.collectionOf)
+        return single
+
+def offsetsFromCounts(counts):
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return offsets
+
+def localIndex(offsets):
+    """Index of each object within its own event"""
+    counts = np.diff(offsets)
+    return np.arange(offsets[-1]) - np.repeat(offsets[:-1], counts)
+
+def pairIndices(offsetsA, offsetsB):
+    """Indices (ia, ib) of all the pairs of objects of collections A and B
+    belonging to the same event"""
+    countsA  = np.diff(offsetsA)
+    countsB  = np.diff(offsetsB)
+    parentsA = np.repeat(np.arange(len(countsA)), countsA)
+    nb = countsB[parentsA]
+    ia = np.repeat(np.arange(offsetsA[-1]), nb)
+    ib = np.repeat(offsetsB[:-1][parentsA], nb) + localIndex(offsetsFromCounts(nb))
+    return ia, ib
+
+def segmentRank(mask, offsets):
+    """Number of True before each object within its own event"""
+    counts  = np.diff(offsets)
+    parents = np.repeat(np.arange(len(counts)), counts)
+    csum = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=csum[1:])
+    return csum[:-1] - csum[offsets[:-1]][parents]
+
+def segmentCount(mask, offsets):
+    """Number of True per event"""
+    counts = np.diff(offsets)
+    parents = np.repeat(np.arange(len(counts)), counts)
+    return np.bincount(parents[mask], minlength=len(counts))
+
+def segmentAny(mask, offsets):
+    return segmentCount(mask, offsets) > 0
+
+def segmentSum(values, offsets):
+    """Sum per event, added in object order as the python sum() of the
+    per-event code does, so that both give the same floating point result"""
+    counts  = np.diff(offsets)
+    nEvents = len(counts)
+    total   = np.zeros(nEvents)
+    if nEvents == 0 or offsets[-1] == 0:
+        return total
+    local = localIndex(offsets)
+    parents = np.repeat(np.arange(nEvents), counts)
+    for k in xrange(counts.max()):
+        sel = local == k
+        total[parents[sel]] += values[sel]
+    return total
+
+def segmentProd(values, offsets):
+    """Product per event along the last axis (values can hold several rows of
+    the same objects), multiplied in object order as the .prod() of the
+    per-event code does"""
+    counts  = np.diff(offsets)
+    nEvents = len(counts)
+    if nEvents == 1:
+        return values.prod(axis=-1)[..., np.newaxis]
+    total = np.ones(values.shape[:-1] + (nEvents,))
+    if nEvents == 0 or offsets[-1] == 0:
+        return total
+    local = localIndex(offsets)
+    parents = np.repeat(np.arange(nEvents), counts)
+    for k in xrange(counts.max()):
+        sel = local == k
+        total[..., parents[sel]] *= values[..., sel]
+    return total
+
+def phiMpiPi(x):
+    """Vectorized ROOT.TVector2.Phi_mpi_pi"""
+    x = np.array(x, dtype=float)
+    while True:
+        high = x >= math.pi
+        if not high.any(): break
+        x[high] -= 2*math.pi
+    while True:
+        low = x < -math.pi
+        if not low.any(): break
+        x[low] += 2*math.pi
+    return x
+
+def deltaPhi(phi1, phi2):
+    """Vectorized postprocessing.tools.deltaPhi"""
+    dphi = np.array(phi1 - phi2, dtype=float)
+    while True:
+        high = dphi > math.pi
+        if not high.any(): break
+        dphi[high] -= 2*math.pi
+    while True:
+        low = dphi < -math.pi
+        if not low.any(): break
+        dphi[low] += 2*math.pi
+    return dphi
+
+def calMtW(metpt, metphi, pt, phi):
+    return np.sqrt(2 * metpt * pt * (1 - np.cos(phiMpiPi(metphi - phi))))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Reading ~~~~~
+def readColumns(tree, collections, scalars, firstEntry, nEntries):
+    """Read the branches of a range of entries of a TTree in bulk with TTree::Draw.
+    collections is a dict {collection : [branch suffixes]} and scalars a list of
+    branch names. The tree should not be the one of the event loop, as Draw
+    moves its current entry."""
+    nEntries = min(nEntries, tree.GetEntries() - firstEntry)
+    batch = ColumnBatch(firstEntry, nEntries)
+
+    def draw(expr, nrows):
+        tree.SetEstimate(nrows + 1)
+        n = tree.Draw(expr, "", "goff", nEntries, firstEntry)
+        if n <= 0:
+            return np.zeros(0)
+        buf = tree.GetV1()
+        buf.SetSize(n)
+        return np.array(buf, dtype=float)
+
+    for name in scalars:
+        batch.columns[name] = draw(name, nEntries)
+    for coll, branches in collections.items():
+        counts = draw("n" + coll, nEntries).astype(np.int64)
+        batch.offsets[coll] = offsetsFromCounts(counts)
+        for br in branches:
+            batch.columns[coll + "_" + br] = draw(coll + "_" + br, batch.offsets[coll][-1])
+            batch.collectionOf[coll + "_" + br] = coll
+    return batch
+
+def scalarValue(val):
+    return ord(val) if type(val) == str else val # convert char to integer number
+
+class BatchReader(object):
+    """Provides the inputs of the current event as ColumnBatch. The branches of
+    the input file are read in ranges of batchSize entries. The branches filled
+    by a previous module of the chain are only visible through the event: they
+    are listed in upstream, and eventBatch() adds them to the batch of the
+    current event alone."""
+    def __init__(self, batchSize, collections, scalars):
+        self.batchSize   = batchSize
+        self.collections = collections
+        self.scalars     = scalars
+        self.upstream    = set()
+        self.inputFile   = None
+        self.tree        = None
+        self.batch       = None
+
+    def beginFile(self, inputFile, wrappedOutputTree):
+        """To be called before the module books its own output branches"""
+        ## The counters are booked with the arrays of the previous modules, but
+        ## they are not changed by them
+        booked = set(wrappedOutputTree._branches.keys())
+        self.upstream = set(name for name in self.scalars if name in booked)
+        for coll, branches in self.collections.items():
+            self.upstream.update(coll + "_" + br for br in branches if coll + "_" + br in booked)
+        self.fileCollections = dict((coll, [br for br in branches if coll + "_" + br not in self.upstream])
+                                    for coll, branches in self.collections.items())
+        self.fileScalars = [name for name in self.scalars if name not in self.upstream]
+        self.batch = None
+        self.inputFile = ROOT.TFile.Open(inputFile.GetName())
+        self.tree      = self.inputFile.Get("Events")
+        if not self.tree:
+            ## A friend tree read as input, see friendTree
+            self.tree  = self.inputFile.Get(FriendTreeName)
+
+    def endFile(self):
+        if self.inputFile:
+            self.inputFile.Close()
+        self.inputFile = None
+        self.tree      = None
+        self.batch     = None
+
+    def fromEvent(self, names):
+        """Whether any of the branches is filled by a previous module"""
+        return any(name in self.upstream for name in names)
+
+    def load(self, event):
+        """Return the batch of the input file branches holding the event, and
+        whether it was just read"""
+        if self.batch is not None and event._entry in self.batch:
+            return self.batch, False
+        self.batch = readColumns(self.tree, self.fileCollections, self.fileScalars, event._entry, self.batchSize)
+        return self.batch, True
+
+    def eventBatch(self, event):
+        """Batch of the current event alone, with all the inputs: the input file
+        branches sliced from the loaded batch, and the upstream ones read through
+        the event"""
+        single = self.batch.eventSlice(self.batch.index(event._entry))
+        for name in self.scalars:
+            if name in self.upstream:
+                single.columns[name] = np.array([scalarValue(getattr(event, name))], dtype=float)
+        for coll, branches in self.collections.items():
+            for br in branches:
+                if coll + "_" + br in self.upstream:
+                    single.columns[coll + "_" + br] = branchArray(getattr(event, coll + "_" + br), dtype=float)
+                    single.collectionOf[coll + "_" + br] = coll
+        return single
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Event arrays ~~~~~
+## ctypes of the TTreeReaderArray element types handled by branchArray
+ReaderArrayTypes = {
+    "float"         : ctypes.c_float,
+    "double"        : ctypes.c_double,
+    "int"           : ctypes.c_int,
+    "unsigned int"  : ctypes.c_uint,
+    "char"          : ctypes.c_byte,
+    "unsigned char" : ctypes.c_ubyte,
+    "bool"          : ctypes.c_bool,
+}
+
+_readerAddressDeclared = None
+def _declareReaderAddress():
+    """Compile the helper returning the address of the data of a TTreeReaderArray,
+    0 when it is empty or not contiguous in memory"""
+    global _readerAddressDeclared
+    if _readerAddressDeclared is None:
+        code = '#include "TTreeReaderArray.h"\nnamespace NanoSUSYArrayView {\n'
+        for ctype in ReaderArrayTypes:
+            code += "Long64_t address(TTreeReaderArray<%s>& a) { return (a.GetSize() > 0 && a.IsContiguous()) ? reinterpret_cast<Long64_t>(&a.At(0)) : 0; }\n" % ctype
+        code += "}\n"
+        try:
+            _readerAddressDeclared = bool(ROOT.gInterpreter.Declare(code))
+        except Exception:
+            _readerAddressDeclared = False
+    return _readerAddressDeclared
+
+def branchArray(ttarray, dtype=None):
+    """NumPy array of a TTreeReaderArray of the current event. When the data is
+    contiguous in memory, this is a view of the reader buffer (valid until the
+    next entry is read, and not to be modified), converted with a single NumPy
+    copy if dtype differs from the branch type. Otherwise, or for other
+    sequences, the elements are copied one by one."""
+    n = len(ttarray)
+    name = type(ttarray).__name__
+    ctype = None
+    if name.startswith("TTreeReaderArray<"):
+        ctype = ReaderArrayTypes.get(name[name.find("<")+1:name.rfind(">")].strip())
+    if n > 0 and ctype is not None and _declareReaderAddress():
+        address = ROOT.NanoSUSYArrayView.address(ttarray)
+        if address:
+            arr = np.ctypeslib.as_array((ctype * n).from_address(address))
+            if dtype is not None and arr.dtype != np.dtype(dtype):
+                arr = arr.astype(dtype)
+            return arr
+    ## Fall back to a copy through python
+    if dtype is None:
+        dtype = np.dtype(ctype) if ctype is not None else float
+    return np.fromiter((ttarray[i] for i in xrange(n)), dtype=dtype, count=n)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Writing ~~~~~
+def fillFromColumns(out, outputs, offsets, i):
+    """Fill the output branches of event i of a batch. outputs is a dict
+    {branch : (values, collection)}, collection being None for event variables"""
+    for name, (values, coll) in outputs.items():
+        if coll is None:
+            val = values[i].item()
+        else:
+            val = values[offsets[coll][i]:offsets[coll][i+1]].tolist()
+        out.fillBranch(name, val)
+
+def eventOutputs(outputs, offsets, i):
+    """Outputs of event i of a batch, as outputs of a batch of one event"""
+    single = {}
+    for name, (values, coll) in outputs.items():
+        if coll is None:
+            single[name] = (values[i:i+1], coll)
+        else:
+            single[name] = (values[offsets[coll][i]:offsets[coll][i+1]], coll)
+    return single
+
+class ColumnGroups(object):
+    """Outputs of a columnar path, computed by groups (inputs, outputs, function).
+    function(batch, outputs, cache) adds its output branches to outputs as
+    {branch : (values, collection)}, and the offsets of new collections to
+    batch.offsets. It reads the input branches from batch, and the outputs of
+    the previous groups from outputs. A group is computed once per batch,
+    unless one of its inputs is filled by a previous module of the chain (or
+    by a group computed per event): it is then computed for each event, on the
+    batch of this event alone."""
+    def __init__(self, batchReader, groups):
+        self.batchReader  = batchReader
+        self.groups       = groups
+        self.batchOutputs = None
+
+    def beginFile(self):
+        """To be called after the beginFile of the BatchReader"""
+        self.batchGroups = []
+        self.eventGroups = []
+        perEvent = set()
+        for inputs, outputs, function in self.groups:
+            if self.batchReader.fromEvent(inputs) or perEvent.intersection(inputs):
+                self.eventGroups.append(function)
+                perEvent.update(outputs)
+            else:
+                self.batchGroups.append(function)
+
+    def fill(self, out, event):
+        batch, isNew = self.batchReader.load(event)
+        if isNew:
+            self.batchOutputs = {}
+            cache = {}
+            for function in self.batchGroups:
+                function(batch, self.batchOutputs, cache)
+        i = batch.index(event._entry)
+        if not self.eventGroups:
+            fillFromColumns(out, self.batchOutputs, batch.offsets, i)
+            return
+        single  = self.batchReader.eventBatch(event)
+        outputs = eventOutputs(self.batchOutputs, batch.offsets, i)
+        cache = {}
+        for function in self.eventGroups:
+            function(single, outputs, cache)
+        fillFromColumns(out, outputs, single.offsets, 0)
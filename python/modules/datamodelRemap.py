@@ -1,4 +1,5 @@
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
 
 class ObjectRemapped(Object):
     def __init__(self, event, prefix, index=None, replaceMap=None):
@@ -28,3 +29,217 @@ class CollectionRemapped(Collection):
         return ret
 
         
+
+
+class RemappedObject(Object):
+    """Object reading through the bindings of a CompiledRemap. Values are cached
+    under the attribute name, so that a second read is a plain attribute access"""
+    _bindings = {}
+
+    def __getattr__(self, name):
+        if name[:1] == "_":
+            raise AttributeError(name)
+        branch = self._bindings.get(name)
+        val = getattr(self._event, branch if branch else self._prefix + name)
+        if self._index != None:
+            val = val[self._index]
+        val = ord(val) if type(val) == str else val # convert char to integer number
+        self.__dict__[name] = val
+        return val
+
+class RemappedCollection(Collection):
+    """Collection of RemappedObject. Attributes of the collection itself are the
+    NumPy arrays of the (remapped) branches, e.g. jets.pt for all the jets"""
+    def __init__(self, event, prefix, lenVar, remap):
+        Collection.__init__(self, event, prefix, lenVar)
+        self._remap = remap
+
+    def __getitem__(self, index):
+        if type(index) == int and index in self._cache: return self._cache[index]
+        if index >= self._len: raise IndexError, "Invalid index %r (len is %r) at %s" % (index,self._len,self._prefix)
+        ret = self._remap.objectClass(self._event, self._prefix, index=index)
+        if type(index) == int: self._cache[index] = ret
+        return ret
+
+    def __getattr__(self, name):
+        if name[:1] == "_":
+            raise AttributeError(name)
+        arr = branchArray(getattr(self._event, self._remap.branch(name)))
+        self.__dict__[name] = arr
+        return arr
+
+class CompiledRemap(object):
+    """Attribute to branch bindings of a remapped collection or object. They are
+    resolved once, and checked against the available branches with resolve()
+    in beginFile, instead of looking up the replaceMap at each access."""
+    def __init__(self, prefix, replaceMap=None, lenVar=None):
+        self.prefix = prefix
+        self.lenVar = lenVar
+        self.replaceMap = dict(replaceMap or {})
+        self.bindings = dict((attr, prefix + "_" + br) for attr, br in self.replaceMap.items())
+        class BoundObject(RemappedObject):
+            _bindings = self.bindings
+        self.objectClass = BoundObject
+
+    def branch(self, attr):
+        return self.bindings.get(attr, self.prefix + "_" + attr)
+
+    def resolve(self, branchNames):
+        """Check that the remapped branches exist, branchNames being the names of
+        the input branches and of the ones declared by the previous modules"""
+        missing = [br for br in self.bindings.values() if br not in branchNames]
+        if missing:
+            raise RuntimeError("Missing branches for the remapping of %s: %s" % (self.prefix, ", ".join(sorted(missing))))
+        return self
+
+    def collection(self, event):
+        return RemappedCollection(event, self.prefix, self.lenVar, self)
+
+    def object(self, event):
+        return self.objectClass(event, self.prefix)
+
+def treeBranches(tree):
+    """Names of the branches of a tree and of its friends (e.g. the parent of a
+    friend tree read as input)"""
+    names = set(br.GetName() for br in tree.GetListOfBranches())
+    for friendElement in tree.GetListOfFriends() or []:
+        friend = friendElement.GetTree()
+        if friend:
+            names.update(treeBranches(friend))
+    return names
+
+def availableBranches(inputTree, wrappedOutputTree):
+    """Names of the branches readable from the event in beginFile"""
+    names = treeBranches(inputTree)
+    names.update(wrappedOutputTree._branches.keys())
+    return names
+
+def _mapKey(replaceMap):
+    return tuple(sorted(replaceMap.items())) if replaceMap else None
+
+_compiledRemaps = {}
+def compileRemap(prefix, replaceMap=None, lenVar=None):
+    """CompiledRemap of a prefix and replaceMap, built once per job"""
+    key = (prefix, lenVar, _mapKey(replaceMap))
+    if key not in _compiledRemaps:
+        _compiledRemaps[key] = CompiledRemap(prefix, replaceMap, lenVar)
+    return _compiledRemaps[key]
+
+## Jet and MET branch replacement for each systematic variation, together with
+## the suffix of the branches produced for it. None is the nominal.
+VariationRemap = {
+    None             : {"suffix" : "",
+                        "Jet"    : None,
+                        "MET"    : None},
+    "JESUp"          : {"suffix" : "_JESUp",
+                        "Jet"    : {"pt":"pt_jesTotalUp", "mass":"mass_jesTotalUp"},
+                        "MET"    : {"pt":"pt_jesTotalUp", "phi":"phi_jesTotalUp"}},
+    "JESDown"        : {"suffix" : "_JESDown",
+                        "Jet"    : {"pt":"pt_jesTotalDown", "mass":"mass_jesTotalDown"},
+                        "MET"    : {"pt":"pt_jesTotalDown", "phi":"phi_jesTotalDown"}},
+    "METUnClustUp"   : {"suffix" : "_METUnClustUp",
+                        "Jet"    : None,
+                        "MET"    : {"pt":"pt_unclustEnUp", "phi":"phi_unclustEnUp"}},
+    "METUnClustDown" : {"suffix" : "_METUnClustDown",
+                        "Jet"    : None,
+                        "MET"    : {"pt":"pt_unclustEnDown", "phi":"phi_unclustEnDown"}},
+}
+
+def parseVariations(applyUncert):
+    """Return the list of variations requested by applyUncert, which is either a
+    single variation (None for nominal) or a list of them ("nominal" for nominal)"""
+    if isinstance(applyUncert, (list, tuple)):
+        variations = [None if v == "nominal" else v for v in applyUncert]
+    else:
+        variations = [applyUncert]
+    for v in variations:
+        if v not in VariationRemap:
+            raise ValueError("Unknown systematic variation %r" % v)
+    return variations
+
+
+class ObjectView(object):
+    """Remapped view of an already loaded Object: attribute reads go through the
+    replaceMap to the underlying Object, so that all the variations of an event
+    share its cache and each branch is read only once"""
+    def __init__(self, obj, replaceMap):
+        self._obj = obj
+        self._replaceMap = replaceMap
+
+    def __getattr__(self, attr):
+        if attr[:2] == "__" and attr[-2:] == "__":
+            raise AttributeError(attr)
+        return getattr(self._obj, self._replaceMap.get(attr, attr))
+
+def remapView(objs, replaceMap):
+    """ObjectView of an Object, or list of ObjectViews of a Collection"""
+    if not replaceMap:
+        return objs
+    if isinstance(objs, Object):
+        return ObjectView(objs, replaceMap)
+    return [ObjectView(o, replaceMap) for o in objs]
+
+
+## Per-event cache of the Collections and Objects, shared by the modules which
+## use cachedCollection/cachedObject instead of building their own. It is kept
+## on the event and emptied when the entry changes. Branch values read through
+## a cached object stay cached for the rest of the event, so a module rewriting
+## branches of a collection must call invalidateCache after filling them.
+ObjectCacheStats = {}
+
+def _eventCache(event):
+    cache = event.__dict__.get("_objectCache")
+    if cache is None or cache[0] != event._entry:
+        cache = (event._entry, {})
+        event.__dict__["_objectCache"] = cache
+    return cache[1]
+
+def _cached(event, key, build):
+    cache = _eventCache(event)
+    stats = ObjectCacheStats.setdefault(key, [0, 0])
+    if key in cache:
+        stats[0] += 1
+        return cache[key]
+    stats[1] += 1
+    obj = cache[key] = build()
+    return obj
+
+def cachedCollection(event, prefix, lenVar=None, replaceMap=None):
+    """Collection (or RemappedCollection) shared by all the modules for this event"""
+    def build():
+        if replaceMap:
+            return compileRemap(prefix, replaceMap, lenVar).collection(event)
+        return Collection(event, prefix, lenVar)
+    return _cached(event, ("Collection", prefix, lenVar, _mapKey(replaceMap)), build)
+
+def cachedObject(event, prefix, replaceMap=None):
+    """Object (or RemappedObject) shared by all the modules for this event"""
+    def build():
+        if replaceMap:
+            return compileRemap(prefix, replaceMap).object(event)
+        return Object(event, prefix)
+    return _cached(event, ("Object", prefix, None, _mapKey(replaceMap)), build)
+
+def cachedEventData(event, kind, prefix, build):
+    """Data derived from the collection prefix (built by build()), shared by all
+    the modules for this event and dropped with the objects of prefix"""
+    return _cached(event, (kind, prefix, None, None), build)
+
+def invalidateCache(event, prefix=None):
+    """Drop the cached objects of a collection (all of them if prefix is None)"""
+    cache = _eventCache(event)
+    for key in cache.keys():
+        if prefix is None or key[1] == prefix:
+            del cache[key]
+
+def printObjectCacheStats():
+    if not ObjectCacheStats:
+        return
+    print "%-12s %-32s %10s %10s" % ("Type", "Name", "Hits", "Misses")
+    totHits, totMisses = 0, 0
+    for (kind, prefix, lenVar, replaceMap), (hits, misses) in sorted(ObjectCacheStats.items()):
+        name = prefix + ("[%s]" % ",".join("%s->%s" % kv for kv in replaceMap) if replaceMap else "")
+        print "%-12s %-32s %10d %10d" % (kind, name, hits, misses)
+        totHits   += hits
+        totMisses += misses
+    print "Object cache: %d hits, %d misses" % (totHits, totMisses)
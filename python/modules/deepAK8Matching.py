@@ -0,0 +1,85 @@
+import math
+import numpy as np
+
+## Gen matching of the DeepAK8 fat jets, on jagged arrays: the fat jets and the
+## gen particles of a batch of events are flat arrays with their offsets
+## (offsets[i]:offsets[i+1] are the objects of event i; a single event has the
+## offsets [0, n]). Each (fat jet, gen particle) dR is computed in the loops of
+## the kernels, without the meshgrid copies of the original code, and with the
+## same floating point operations, so that the matches are unchanged. The
+## kernels are compiled with numba when it is available.
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+## FatJet_GenMatch values
+GenMatchNone = 0
+GenMatchTop  = 1
+GenMatchW    = 2
+
+@njit(cache=True)
+def minGroupMaxDR(fatJetOffsets, fatJetEta, fatJetPhi, dauOffsets, dauEta, dauPhi, groupSize):
+    """For each fat jet, the smallest over the decays of its event of the largest
+    dR to the groupSize daughters of the decay (consecutive in dau*), inf if
+    the event has no decay"""
+    out = np.full(len(fatJetEta), np.inf)
+    for iEvt in range(len(fatJetOffsets) - 1):
+        d0 = dauOffsets[iEvt]
+        nGroups = (dauOffsets[iEvt + 1] - d0) // groupSize
+        for j in range(fatJetOffsets[iEvt], fatJetOffsets[iEvt + 1]):
+            best = np.inf
+            for g in range(nGroups):
+                worst = 0.
+                for d in range(d0 + g * groupSize, d0 + (g + 1) * groupSize):
+                    ## As in the original deltaRMatch, the squared deta is squared
+                    ## again: the "dR" is sqrt(dphi^2 + deta^4)
+                    deta = fatJetEta[j] - dauEta[d]
+                    deta = deta * deta
+                    dphi = abs(abs(fatJetPhi[j] - dauPhi[d]) - math.pi) - math.pi
+                    dR2 = dphi * dphi + deta * deta
+                    if dR2 > worst:
+                        worst = dR2
+                if worst < best:
+                    best = worst
+            ## sqrt is monotonic, so that it commutes with the min and max
+            out[j] = math.sqrt(best)
+    return out
+
+@njit(cache=True)
+def countWithinDR(fatJetOffsets, fatJetEta, fatJetPhi, partOffsets, partEta, partPhi, dR2Max):
+    """Number of gen particles of its event within dR2 < dR2Max of each fat jet"""
+    out = np.zeros(len(fatJetEta), np.int64)
+    for iEvt in range(len(fatJetOffsets) - 1):
+        for j in range(fatJetOffsets[iEvt], fatJetOffsets[iEvt + 1]):
+            n = 0
+            for p in range(partOffsets[iEvt], partOffsets[iEvt + 1]):
+                deta = fatJetEta[j] - partEta[p]
+                dphi = fatJetPhi[j] - partPhi[p]
+                if dphi >= math.pi:
+                    dphi -= 2*math.pi
+                if dphi < -1*math.pi:
+                    dphi += 2*math.pi
+                if deta * deta + dphi * dphi < dR2Max:
+                    n += 1
+            out[j] = n
+    return out
+
+
+def fatJetGenMatchType(fatJetOffsets, fatJetEta, fatJetPhi, topOffsets, topDauEta, topDauPhi, wOffsets, wDauEta, wDauPhi, dRMax=0.6):
+    """FatJet_GenMatch: GenMatchTop if the 3 quarks of a hadronic top decay are
+    within dRMax of the fat jet, else GenMatchW for the 2 quarks of a W"""
+    matches = np.zeros(len(fatJetEta), dtype=int)
+    matches[minGroupMaxDR(fatJetOffsets, fatJetEta, fatJetPhi, wOffsets, wDauEta, wDauPhi, 2) < dRMax] = GenMatchW
+    matches[minGroupMaxDR(fatJetOffsets, fatJetEta, fatJetPhi, topOffsets, topDauEta, topDauPhi, 3) < dRMax] = GenMatchTop
+    return matches
+
+def fatJetGenPartCount(fatJetOffsets, fatJetEta, fatJetPhi, partOffsets, partEta, partPhi, dRMax=0.6):
+    """FatJet_nGenPart: number of gen particles within dRMax of the fat jet"""
+    return countWithinDR(fatJetOffsets, fatJetEta, fatJetPhi, partOffsets, partEta, partPhi, dRMax*dRMax)
+
+def eventOffsets(n):
+    return np.array([0, n], dtype=np.int64)
@@ -0,0 +1,147 @@
+import os
+import hashlib
+import numpy as np
+
+## NumPy copies of the efficiency and scale factor graphs and histograms, read
+## once when a module is constructed, so that the per-event lookups are
+## searchsorted calls on arrays instead of ROOT calls. The lookups take arrays
+## of values, of one event or of a batch of events.
+
+## The tables derived from the efficiency files (ratios of numerator and
+## denominator histograms) are built once per job for each (file, sample, name),
+## and shared by the modules and the input files. With EffCacheDir set (by
+## default from $NANOSUSY_EFFCACHE), they are also written there as small NPZ
+## files, keyed by the efficiency file and its modification time, so that the
+## later jobs read them without opening the ROOT files.
+EffCacheDir = os.environ.get("NANOSUSY_EFFCACHE")
+## To be increased when the content of the tables changes
+EffCacheVersion = 1
+
+## Upper edge closing the last point of a graph
+GraphOverflowEdge = 99999
+
+def graphTable(graph):
+    """Points of a TGraphAsymmErrors as the dict {"edges", "central", "down",
+    "up"}: the lower edges x - exlow of the points, closed by GraphOverflowEdge,
+    the y of the points and y - eylow, y + eyhigh"""
+    n = graph.GetN()
+    x       = np.array([graph.GetX()[i] - graph.GetErrorXlow(i) for i in xrange(n)], dtype=float)
+    central = np.array([graph.GetY()[i] for i in xrange(n)], dtype=float)
+    return {
+        "edges":   np.append(x, GraphOverflowEdge),
+        "central": central,
+        "down":    central - np.array([graph.GetErrorYlow(i) for i in xrange(n)], dtype=float),
+        "up":      central + np.array([graph.GetErrorYhigh(i) for i in xrange(n)], dtype=float),
+    }
+
+def graphPoint(table, x):
+    """Point of the graph of each x, -1 below the first edge or for NaN"""
+    x = np.asarray(x, dtype=float)
+    idx = np.searchsorted(table["edges"], x) - 1
+    idx = np.minimum(idx, len(table["central"]) - 1)
+    return np.where(np.isnan(x), -1, idx)
+
+def graphValues(table, idx):
+    """(central, down, up) of the points idx of graphPoint, 0 for -1"""
+    found = idx >= 0
+    safe  = np.maximum(idx, 0)
+    return tuple(np.where(found, table[k][safe], 0.) for k in ("central", "down", "up"))
+
+def graphLookup(table, x):
+    """(central, down, up) of the graph at each x, 0 where there is no point"""
+    return graphValues(table, graphPoint(table, x))
+
+def hist1DTable(hist):
+    """Contents of the bins of a TH1 with variable bins, and their edges"""
+    return {
+        "edges":  np.fromiter(hist.GetXaxis().GetXbins(), dtype=float),
+        "values": np.array([hist.GetBinContent(iBin) for iBin in xrange(1, hist.GetNbinsX() + 1)], dtype=float),
+    }
+
+def axisTable(axis):
+    """Binning of a TAxis: the low edges of its bins closed by its maximum, and
+    whether the bins are uniform (FindBin then computes the bin from the width)"""
+    n = axis.GetNbins()
+    edges = np.array([axis.GetBinLowEdge(i) for i in xrange(1, n + 1)] + [axis.GetXmax()], dtype=float)
+    return {"edges": edges, "uniform": axis.GetXbins().GetSize() == 0}
+
+def axisBins(table, x):
+    """Bin of each x as TAxis::FindBin: 0 below the axis, nbins + 1 above it"""
+    edges = table["edges"]
+    n = len(edges) - 1
+    x = np.asarray(x, dtype=float)
+    inside = (x >= edges[0]) & (x < edges[-1])
+    if table["uniform"]:
+        bins = 1 + (n * (np.where(inside, x, edges[0]) - edges[0]) / (edges[-1] - edges[0])).astype(np.int64)
+    else:
+        bins = np.searchsorted(edges, x, side="right")
+    return np.where(x < edges[0], 0, np.where(inside, bins, n + 1))
+
+def hist2DTable(hist):
+    """Contents of a TH2, with the under and overflow bins, and its binning"""
+    xTable, yTable = axisTable(hist.GetXaxis()), axisTable(hist.GetYaxis())
+    nx, ny = len(xTable["edges"]) - 1, len(yTable["edges"]) - 1
+    values = np.array([[hist.GetBinContent(ix, iy) for iy in xrange(ny + 2)] for ix in xrange(nx + 2)], dtype=float)
+    return {"x": xTable, "y": yTable, "values": values}
+
+def hist2DLookup(table, x, y):
+    """Content of the bin of each (x, y), the values above an axis being read
+    in its last bin"""
+    nx, ny = table["values"].shape[0] - 2, table["values"].shape[1] - 2
+    ix = np.minimum(axisBins(table["x"], x), nx)
+    iy = np.minimum(axisBins(table["y"], y), ny)
+    return table["values"][ix, iy]
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Caching ~~~~~
+_cachedTables = {}
+
+def _flattenTable(table, prefix=""):
+    arrays = {}
+    for key, value in table.items():
+        if isinstance(value, dict):
+            arrays.update(_flattenTable(value, prefix + key + "."))
+        else:
+            arrays[prefix + key] = np.asarray(value)
+    return arrays
+
+def _unflattenTable(arrays):
+    table = {}
+    for name, value in arrays.items():
+        keys = name.split(".")
+        node = table
+        for key in keys[:-1]:
+            node = node.setdefault(key, {})
+        node[keys[-1]] = value if value.ndim else value.item()
+    return table
+
+def effCacheFile(key, fileName):
+    st = os.stat(fileName)
+    digest = hashlib.sha1(repr(key + (st.st_mtime, st.st_size, EffCacheVersion))).hexdigest()
+    return os.path.join(EffCacheDir, "%s_%s_%s.npz" % (key[2], key[1], digest[:16]))
+
+def cachedEffTable(fileName, sample, name, build):
+    """Table (nested dicts of arrays) built by build() from the efficiency file
+    fileName for sample, built or read from EffCacheDir once per job. The table
+    is shared, and must not be modified."""
+    key = (os.path.abspath(fileName), sample, name)
+    if key in _cachedTables:
+        return _cachedTables[key]
+    cacheFile = effCacheFile(key, fileName) if EffCacheDir else None
+    if cacheFile and os.path.exists(cacheFile):
+        with np.load(cacheFile) as arrays:
+            table = _unflattenTable(dict((arrayName, arrays[arrayName]) for arrayName in arrays.files))
+    else:
+        table = build()
+        if cacheFile:
+            try:
+                os.makedirs(EffCacheDir)
+            except OSError:
+                if not os.path.isdir(EffCacheDir):
+                    raise
+            ## Written under a temporary name, as several jobs can share the directory
+            tmpFile = "%s.%d.tmp" % (cacheFile, os.getpid())
+            with open(tmpFile, "wb") as f:
+                np.savez(f, **_flattenTable(table))
+            os.rename(tmpFile, cacheFile)
+    _cachedTables[key] = table
+    return table
@@ -4,8 +4,12 @@ import re
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
 
 class eleMiniCutIDProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Electron")
+
     def __init__(self):
         self.eleCuts = []
         self.nbit = 0
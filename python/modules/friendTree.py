@@ -0,0 +1,142 @@
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+import os
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+
+## Friend tree output: with PostProcessor(friend=True), only the branches booked
+## by the modules are written, to a "Friends" tree. FriendIndexProducer stores
+## the run, lumi, event and entry of the parent event of each entry, and attaches
+## the input file to the friend tree as its friend "Parent".
+##
+## A later stage reads the friend files instead of the input files (see
+## friendFiles): the friend tree is then the main tree, so the branches rewritten
+## by the modules under their input names (as MET_pt, Jet_jetId or GenPart_*)
+## are read before those of the parent, and the PostProcessor cut sees the
+## branches of both. Its output is again a friend tree, of the friend tree read.
+##
+## Each friend tree is indexed on the parent run and event: when it is the
+## parent of a later friend tree which skips entries (e.g. with a cut), ROOT
+## finds its entries with the index. A NanoAOD parent has no index, so the
+## friend trees of the NanoAOD files must keep all their entries.
+
+FriendTreeName = "Friends"
+FriendPostfix  = "_Friend"
+ParentAlias    = "Parent"
+
+## (friend branch, parent branch, type)
+ParentIndexBranches = [
+    ("parentRun",             "run",             "i"),
+    ("parentLuminosityBlock", "luminosityBlock", "i"),
+    ("parentEvent",           "event",           "l"),
+]
+IndexBranchNames = [friendBr for friendBr, parentBr, brtype in ParentIndexBranches] + ["parentEntry"]
+
+def friendFileName(inputFileName, friendDir, postfix=FriendPostfix):
+    """Friend file written by PostProcessor(friend=True) for an input file"""
+    return os.path.join(friendDir, os.path.basename(inputFileName).replace(".root", postfix + ".root"))
+
+def friendFiles(inputFileNames, friendDir, postfix=FriendPostfix):
+    """Friend files of the input files, to be read instead of them"""
+    return [friendFileName(name, friendDir, postfix) for name in inputFileNames]
+
+def parentFileName(inputFile):
+    """Name of an input file with which the friend tree opens it again: local
+    files by their absolute path"""
+    name = inputFile.GetName()
+    if "://" in name:
+        return name
+    return os.path.abspath(name)
+
+def validateFriend(tree):
+    """Check that the parent of a friend tree read as the main tree is attached,
+    and that it holds the parent events of its entries. Raise RuntimeError if
+    not."""
+    if not tree.GetListOfBranches().FindObject("parentEntry"):
+        raise RuntimeError("Tree %s has no parent index, it should be a friend tree written with FriendIndexProducer" % tree.GetName())
+    parent = tree.GetFriend(ParentAlias)
+    if not parent:
+        raise RuntimeError("Cannot open the parent of friend tree %s in %s" % (tree.GetName(), tree.GetCurrentFile().GetName()))
+    if not parent.GetTreeIndex() and parent.GetEntries() < tree.GetEntries():
+        raise RuntimeError("Friend tree %s has %d entries, its parent %d" % (tree.GetName(), tree.GetEntries(), parent.GetEntries()))
+    ## The parent branches are found in the parent of the parent if needed
+    mismatch = " || ".join("%s != %s" % (friendBr, parentBr) for friendBr, parentBr, brtype in ParentIndexBranches)
+    nBad = tree.GetEntries(mismatch)
+    if nBad:
+        raise RuntimeError("%d entries of friend tree %s are not aligned with their parent events" % (nBad, tree.GetName()))
+
+
+class FriendIndexProducer(Module):
+    """Store the index of the parent events in a friend tree, and attach the
+    input file to it as its parent. To be the first module. A NanoAOD input has
+    no index, so all its entries must be written: rejecting an event, or a
+    PostProcessor cut, raises. The entries of a friend tree input may be
+    skipped."""
+    ## Input branches read, see branchSelection
+    inputBranches = ["run", "luminosityBlock", "event"]
+
+    def __init__(self):
+        pass
+
+    def beginJob(self):
+        pass
+    def endJob(self):
+        pass
+
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.nEvents = 0
+        self.indexedParent = inputTree.GetName() == FriendTreeName
+        for friendBr, parentBr, brtype in ParentIndexBranches:
+            self.out.branch(friendBr, brtype)
+        self.out.branch("parentEntry", "L")
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        tree = wrappedOutputTree.tree()
+        nWritten = tree.GetEntries()
+        if nWritten != self.nEvents and not self.indexedParent:
+            raise RuntimeError("Friend tree of %s has %d entries for %d input events: a module rejected events, the friend is not aligned with its parent"
+                               % (inputFile.GetName(), nWritten, self.nEvents))
+        outputFile.cd()
+        if nWritten:
+            tree.BuildIndex("parentRun", "parentEvent")
+        tree.AddFriend("%s=%s" % (ParentAlias, inputTree.GetName()), parentFileName(inputFile))
+        outputFile.cd()
+
+    def analyze(self, event):
+        if event._entry != self.nEvents and not self.indexedParent:
+            raise RuntimeError("Entry %d of the input read as entry %d of its friend tree: the input is skimmed, the friend is not aligned with its parent"
+                               % (event._entry, self.nEvents))
+        self.nEvents += 1
+        for friendBr, parentBr, brtype in ParentIndexBranches:
+            self.out.fillBranch(friendBr, getattr(event, parentBr))
+        self.out.fillBranch("parentEntry", event._entry)
+        return True
+
+
+class FriendTreeReader(Module):
+    """Check that the input files are friend trees, with their parent attached
+    and aligned. The modules and the PostProcessor cut read the branches of the
+    friend tree before those of its parents, which are not copied to the
+    output: write it as a friend tree too, with FriendIndexProducer."""
+    ## Input branches read, see branchSelection
+    inputBranches = ["run", "luminosityBlock", "event"] + IndexBranchNames
+
+    def __init__(self):
+        pass
+
+    def beginJob(self):
+        pass
+    def endJob(self):
+        pass
+
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        if inputTree.GetName() != FriendTreeName:
+            raise RuntimeError("Input %s is not a friend tree, its tree is %s" % (inputFile.GetName(), inputTree.GetName()))
+        validateFriend(inputTree)
+
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        pass
+
+    def analyze(self, event):
+        return True
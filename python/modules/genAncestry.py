@@ -0,0 +1,115 @@
+import numba
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import cachedEventData
+
+## Gen-level ancestry of the GenPart collection, built once per event and shared
+## by the modules through the per-event object cache of datamodelRemap (it is
+## dropped with the GenPart objects by invalidateCache). The ancestor lookups
+## are linear passes over the mother indices, each chain being walked once.
+
+@numba.jit(nopython=True)
+def nearestAncestorIn(mother, mask):
+    """For each particle, the nearest ancestor (mother, grandmother, ...) in
+    mask, or the negative mother index ending its chain if there is none"""
+    n = len(mother)
+    out = np.empty(n, np.int64)
+    done = np.zeros(n, np.bool_)
+    stack = np.empty(n + 1, np.int64)
+    for i in range(n):
+        if done[i]:
+            continue
+        depth = 0
+        j = i
+        while not done[j]:
+            stack[depth] = j
+            depth += 1
+            m = mother[j]
+            if m < 0 or m >= n or mask[m] or depth > n:
+                out[j] = m if depth <= n else -1
+                done[j] = True
+                break
+            j = m
+        ## The last node is resolved, or its mother was resolved before
+        last = stack[depth - 1]
+        if not done[last]:
+            out[last] = out[j]
+            done[last] = True
+        for k in range(depth - 2, -1, -1):
+            out[stack[k]] = out[stack[k + 1]]
+            done[stack[k]] = True
+    return out
+
+
+class GenAncestry(object):
+    """Mother chains of the gen particles of an event"""
+    def __init__(self, event):
+        self.mother      = branchArray(event.GenPart_genPartIdxMother, dtype=np.int64)
+        self.pdgId       = branchArray(event.GenPart_pdgId,            dtype=np.int64)
+        self.statusFlags = branchArray(event.GenPart_statusFlags,      dtype=np.int64)
+        self.absPdgId    = np.abs(self.pdgId)
+        self._nearest    = {}
+
+    def __len__(self):
+        return len(self.mother)
+
+    def hasFlags(self, flags):
+        return (self.statusFlags & flags) == flags
+
+    def nearestFilteredAncestor(self, mask, key=None):
+        """Index of the nearest ancestor of each particle passing mask, negative
+        if none. Lookups with the same key are computed once per event."""
+        if key is not None and key in self._nearest:
+            return self._nearest[key]
+        nearest = nearestAncestorIn(self.mother, np.asarray(mask, dtype=np.bool_))
+        if key is not None:
+            self._nearest[key] = nearest
+        return nearest
+
+    def descendsFrom(self, mask, key=None):
+        """Whether each particle has an ancestor passing mask"""
+        return self.nearestFilteredAncestor(mask, key) >= 0
+
+    def decayDaughters(self, motherMask, daughterMask, key=None):
+        """Daughters passing daughterMask of each particle passing motherMask,
+        at any depth of the decay chain: {mother : [daughters, increasing]}"""
+        nearest = self.nearestFilteredAncestor(motherMask, key)
+        daughters = dict((i, []) for i in np.nonzero(motherMask)[0])
+        for d in np.nonzero(daughterMask)[0]:
+            m = nearest[d]
+            while m >= 0:
+                daughters[m].append(d)
+                m = nearest[m]
+        return daughters
+
+    def slimmedMothers(self, mask):
+        """Mother indices of the particles passing mask, within the collection of
+        these particles only: each mother is replaced by its nearest ancestor
+        passing mask, then re-indexed with the cumulative count of mask"""
+        newIdx = np.cumsum(mask) - 1
+        mothers = self.nearestFilteredAncestor(mask)[mask]
+        return np.where(mothers >= 0, newIdx[np.maximum(mothers, 0)], mothers)
+
+    def hardProcessDecays(self):
+        """Hard process quarks of the hadronic top and W decays, as the flat lists
+        (topDaughters, WDaughters) in groups of 3 and 2, in the order of the tops
+        and Ws. Only tops and Ws with a mother are considered."""
+        # statusFlag 0x2100 corresponds to "isLastCopy and fromHardProcess"
+        hard = self.hasFlags(0x2100)
+        quarks = hard & (self.absPdgId >= 1) & (self.absPdgId <= 5)
+        resonances = hard & ((self.absPdgId == 6) | (self.absPdgId == 24)) & (self.mother >= 0)
+        daughters = self.decayDaughters(resonances, quarks, key="hardTopW")
+
+        topDaughters, WDaughters = [], []
+        for i in sorted(daughters):
+            if self.absPdgId[i] == 6 and len(daughters[i]) == 3:
+                topDaughters.extend(daughters[i])
+            elif self.absPdgId[i] == 24 and len(daughters[i]) == 2:
+                WDaughters.extend(daughters[i])
+        return topDaughters, WDaughters
+
+
+def genAncestry(event):
+    """GenAncestry of the event, shared by all the modules"""
+    return cachedEventData(event, "GenAncestry", "GenPart", lambda: GenAncestry(event))
@@ -6,9 +6,14 @@ ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import cachedCollection
 from TauPOG.TauIDSFs.TauIDSFTool import TauIDSFTool
 
 class lepSFProducer(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Muon", "Electron", "Photon", "Tau", "GenPart")
+
     """ This module is copied from the NanoAOD-tools,
     but developed for lastest SUSY Lepton ID
     """
@@ -169,11 +174,11 @@ class lepSFProducer(Module):
 
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
-        muons     = Collection(event, "Muon")
-        electrons = Collection(event, "Electron")
-        photons   = Collection(event, "Photon")
-        taus      = Collection(event, "Tau")
-        gens      = Collection(event, "GenPart")
+        muons     = cachedCollection(event, "Muon")
+        electrons = cachedCollection(event, "Electron")
+        photons   = cachedCollection(event, "Photon")
+        taus      = cachedCollection(event, "Tau")
+        gens      = cachedCollection(event, "GenPart")
 
         sf_el = [ self._worker_el.getSF(el.pdgId,el.pt,el.eta) for el in electrons ]
         if self.era == "2016":
@@ -0,0 +1,137 @@
+import os
+import time
+import json
+import resource
+
+## Opt-in profiling of the modules of a PostProcessor chain. profileModules
+## wraps each module to record, per module instance, the wall time and number
+## of calls of analyze/beginFile/endFile, the events it rejected, and the
+## increase of the peak RSS of the process during its calls. The summary is
+## printed at endJob and written to a JSON file next to the output file.
+
+ProfiledMethods = ["beginJob", "endJob", "beginFile", "endFile", "analyze"]
+
+def peakRSS():
+    """Peak resident memory of the process, in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+def moduleLabel(module):
+    """Class name of the module, with its systematic variation if any"""
+    label = module.__class__.__name__
+    for attr in ("applyUncert", "suffix"):
+        variation = getattr(module, attr, None)
+        if variation and isinstance(variation, str):
+            return "%s_%s" % (label, variation.lstrip("_"))
+    return label
+
+
+class ModuleStats(object):
+    def __init__(self, label):
+        self.label    = label
+        self.calls    = dict((method, 0) for method in ProfiledMethods)
+        self.time     = dict((method, 0.) for method in ProfiledMethods)
+        self.rejected = 0
+        self.rssDelta = 0.
+
+    def toDict(self):
+        return {"module"   : self.label,
+                "calls"    : self.calls,
+                "time"     : self.time,
+                "rejected" : self.rejected,
+                "rssDelta" : self.rssDelta}
+
+
+class ProfiledModule(object):
+    """Module wrapper timing the calls of the framework; everything else is
+    forwarded to the module"""
+    def __init__(self, module, stats):
+        self.module = module
+        self.stats  = stats
+
+    def __getattr__(self, attr):
+        return getattr(self.module, attr)
+
+    def _call(self, method, *args, **kwargs):
+        rss = peakRSS()
+        start = time.time()
+        ret = getattr(self.module, method)(*args, **kwargs)
+        self.stats.time[method] += time.time() - start
+        self.stats.calls[method] += 1
+        self.stats.rssDelta += peakRSS() - rss
+        return ret
+
+    def beginJob(self, *args, **kwargs):
+        return self._call("beginJob", *args, **kwargs)
+    def endJob(self):
+        return self._call("endJob")
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        return self._call("beginFile", inputFile, outputFile, inputTree, wrappedOutputTree)
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        return self._call("endFile", inputFile, outputFile, inputTree, wrappedOutputTree)
+    def analyze(self, event):
+        ret = self._call("analyze", event)
+        if not ret:
+            self.stats.rejected += 1
+        return ret
+
+
+class ProfileReport(object):
+    """Last module of a profiled chain: prints the summary and writes it to a
+    JSON file at endJob"""
+    def __init__(self, stats, jsonFile=None):
+        self.stats         = stats
+        self.jsonFile      = jsonFile
+        self.outputFiles   = []
+        self.writeHistFile = False
+
+    def beginJob(self, *args, **kwargs):
+        self.start = time.time()
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        pass
+    def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        if outputFile:
+            self.outputFiles.append(outputFile.GetName())
+    def analyze(self, event):
+        return True
+
+    def endJob(self):
+        wallTime = time.time() - self.start
+        nEvents  = self.stats[0].calls["analyze"] if self.stats else 0
+        totTime  = sum(sum(s.time.values()) for s in self.stats)
+
+        print "Module profile: %d events in %.1f s, %.1f Hz, peak RSS %.0f MB" % (nEvents, wallTime,
+                nEvents / wallTime if wallTime > 0 else 0., peakRSS())
+        print "  %-40s %10s %10s %8s %10s %10s %10s" % ("module", "events", "rejected", "ms/evt", "beginFile", "total s", "RSS MB")
+        for s in sorted(self.stats, key=lambda s: -sum(s.time.values())):
+            nCalls = s.calls["analyze"]
+            print "  %-40s %10d %10d %8.3f %10.2f %10.2f %10.1f" % (s.label, nCalls, s.rejected,
+                    1000. * s.time["analyze"] / nCalls if nCalls else 0., s.time["beginFile"], sum(s.time.values()), s.rssDelta)
+        print "  %-40s %10s %10s %8s %10s %10.2f" % ("all modules", "", "", "", "", totTime)
+
+        jsonFile = self.jsonFile
+        if jsonFile is None and self.outputFiles:
+            jsonFile = os.path.splitext(self.outputFiles[-1])[0] + "_profile.json"
+        if jsonFile:
+            with open(jsonFile, "w") as f:
+                json.dump({"events"      : nEvents,
+                           "wallTime"    : wallTime,
+                           "peakRSS"     : peakRSS(),
+                           "outputFiles" : self.outputFiles,
+                           "modules"     : [s.toDict() for s in self.stats]}, f, indent=2)
+            print "Module profile written to %s" % jsonFile
+
+
+def profileModules(mods, jsonFile=None):
+    """Wrap the modules of a chain for profiling, and append the ProfileReport.
+    Without jsonFile, the summary is written next to the last output file."""
+    stats, labels = [], {}
+    profiled = []
+    for mod in mods:
+        label = moduleLabel(mod)
+        labels[label] = labels.get(label, 0) + 1
+        if labels[label] > 1:
+            label += "#%d" % labels[label]
+        stats.append(ModuleStats(label))
+        profiled.append(ProfiledModule(mod, stats[-1]))
+    profiled.append(ProfileReport(stats, jsonFile))
+    return profiled
@@ -14,6 +14,9 @@ from rootpy.tree import Tree, TreeModel, IntCol, FloatArrayCol
 
 
 class qcdBootstrapProducer(Module): 
+    ## Input branches read, see branchSelection
+    inputBranches = []
+
     def __init__(self):
         self.writeHistFile=True
         self.nBootstraps = 100
@@ -8,6 +8,7 @@ from os import system, environ
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 #import "$CMSSW_BASE/src/AnalysisTools/QuickRefold/interface/TObjectContainer.h"
 
 class qcdSFProducer(Module): 
@@ -30,7 +31,7 @@ class qcdSFProducer(Module):
 	pass 
 
     def loadhisto(self,filename,hname):
-        file =ROOT.TFile.Open(filename)
+        file =openCalibFile(filename)
         hist_ = file.Get(hname)
         hist_.SetDirectory(0)
         return hist_
@@ -9,6 +9,7 @@ from os import system, environ
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import *
 from rootpy.tree import Tree, TreeModel, IntCol, FloatArrayCol
 
@@ -35,7 +36,7 @@ class qcdSmearProducer(Module):
         pass
 
     def loadHisto(self,filename,hname):
-        tf = ROOT.TFile.Open(filename)
+        tf = openCalibFile(filename)
         hist = []
         for h1 in hname:
             hist_ = tf.Get(h1)
@@ -0,0 +1,82 @@
+import math
+import numpy as np
+
+## Compiled kernels of the resolved top cleaning of DeepTopProducer, working on
+## the flat arrays of one event. They are compiled with numba when it is
+## available, and otherwise run as plain python on the same arrays. The
+## arithmetic follows the original NumPy/python code operation by operation, so
+## that both give the same ResolvedTop_Stop0l.
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+
+@njit(cache=True)
+def killSubjetOverlap(stop0l, j1Idx, j2Idx, j3Idx, subjetIdx, subjetEta, subjetPhi, jetEta, jetPhi, dR2Max):
+    """Reject the resolved tops with a jet within dR2Max of one of the subjets
+    subjetIdx (those of the selected DeepAK8 tops and Ws). Only the jets of the
+    tops still selected are considered."""
+    nJet = len(jetEta)
+    nSubJet = len(subjetEta)
+    resJet = np.zeros(nJet, np.bool_)
+    for i in range(len(stop0l)):
+        if stop0l[i]:
+            for j in (j1Idx[i], j2Idx[i], j3Idx[i]):
+                if j >= 0 and j < nJet:
+                    resJet[j] = True
+
+    overlap = np.zeros(nJet, np.bool_)
+    for s in subjetIdx:
+        if s < 0 or s >= nSubJet:
+            continue
+        for j in range(nJet):
+            if not resJet[j] or overlap[j]:
+                continue
+            deta = subjetEta[s] - jetEta[j]
+            deta = deta * deta
+            dphi = subjetPhi[s] - jetPhi[j]
+            if dphi >= math.pi:
+                dphi -= 2*math.pi
+            if dphi < -1*math.pi:
+                dphi += 2*math.pi
+            if deta + dphi * dphi < dR2Max:
+                overlap[j] = True
+
+    out = stop0l.copy()
+    for i in range(len(out)):
+        if out[i]:
+            for j in (j1Idx[i], j2Idx[i], j3Idx[i]):
+                if j >= 0 and j < nJet and overlap[j]:
+                    out[i] = False
+    return out
+
+@njit(cache=True)
+def cleanSharedJets(stop0l, j1Idx, j2Idx, j3Idx, discriminator):
+    """Greedy removal of the resolved tops sharing a jet with a top of higher
+    discriminator (ties in the order of the candidates)"""
+    out = stop0l.copy()
+    remaining = np.nonzero(out)[0]
+    if len(remaining) < 2:
+        return out
+    order = remaining[np.argsort(-discriminator[remaining], kind="mergesort")]
+
+    usedJets = np.empty(3 * len(order), j1Idx.dtype)
+    nUsed = 0
+    for iTop in order:
+        shared = False
+        for j in (j1Idx[iTop], j2Idx[iTop], j3Idx[iTop]):
+            for k in range(nUsed):
+                if usedJets[k] == j:
+                    shared = True
+        if shared:
+            out[iTop] = False
+        else:
+            usedJets[nUsed]     = j1Idx[iTop]
+            usedJets[nUsed + 1] = j2Idx[iTop]
+            usedJets[nUsed + 2] = j3Idx[iTop]
+            nUsed += 3
+    return out
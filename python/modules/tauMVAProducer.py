@@ -3,8 +3,6 @@ import os, sys
 import ROOT
 import math
 import numpy as np
-import xgboost as xgb
-import logging
 from array import array
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 from importlib import import_module
@@ -13,19 +11,12 @@ from os import system, environ
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 from PhysicsTools.NanoAODTools.postprocessing.tools import deltaPhi, deltaR, closest
-
-class XGBHelper:
-    def __init__(self, model_file, var_list):
-        self.bst = xgb.Booster(params={'nthread': 1}, model_file=model_file)
-        self.var_list = var_list
-        logging.info('Load XGBoost model %s, input variables:\n  %s' % (model_file, str(var_list)))
-
-    def eval(self, inputs):
-        dmat = xgb.DMatrix(np.array([[inputs[k] for k in self.var_list]]), feature_names=self.var_list)
-        return self.bst.predict(dmat)[0]
+from PhysicsTools.NanoSUSYTools.modules.xgbHelper import XGBModels
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray
+from PhysicsTools.NanoSUSYTools.modules.tauMVATools import pfcandMT, genTauDecayMatch
 
 class tauMVAProducer(Module):
-    def __init__(self, isFakeMVA = False, isEff = False, isData = False):
+    def __init__(self, isFakeMVA = False, isEff = False, isData = False, numpyTrees = False):
 	self.writeHistFile=True
 	self.isFakeMVA = isFakeMVA 
 	self.isEff = isEff
@@ -53,12 +44,9 @@ class tauMVAProducer(Module):
 	self.bdt_file_eta00003 	= environ["CMSSW_BASE"] + "/src/PhysicsTools/NanoSUSYTools/data/tauMVA/tauMVA-xgb_nvar13_eta0_000030_maxdepth10.model"
 	self.bdt_file 		= environ["CMSSW_BASE"] + "/src/PhysicsTools/NanoSUSYTools/data/tauMVA/tauMVA-xgb_nvar13_eta0_030000_maxdepth10.model"
 	self.bdt_vars = ['pt', 'abseta', 'chiso0p1', 'chiso0p2', 'chiso0p3', 'chiso0p4', 'totiso0p1', 'totiso0p2', 'totiso0p3', 'totiso0p4', 'neartrkdr', 'contjetdr', 'contjetcsv']
-	self.xgb 		= XGBHelper(self.bdt_file, self.bdt_vars)
-	self.xgb_eta3 		= XGBHelper(self.bdt_file_eta3, self.bdt_vars)
-	self.xgb_eta03 		= XGBHelper(self.bdt_file_eta03, self.bdt_vars)
-	self.xgb_eta003 	= XGBHelper(self.bdt_file_eta003, self.bdt_vars)
-	self.xgb_eta0003 	= XGBHelper(self.bdt_file_eta0003, self.bdt_vars)
-	self.xgb_eta00003 	= XGBHelper(self.bdt_file_eta00003, self.bdt_vars)
+	#the candidates of an event are evaluated together, once per model (numpyTrees: all the models at once, without xgboost)
+	self.xgb 		= XGBModels([self.bdt_file], self.bdt_vars, numpyTrees)
+	self.xgb_eta 		= XGBModels([self.bdt_file_eta3, self.bdt_file_eta03, self.bdt_file_eta003, self.bdt_file_eta0003, self.bdt_file_eta00003], self.bdt_vars, numpyTrees)
 
     def beginJob(self,histFile=None,histDirName=None):
    	pass
@@ -118,37 +106,6 @@ class tauMVAProducer(Module):
     def isA(self, particleID, p):
 	return abs(p) == particleID
 
-    def getNearPhotonIndex(self, pfc, pfcands):
-	minPhotonPt = 0.5
-	maxPhotonDR = 0.2
-	photonInd = -1
-	maxPhotonPT = 0.0
-	
-	for ic in xrange(len(pfcands)):
-		c = pfcands[ic]
-		if(c.nearphopt < minPhotonPt): continue
-		dr = deltaR(c.eta, c.phi, pfc.nearphoeta, pfc.nearphophi)
-		if(dr > maxPhotonDR): continue
-		if(c.nearphopt > maxPhotonPT):
-			maxPhotonPT = c.pt
-			photonInd = ic
-	
-	return photonInd
-
-    def transverseMass(self, visible, invisible):
-	cosDPhi   = np.cos( deltaPhi(visible.Phi(), invisible.phi) )
-	return np.sqrt( 2 * visible.Pt() * invisible.pt * (1 - cosDPhi) )
-        
-    def computeMT(self, pfc, met, pfcands):
-	photonInd = self.getNearPhotonIndex(pfc, pfcands)
-	candP4 = ROOT.TLorentzVector()
-	candP4.SetPtEtaPhiM(pfc.pt, pfc.eta, pfc.phi, pfc.mass)
-	if(photonInd > -1): 
-		pfcand_buff = ROOT.TLorentzVector()
-		pfcand_buff.SetPtEtaPhiM(pfcands[photonInd].pt, pfcands[photonInd].eta, pfcands[photonInd].phi, pfcands[photonInd].mass)
-		candP4+=pfcand_buff
-	return self.transverseMass(candP4, met)
-
     def analyze(self, event):
         ## Getting objects
 	met	  = Object(event, self.metBranchName)
@@ -194,7 +151,10 @@ class tauMVAProducer(Module):
 
         pfchargedhads = []
         pfphotons = []
-	mva = {}
+	mvaIdx = []
+	mvaFeatures = []
+	mvaEtaIdx = []
+	mvaEtaFeatures = []
 	mva_ = []
 	mva_eta3_ = []
 	mva_eta03_ = []
@@ -209,13 +169,23 @@ class tauMVAProducer(Module):
 	abseta_ = []
 	absdz_ = []
 	gentaumatch_ = [] 
-	for pfc in pfcand:
+	#transverse mass of the preselected candidates with their near photon, for all of them at once
+	pfcPt  = branchArray(event.PFcand_pt,  dtype=float)
+	pfcEta = branchArray(event.PFcand_eta, dtype=float)
+	mtCands = np.nonzero((pfcPt > 10.0) & (np.abs(pfcEta) < 2.4) & (np.abs(branchArray(event.PFcand_dz, dtype=float)) < 0.2))[0]
+	pfcMT = np.zeros(len(pfcPt))
+	pfcMT[mtCands] = pfcandMT(event, met, mtCands)
+	#truth matching of all the candidates to the charged hadrons of the tau decays
+	pfcMatch, pfcPtMatch, pfcEtaMatch = genTauDecayMatch(pfcPt, pfcEta, branchArray(event.PFcand_phi, dtype=float),
+	                                                     np.array([p.pt  for p in taudecayprods], dtype=float),
+	                                                     np.array([p.eta for p in taudecayprods], dtype=float),
+	                                                     np.array([p.phi for p in taudecayprods], dtype=float))
+
+	for ipfc, pfc in enumerate(pfcand):
       
-		match = False
-		tmpDr = 0.05
-		kpt = 0.01
-		ptmatch = -1.0
-		etamatch = -10
+		match    = pfcMatch[ipfc]
+		ptmatch  = pfcPtMatch[ipfc]
+		etamatch = pfcEtaMatch[ipfc]
 		GoodTaus = False
 		FakeTaus = False
 		TauCR = False
@@ -231,18 +201,9 @@ class tauMVAProducer(Module):
 		abseta = 10.0
 		absdz  = 10.0
 		
-		for genchhad in taudecayprods:
-			dpt = 0.0
-			if(genchhad.pt>0.5): 
-				dpt = abs(1.0 - pfc.pt/genchhad.pt)
-			if((deltaR(pfc.eta, pfc.phi, genchhad.eta, genchhad.phi) +  kpt*dpt) < tmpDr and dpt < 0.4):
-				tmpDr = deltaR(pfc.eta, pfc.phi, genchhad.eta, genchhad.phi) + kpt*dpt
-				match = True
-				ptmatch = genchhad.pt
-				etamatch = genchhad.eta
 		
 		if((pfc.pt > 10.0 and abs(pfc.eta) < 2.4 and abs(pfc.dz) < 0.2)):
-			mt = self.computeMT(pfc, met, pfcand)
+			mt = pfcMT[ipfc]
 			if mt < 100:
 				pt = min(pfc.pt,float(300.0))
 				abseta       = abs(pfc.eta)
@@ -276,27 +237,14 @@ class tauMVAProducer(Module):
 					TauCR = True
 
 				if FakeTaus == True or GoodTaus == True or TauCR == True:
-					mva = {self.bdt_vars[0]: pt, 
-					       self.bdt_vars[1]: abseta,
-					       self.bdt_vars[2]: chiso0p1, 
-					       self.bdt_vars[3]: chiso0p2, 
-					       self.bdt_vars[4]: chiso0p3, 
-					       self.bdt_vars[5]: chiso0p4, 
-					       self.bdt_vars[6]: totiso0p1, 
-					       self.bdt_vars[7]: totiso0p2, 
-					       self.bdt_vars[8]: totiso0p3, 
-					       self.bdt_vars[9]: totiso0p4, 
-					       self.bdt_vars[10]: neartrkdr, 
-					       self.bdt_vars[11]: contjetdr, 
-					       self.bdt_vars[12]: contjetcsv}
+					#features in the order of bdt_vars, evaluated after the loop
+					mva = [pt, abseta, chiso0p1, chiso0p2, chiso0p3, chiso0p4, totiso0p1, totiso0p2, totiso0p3, totiso0p4, neartrkdr, contjetdr, contjetcsv]
 					if TauCR == True:
-						mva_buff = self.xgb.eval(mva)
+						mvaIdx.append(len(mva_))
+						mvaFeatures.append(mva)
 					else:
-						mva_eta3	 = self.xgb_eta3.eval(mva)
-						mva_eta03	 = self.xgb_eta03.eval(mva)
-						mva_eta003	 = self.xgb_eta003.eval(mva)
-						mva_eta0003	 = self.xgb_eta0003.eval(mva)
-						mva_eta00003	 = self.xgb_eta00003.eval(mva)
+						mvaEtaIdx.append(len(mva_))
+						mvaEtaFeatures.append(mva)
 
 		#print "fastsim: %d, FakeTaus: %d, GoodTaus: %d" %(self.isFakeMVA, FakeTaus, GoodTaus)
 		mt_.append(mt)
@@ -313,6 +261,16 @@ class tauMVAProducer(Module):
 		FakeTaus_.append(FakeTaus)
 		TauCR_.append(TauCR)
 
+	#one evaluation of each model for all the candidates
+	if mvaIdx:
+		for i, mva in zip(mvaIdx, self.xgb.evalBatch(mvaFeatures)[0]):
+			mva_[i] = mva
+	if mvaEtaIdx:
+		mvaEta = self.xgb_eta.evalBatch(mvaEtaFeatures)
+		for mvaEta_, mvaModel in zip((mva_eta3_, mva_eta03_, mva_eta003_, mva_eta0003_, mva_eta00003_), mvaEta):
+			for i, mva in zip(mvaEtaIdx, mvaModel):
+				mvaEta_[i] = mva
+
 	cut_71 = []
 	cut_73 = []
 	for i in mva_:
@@ -0,0 +1,128 @@
+import math
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules.columnarTools import branchArray, deltaPhi, phiMpiPi, localIndex, offsetsFromCounts
+
+## Per-event neighbourhood queries on the PFcands of the tau MVA producers,
+## computed on the arrays of all the candidates of the event instead of a loop
+## over the PFcands for each candidate.
+
+class EtaPhiGrid(object):
+    """Objects of an event binned in cells of eta and phi of at least cellSize,
+    for the queries of the objects within a cone of radius up to cellSize. The
+    cells wrap around in phi."""
+    def __init__(self, eta, phi, cellSize):
+        self.eta      = np.asarray(eta, dtype=float)
+        self.phi      = np.asarray(phi, dtype=float)
+        self.cellSize = cellSize
+        self.nPhi     = int(2*math.pi / cellSize)
+        ## With less than 3 cells in phi, the neighbouring cells are the same
+        if self.nPhi < 3:
+            self.nPhi = 1
+        cells = self.cellIndex(*self.cells(self.eta, self.phi))
+        self.order = np.argsort(cells, kind="mergesort")
+        self.sortedCells = cells[self.order]
+
+    def cells(self, eta, phi):
+        ieta = np.floor(eta / self.cellSize).astype(np.int64)
+        iphi = np.floor((phiMpiPi(phi) + math.pi) * (self.nPhi / (2*math.pi))).astype(np.int64) % self.nPhi
+        return ieta, iphi
+
+    def cellIndex(self, ieta, iphi):
+        return ieta * self.nPhi + iphi % self.nPhi
+
+    def pairsWithin(self, eta, phi, radius):
+        """Pairs (query, object, dR) of the points (eta, phi) and the objects
+        within dR <= radius, ordered by query then by object. The dR is the one
+        of postprocessing.tools.deltaR(object, point)."""
+        if radius > self.cellSize:
+            raise ValueError("Query radius %g larger than the cells %g" % (radius, self.cellSize))
+        eta = np.asarray(eta, dtype=float)
+        phi = np.asarray(phi, dtype=float)
+        ieta, iphi = self.cells(eta, phi)
+        dEta = np.array([-1, 0, 1])
+        dPhi = np.array([-1, 0, 1]) if self.nPhi >= 3 else np.array([0])
+        cells = self.cellIndex(ieta[:, np.newaxis, np.newaxis] + dEta[np.newaxis, :, np.newaxis],
+                               iphi[:, np.newaxis, np.newaxis] + dPhi[np.newaxis, np.newaxis, :]).reshape(len(eta), -1)
+        start  = np.searchsorted(self.sortedCells, cells, "left").ravel()
+        counts = np.searchsorted(self.sortedCells, cells, "right").ravel() - start
+
+        query = np.repeat(np.repeat(np.arange(len(eta)), cells.shape[1]), counts)
+        obj   = self.order[np.repeat(start, counts) + localIndex(offsetsFromCounts(counts))]
+        deta = self.eta[obj] - eta[query]
+        dphi = deltaPhi(self.phi[obj], phi[query])
+        dR = np.sqrt(deta*deta + dphi*dphi)
+        keep = dR <= radius
+        query, obj, dR = query[keep], obj[keep], dR[keep]
+        order = np.lexsort((obj, query))
+        return query[order], obj[order], dR[order]
+
+
+def nearPhotonIndex(pt, eta, phi, nearphopt, nearphoeta, nearphophi, cands, minPhotonPt=0.5, maxPhotonDR=0.2):
+    """Index of the PFcand giving the near photon of each candidate of cands, or
+    -1, as getNearPhotonIndex of the tau MVA producers did: among the PFcands
+    with nearphopt >= minPhotonPt within maxPhotonDR of the near photon of the
+    candidate, in their order, the last one whose nearphopt is above the pt of
+    the previous one chosen"""
+    photonIdx = np.full(len(cands), -1, dtype=np.int64)
+    photons = np.nonzero(nearphopt >= minPhotonPt)[0]
+    if len(photons) == 0 or len(cands) == 0:
+        return photonIdx
+    ## Slightly larger cells, so that no object within maxPhotonDR is lost to the rounding of the cells
+    grid = EtaPhiGrid(eta[photons], phi[photons], 1.01 * maxPhotonDR)
+    query, obj, dR = grid.pairsWithin(nearphoeta[cands], nearphophi[cands], maxPhotonDR)
+    maxPhotonPt = np.zeros(len(cands))
+    for q, ic in zip(query, photons[obj]):
+        if nearphopt[ic] > maxPhotonPt[q]:
+            maxPhotonPt[q] = pt[ic]
+            photonIdx[q] = ic
+    return photonIdx
+
+def candidateMT(pt, phi, cands, photonIdx, metPt, metPhi):
+    """Transverse mass of each candidate of cands, with the PFcand of its near
+    photon (photonIdx >= 0), and the MET"""
+    px = pt[cands] * np.cos(phi[cands])
+    py = pt[cands] * np.sin(phi[cands])
+    withPhoton = photonIdx >= 0
+    photons = photonIdx[withPhoton]
+    px[withPhoton] = px[withPhoton] + pt[photons] * np.cos(phi[photons])
+    py[withPhoton] = py[withPhoton] + pt[photons] * np.sin(phi[photons])
+    visPt  = np.sqrt(px*px + py*py)
+    visPhi = np.arctan2(py, px)
+    return np.sqrt(2 * visPt * metPt * (1 - np.cos(deltaPhi(visPhi, metPhi))))
+
+def pfcandMT(event, met, cands):
+    """Transverse mass of the PFcands cands (indices) with their near photon,
+    as computeMT of the tau MVA producers did with TLorentzVectors"""
+    pt  = branchArray(event.PFcand_pt,  dtype=float)
+    eta = branchArray(event.PFcand_eta, dtype=float)
+    phi = branchArray(event.PFcand_phi, dtype=float)
+    photonIdx = nearPhotonIndex(pt, eta, phi, branchArray(event.PFcand_nearphopt, dtype=float),
+                                branchArray(event.PFcand_nearphoeta, dtype=float), branchArray(event.PFcand_nearphophi, dtype=float), cands)
+    return candidateMT(pt, phi, cands, photonIdx, met.pt, met.phi)
+
+def genTauDecayMatch(pt, eta, phi, genPt, genEta, genPhi, maxScore=0.05, kpt=0.01, maxDpt=0.4):
+    """Truth matching of the candidates (pt, eta, phi) to the charged hadrons of
+    the gen tau decays, from the (candidate x hadron) matrix of the scores
+    dR + kpt*dpt, with dpt = |1 - pt/genPt| (0 for genPt <= 0.5). Each candidate
+    is matched to the hadron of smallest score below maxScore with dpt below
+    maxDpt, the first one on ties. Returns (matched, pt and eta of the matched
+    hadron, -1 and -10 if none)."""
+    matched  = np.zeros(len(pt), dtype=bool)
+    ptMatch  = np.full(len(pt), -1.0)
+    etaMatch = np.full(len(pt), -10.0)
+    if len(pt) == 0 or len(genPt) == 0:
+        return matched, ptMatch, etaMatch
+
+    deta = eta[:, np.newaxis] - genEta[np.newaxis, :]
+    dphi = deltaPhi(phi[:, np.newaxis], genPhi[np.newaxis, :])
+    hasPt = genPt > 0.5
+    dpt = np.where(hasPt, np.abs(1.0 - pt[:, np.newaxis] / np.where(hasPt, genPt, 1.)), 0.)
+    score = np.sqrt(deta*deta + dphi*dphi) + kpt*dpt
+    valid = (score < maxScore) & (dpt < maxDpt)
+
+    matched = valid.any(axis=1)
+    best = np.argmin(np.where(valid, score, np.inf), axis=1)[matched]
+    ptMatch[matched]  = genPt[best]
+    etaMatch[matched] = genEta[best]
+    return matched, ptMatch, etaMatch
@@ -0,0 +1,133 @@
+from __future__ import print_function
+import os
+import re
+import json
+import uuid
+import shutil
+import numpy as np
+
+## Columnar output of the MVA training samples: the selected rows are buffered
+## in fixed size NumPy columns and written every chunkSize rows to a chunk
+## directory <prefix>_<job>_<n>/ holding one uncompressed <column>.npy per
+## column. The memory used does not grow with the number of events, and the
+## training loads the chunks with numpy directly, memory-mapped if wanted,
+## without another pass over the NanoAOD trees.
+##
+## <job> is unique to each writer, so that the jobs of a sample can share a
+## prefix: the chunks of all of them are read together. Each chunk directory
+## holds a ChunkManifest, written after its columns: only the directories
+## with one are read as chunks, or removed by removeChunks.
+
+ChunkManifest = "manifest.json"
+JobIdPattern  = re.compile(r"[0-9a-zA-Z]+$")
+
+class ChunkedColumnWriter(object):
+    """Writer of the rows of the columns [(name, dtype)] in chunks of chunkSize.
+    Existing chunks are never overwritten: use a new prefix, or removeChunks,
+    to replace a sample."""
+    def __init__(self, prefix, columns, chunkSize=200000, jobId=None):
+        self.prefix    = prefix
+        self.jobId     = jobId if jobId else uuid.uuid4().hex[:12]
+        if not JobIdPattern.match(self.jobId):
+            raise ValueError("Job id %s of the training chunks is not alphanumeric" % self.jobId)
+        self.columns   = [(name, np.dtype(dtype)) for name, dtype in columns]
+        self.chunkSize = chunkSize
+        self.buffers   = dict((name, np.empty(chunkSize, dtype=dtype)) for name, dtype in self.columns)
+        self.nRows     = 0
+        self.nChunks   = 0
+        self.nWritten  = 0
+        outDir = os.path.dirname(prefix)
+        if outDir and not os.path.isdir(outDir):
+            os.makedirs(outDir)
+
+    def append(self, **arrays):
+        """Append the rows given as one array per column, all of the same length"""
+        if set(arrays) != set(self.buffers):
+            raise KeyError("Columns %s given, %s expected" % (sorted(arrays), sorted(self.buffers)))
+        n = len(arrays[self.columns[0][0]])
+        start = 0
+        while start < n:
+            nCopy = min(n - start, self.chunkSize - self.nRows)
+            for name, values in arrays.items():
+                self.buffers[name][self.nRows:self.nRows + nCopy] = values[start:start + nCopy]
+            self.nRows += nCopy
+            start      += nCopy
+            if self.nRows == self.chunkSize:
+                self.flush()
+
+    def flush(self):
+        if self.nRows == 0:
+            return
+        ## Fails if the directory exists, rather than mixing two samples
+        chunkDir = chunkDirName(self.prefix, self.jobId, self.nChunks)
+        os.mkdir(chunkDir)
+        for name, buf in self.buffers.items():
+            np.save(os.path.join(chunkDir, name + ".npy"), buf[:self.nRows])
+        with open(os.path.join(chunkDir, ChunkManifest), "w") as f:
+            json.dump({"prefix"  : os.path.basename(self.prefix),
+                       "job"     : self.jobId,
+                       "chunk"   : self.nChunks,
+                       "rows"    : self.nRows,
+                       "columns" : [[name, dtype.str] for name, dtype in self.columns]}, f)
+        self.nWritten += self.nRows
+        self.nChunks  += 1
+        self.nRows     = 0
+
+    def close(self):
+        self.flush()
+        print("Wrote %d rows in %d chunks %s_%s_<n>/" % (self.nWritten, self.nChunks, self.prefix, self.jobId))
+
+
+def chunkDirName(prefix, jobId, iChunk):
+    return "%s_%s_%d" % (prefix, jobId, iChunk)
+
+def readManifest(chunkDir):
+    """Manifest of a chunk directory, None if it has none"""
+    path = os.path.join(chunkDir, ChunkManifest)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def chunkDirs(prefix):
+    """Chunk directories written with prefix by all the jobs, ordered by job
+    and chunk. Directories without the manifest of a chunk of prefix, e.g. not
+    written by ChunkedColumnWriter or not complete, are skipped."""
+    outDir = os.path.dirname(prefix)
+    if not os.path.isdir(outDir or "."):
+        return []
+    base = os.path.basename(prefix)
+    pattern = re.compile(re.escape(base) + r"_([0-9a-zA-Z]+)_(\d+)$")
+    chunks = []
+    for name in os.listdir(outDir or "."):
+        match = pattern.match(name)
+        if not match:
+            continue
+        path = os.path.join(outDir, name)
+        manifest = readManifest(path) if os.path.isdir(path) else None
+        if manifest is None or manifest["prefix"] != base or manifest["job"] != match.group(1) or manifest["chunk"] != int(match.group(2)):
+            continue
+        chunks.append(((match.group(1), int(match.group(2))), path))
+    return [path for key, path in sorted(chunks)]
+
+def removeChunks(prefix):
+    """Remove the chunks of all the jobs written with prefix, and only them"""
+    for chunkDir in chunkDirs(prefix):
+        shutil.rmtree(chunkDir)
+
+def iterChunks(prefix, columns=None, mmap_mode=None):
+    """Dictionaries {column : array} of the chunks written with prefix, in order.
+    With mmap_mode (e.g. "r"), the arrays are memory-mapped from the files."""
+    for chunkDir in chunkDirs(prefix):
+        if columns is None:
+            names = [name for name, dtype in readManifest(chunkDir)["columns"]]
+        else:
+            names = columns
+        yield dict((name, np.load(os.path.join(chunkDir, name + ".npy"), mmap_mode=mmap_mode)) for name in names)
+
+def loadSample(prefix, columns=None):
+    """All the chunks written with prefix, concatenated"""
+    chunks = list(iterChunks(prefix, columns))
+    if not chunks:
+        raise IOError("No training sample chunks %s_<job>_<n>/" % prefix)
+    return dict((name, np.concatenate([chunk[name] for chunk in chunks])) for name in chunks[0])
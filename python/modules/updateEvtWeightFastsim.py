@@ -5,6 +5,7 @@ import math
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import openCalibFile
 
 class UpdateEvtWeightFastsim(Module):
     def __init__(self, isData, nEvent, Process):
@@ -21,7 +22,7 @@ class UpdateEvtWeightFastsim(Module):
         pass
 
     def loadhisto(self,filename,hname):
-        file =ROOT.TFile.Open(filename)
+        file =openCalibFile(filename)
         hist_ = file.Get(hname)
         hist_.SetDirectory(0)
         return hist_
@@ -4,6 +4,8 @@ import math
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import collectionBranches
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import invalidateCache
 
 
 # 2016 : https://twiki.cern.ch/twiki/bin/viewauth/CMS/JetID13TeVRun2016
@@ -11,6 +13,9 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 # 2018 : https://twiki.cern.ch/twiki/bin/view/CMS/JetID13TeVRun2018
 
 class UpdateJetID(Module):
+    ## Input branches read, see branchSelection
+    inputBranches = collectionBranches("Jet")
+
     def __init__(self, era):
         self.era = era
 
@@ -69,4 +74,5 @@ class UpdateJetID(Module):
 
         ### Store output
         self.out.fillBranch("Jet_jetId",        newJetID)
+        invalidateCache(event, "Jet")
         return True
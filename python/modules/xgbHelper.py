@@ -0,0 +1,219 @@
+import math
+import ctypes
+import ctypes.util
+import struct
+import logging
+import numpy as np
+
+try:
+    import xgboost as xgb
+except ImportError:
+    xgb = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+## Evaluation of the XGBoost models of the tau MVA. The features of all the
+## candidates of an event are evaluated together, as the rows of one float32
+## matrix: XGBModels makes one predict per model, or with numpyTrees=True
+## evaluates all its models at once with TreeEnsemble, which reads the trees of
+## the binary .model files (format of XGBoost < 1.0) into flat NumPy arrays and
+## does not need xgboost.
+
+class XGBHelper:
+    def __init__(self, model_file, var_list):
+        self.bst = xgb.Booster(params={'nthread': 1}, model_file=model_file)
+        self.var_list = var_list
+        logging.info('Load XGBoost model %s, input variables:\n  %s' % (model_file, str(var_list)))
+
+    def eval(self, inputs):
+        dmat = xgb.DMatrix(np.array([[inputs[k] for k in self.var_list]]), feature_names=self.var_list)
+        return self.bst.predict(dmat)[0]
+
+    def evalBatch(self, features):
+        """Prediction for each row of features (in the order of var_list)"""
+        dmat = xgb.DMatrix(np.asarray(features, dtype=np.float32), feature_names=self.var_list)
+        return self.bst.predict(dmat)
+
+
+## float32 exp of the libm, as XGBoost: the float32 exp of NumPy (vectorized in
+## recent versions) and the rounded double exp may differ from it by one ulp
+try:
+    _expf = ctypes.CDLL(ctypes.util.find_library("m")).expf
+    _expf.restype, _expf.argtypes = ctypes.c_float, [ctypes.c_float]
+except (OSError, AttributeError):
+    _expf = None
+
+def _libmSigmoid(margin):
+    one = np.float32(1)
+    if _expf is None:
+        return one / (one + np.exp(-margin.astype(np.float64)).astype(np.float32))
+    return one / (one + np.array([_expf(-m) for m in margin.tolist()], dtype=np.float32))
+_sigmoid = _libmSigmoid
+
+if njit is not None:
+    @njit(cache=True)
+    def _sigmoid(margin):
+        out = np.empty_like(margin)
+        one = np.float32(1)
+        for i in range(len(margin)):
+            out[i] = one / (one + math.exp(-margin[i]))
+        return out
+
+    @njit(cache=True)
+    def _treeMargins(x, roots, treeModel, nModels, left, right, feature, defaultLeft, value):
+        out = np.zeros((nModels, x.shape[0]), np.float32)
+        for r in range(x.shape[0]):
+            for t in range(len(roots)):
+                node = roots[t]
+                while left[node] >= 0:
+                    fvalue = x[r, feature[node]]
+                    if np.isnan(fvalue):
+                        goLeft = defaultLeft[node]
+                    else:
+                        goLeft = fvalue < value[node]
+                    node = left[node] if goLeft else right[node]
+                out[treeModel[t], r] += value[node]
+        return out
+
+
+## Node of the binary model format
+TreeNodeType = np.dtype([("parent", "<i4"), ("cleft", "<i4"), ("cright", "<i4"), ("sindex", "<u4"), ("info", "<f4")])
+TreeNodeStatSize   = 16
+LearnerParamSize   = 136
+GBTreeParamSize    = 160
+TreeParamSize      = 148
+
+class TreeEnsemble(object):
+    """Trees of one or several binary XGBoost models, flattened into arrays of
+    nodes. The decisions and the sums of the leaves are done in float32 in the
+    order of XGBoost, so that the predictions are the same."""
+    def __init__(self, model_files):
+        left, right, feature, threshold, defaultLeft, roots, treeModel = [], [], [], [], [], [], []
+        self.baseMargin, self.objectives = [], []
+        nNodes = 0
+        for iModel, model_file in enumerate(model_files):
+            objective, baseMargin, trees = self.readModel(model_file)
+            self.objectives.append(objective)
+            self.baseMargin.append(baseMargin)
+            for nodes in trees:
+                isLeaf = nodes["cleft"] < 0
+                left.append(np.where(isLeaf, -1, nodes["cleft"] + nNodes))
+                right.append(np.where(isLeaf, -1, nodes["cright"] + nNodes))
+                feature.append(np.where(isLeaf, 0, nodes["sindex"] & 0x7fffffff))
+                defaultLeft.append((nodes["sindex"] >> 31) != 0)
+                threshold.append(nodes["info"])
+                roots.append(nNodes)
+                treeModel.append(iModel)
+                nNodes += len(nodes)
+            logging.info('Load %d trees of model %s for NumPy evaluation' % (len(trees), model_file))
+
+        self.left        = np.concatenate(left).astype(np.int64)
+        self.right       = np.concatenate(right).astype(np.int64)
+        self.feature     = np.concatenate(feature).astype(np.int64)
+        self.defaultLeft = np.concatenate(defaultLeft)
+        ## The value of a node is its split threshold, or its leaf value
+        self.value       = np.concatenate(threshold).astype(np.float32)
+        self.roots       = np.array(roots, dtype=np.int64)
+        self.treeModel   = np.array(treeModel, dtype=np.int64)
+        self.baseMargin  = np.array(self.baseMargin, dtype=np.float32)
+
+    @staticmethod
+    def readModel(model_file):
+        """(objective, base margin, [node array of each tree]) of a binary model"""
+        with open(model_file, "rb") as f:
+            data = f.read()
+        if data[:4] in (b"binf", b"bs64") or data[:1] == b"{":
+            raise RuntimeError("Unsupported XGBoost model format of %s" % model_file)
+        pos = 0
+        baseScore, = struct.unpack_from("<f", data, pos)
+        pos += LearnerParamSize
+        names = []
+        for i in range(2):
+            n, = struct.unpack_from("<Q", data, pos)
+            names.append(data[pos + 8:pos + 8 + n].decode())
+            pos += 8 + n
+        objective, gbm = names
+        if gbm != "gbtree":
+            raise RuntimeError("Booster %s of %s is not supported" % (gbm, model_file))
+        numTrees, numRoots = struct.unpack_from("<ii", data, pos)
+        numOutputGroup, sizeLeafVector = struct.unpack_from("<ii", data, pos + 24)
+        if numRoots != 1 or numOutputGroup != 1 or sizeLeafVector != 0:
+            raise RuntimeError("Only single output models are supported, not %s" % model_file)
+        pos += GBTreeParamSize
+
+        trees = []
+        for i in range(numTrees):
+            numNodes, = struct.unpack_from("<i", data, pos + 4)
+            pos += TreeParamSize
+            trees.append(np.frombuffer(data, dtype=TreeNodeType, count=numNodes, offset=pos))
+            pos += numNodes * (TreeNodeType.itemsize + TreeNodeStatSize)
+        ## The base score of these models is stored as a margin
+        return objective, baseScore, trees
+
+    def margins(self, features):
+        """Sum of the leaves of each model, shape (number of models, rows)"""
+        x = np.asarray(features, dtype=np.float32)
+        if njit is not None:
+            out = _treeMargins(x, self.roots, self.treeModel, len(self.baseMargin), self.left, self.right, self.feature, self.defaultLeft, self.value)
+            return out + self.baseMargin[:, np.newaxis]
+        nRows = len(x)
+        out = np.zeros((len(self.baseMargin), nRows), dtype=np.float32)
+        if nRows == 0:
+            return out
+        rows = np.arange(nRows)[:, np.newaxis]
+        node = np.repeat(self.roots[np.newaxis], nRows, axis=0)
+        while True:
+            split = self.left[node] >= 0
+            if not split.any():
+                break
+            fvalue = x[rows, self.feature[node]]
+            with np.errstate(invalid="ignore"):
+                goLeft = np.where(np.isnan(fvalue), self.defaultLeft[node], fvalue < self.value[node])
+            node = np.where(split, np.where(goLeft, self.left[node], self.right[node]), node)
+        leaves = self.value[node]
+        ## Summed tree after tree in float32, as XGBoost does
+        for iModel in range(len(out)):
+            trees = np.nonzero(self.treeModel == iModel)[0]
+            out[iModel] = np.cumsum(leaves[:, trees], axis=1, dtype=np.float32)[:, -1]
+        return out + self.baseMargin[:, np.newaxis]
+
+    def predict(self, features):
+        """Prediction of each model for each row of features, shape (models, rows)"""
+        margins = self.margins(features)
+        for iModel, objective in enumerate(self.objectives):
+            if objective == "binary:logistic":
+                margins[iModel] = _sigmoid(margins[iModel])
+            elif objective not in ("binary:logitraw", "reg:linear", "reg:squarederror"):
+                raise RuntimeError("Objective %s is not supported by the NumPy evaluation" % objective)
+        return margins
+
+
+## Models already loaded, shared by the producers of a job
+_loadedEnsembles = {}
+
+class XGBModels(object):
+    """Several models evaluated on the same candidates"""
+    def __init__(self, model_files, var_list, numpyTrees=False):
+        self.var_list   = var_list
+        self.numpyTrees = numpyTrees
+        key = tuple(model_files)
+        if numpyTrees:
+            if key not in _loadedEnsembles:
+                _loadedEnsembles[key] = TreeEnsemble(model_files)
+            self.ensemble = _loadedEnsembles[key]
+        else:
+            self.helpers = [XGBHelper(model_file, var_list) for model_file in model_files]
+
+    def evalBatch(self, features):
+        """Prediction of each model for each row of features (in the order of
+        var_list), shape (number of models, rows)"""
+        features = np.asarray(features, dtype=np.float32).reshape(-1, len(self.var_list))
+        if self.numpyTrees:
+            return self.ensemble.predict(features)
+        if len(features) == 0:
+            return np.zeros((len(self.helpers), 0), dtype=np.float32)
+        dmat = xgb.DMatrix(features, feature_names=self.var_list)
+        return np.array([helper.bst.predict(dmat) for helper in self.helpers])
@@ -15,6 +15,7 @@ from PhysicsTools.NanoSUSYTools.modules.SoftBDeepAK8SFProducer import SoftBDeepA
 from PhysicsTools.NanoSUSYTools.modules.TopReweightProducer import TopReweightProducer
 from PhysicsTools.NanoAODTools.postprocessing.modules.btv.btagSFProducer import btagSFProducer
 from PhysicsTools.NanoSUSYTools.modules.BtagSFWeightProducer import BtagSFWeightProducer
+from PhysicsTools.NanoSUSYTools.modules.friendTree import FriendTreeReader, FriendIndexProducer, FriendPostfix, friendFiles
 # JEC files are those recomended here (as of Mar 1, 2019)
 # https://twiki.cern.ch/twiki/bin/view/CMS/JECDataMC#Recommended_for_MC
 # Actual text files are found here
@@ -221,7 +222,19 @@ def main(args):
         with open(args.inputfile) as f:
             files = [line.strip() for line in f]
 
-    p=PostProcessor(args.outputfile,files,cut=None, branchsel=None, postfix="", outputbranchsel="keep_and_drop.txt", modules=mods,provenance=False,maxEvents=args.maxEvents)
+    friend = args.friend
+    if args.friendDir:
+        ## Read the friend trees of the previous step, their parent attached:
+        ## the output is a friend tree of them
+        files = friendFiles(files, args.friendDir)
+        mods.insert(0, FriendTreeReader())
+        friend = True
+    if friend:
+        ## Only the new branches, with the index of their parent events
+        mods.insert(0, FriendIndexProducer())
+
+    p=PostProcessor(args.outputfile,files,cut=None, branchsel=None, postfix=FriendPostfix if friend else "", outputbranchsel="keep_and_drop.txt", modules=mods,provenance=False,maxEvents=args.maxEvents,
+                    friend=friend)
     p.run()
 
 if __name__ == "__main__":
@@ -252,5 +265,10 @@ if __name__ == "__main__":
                         type=int,
                         default = -1,
                         help = 'MAximum number of events to process (Default: all events)')
+    parser.add_argument('--friend',
+                        action="store_true",
+                        help = 'Write only the branches produced by the modules, to a friend tree of the input (Default: false)')
+    parser.add_argument('--friendDir', type=str, default = "",
+                        help = 'Directory of the friend trees of the input files, written with --friend by Stop0l_postproc.py. They are read instead of the input files, and the output is a friend tree of them (Default: none)')
     args = parser.parse_args()
     main(args)
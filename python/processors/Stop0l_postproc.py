@@ -28,8 +28,15 @@ from PhysicsTools.NanoSUSYTools.modules.FastsimOtherVarProducer import FastsimOt
 from PhysicsTools.NanoSUSYTools.modules.PrefireCorr import PrefCorr
 from PhysicsTools.NanoSUSYTools.modules.ISRWeightProducer import ISRSFWeightProducer
 from PhysicsTools.NanoSUSYTools.modules.Stop0l_trigger import Stop0l_trigger
+from PhysicsTools.NanoSUSYTools.modules.Stop0lPreselection import Stop0lPreselection
+from PhysicsTools.NanoSUSYTools.modules.datamodelRemap import printObjectCacheStats
+from PhysicsTools.NanoSUSYTools.modules.branchSelection import writeInputBranchSel, BranchReadReport
+from PhysicsTools.NanoSUSYTools.modules.friendTree import FriendIndexProducer, FriendPostfix
+from PhysicsTools.NanoSUSYTools.modules.moduleProfiler import profileModules
 from PhysicsTools.NanoSUSYTools.modules.SoftBDeepAK8SFProducer import SoftBDeepAK8SFProducer
 from PhysicsTools.NanoSUSYTools.modules.TopReweightProducer import TopReweightProducer
+import PhysicsTools.NanoSUSYTools.modules.effTables as effTables
+import PhysicsTools.NanoSUSYTools.modules.calibBundle as calibBundle
 from PhysicsTools.NanoSUSYTools.processors.FastsimISR import *
 
 # JEC files are those recomended here (as of Mar 1, 2019)
@@ -183,6 +190,15 @@ def main(args):
         print "ERROR: It is impossible to have a dataset that is both data and fastsim"
         exit(0)
 
+    if args.preselect and args.friend:
+        print "ERROR: A friend tree needs all the events, it cannot be preselected"
+        exit(0)
+
+    if args.effCache:
+        effTables.EffCacheDir = args.effCache
+    if args.calibBundle:
+        calibBundle.CalibBundlePath = args.calibBundle
+
     if isdata:
         dataType="Data"
         if not args.era + args.dataEra in DataDepInputs[dataType].keys():
@@ -226,16 +242,33 @@ def main(args):
 
     #~~~~~ Common modules for Data and MC ~~~~~
     taggerWorkingDirectory = os.environ["CMSSW_BASE"] + "/src/PhysicsTools/NanoSUSYTools/python/processors/" + DataDepInputs[dataType][args.era if not isdata else (args.era + args.dataEra)]["taggerWD"]
+    ## The Stop0l objects and baseline of all the systematic variations are
+    ## evaluated together in one module each for MC
+    stop0lUncerts = None if isdata else ["nominal", "JESUp", "JESDown", "METUnClustUp", "METUnClustDown"]
     if isfastsim:
         mods.append(FastsimOtherVarProducer(isfastsim))
+        ## Fastsim MET variations are needed before the Stop0l objects
+        mods += [
+                FastsimOtherVarProducer(isfastsim, "JESUp"),
+                FastsimOtherVarProducer(isfastsim, "JESDown"),
+                FastsimOtherVarProducer(isfastsim, "METUnClustUp"),
+                FastsimOtherVarProducer(isfastsim, "METUnClustDown"),
+                ]
+    if args.preselect:
+        ## Reject the events failing the MET and jet cuts in all the variations
+        ## before the expensive modules
+        mods.append(Stop0lPreselection())
     mods += [ eleMiniCutID(),
-             Stop0lObjectsProducer(args.era),
+             Stop0lObjectsProducer(args.era, stop0lUncerts, batchSize=args.batchSize),
              TopTaggerProducer(recalculateFromRawInputs=True, topDiscCut=DeepResovledCandidateDiscCut, 
                                cfgWD=taggerWorkingDirectory,
                                saveSFAndSyst=not isdata, 
                                systToSave=["Btag_Up", "Btag_Down", "Pileup_Up", "Pileup_Down", "CSPur_Up", "CSPur_Down", "Stat_Up", "Stat_Down", "Closure_Up", "Closure_Down"]),
              DeepTopProducer(args.era, taggerWorkingDirectory, sampleName=args.sampleName, isFastSim=isfastsim, isData=isdata),
-             Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim),
+            ]
+    if isdata:
+        mods.append(Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim, batchSize=args.batchSize))
+    mods += [
              SoftBDeepAK8SFProducer(args.era, taggerWorkingDirectory, isData=isdata, isFastSim=isfastsim, sampleName=args.sampleName),
              Stop0l_trigger(args.era, isData=isdata),
 	     qcdBootstrapProducer(),
@@ -249,10 +282,6 @@ def main(args):
         if isfastsim:
             mods += [
                     btagSFProducer(args.era+"FastSim", algo="deepcsv"),
-                    FastsimOtherVarProducer(isfastsim, "JESUp"),
-                    FastsimOtherVarProducer(isfastsim, "JESDown"),
-                    FastsimOtherVarProducer(isfastsim, "METUnClustUp"),
-                    FastsimOtherVarProducer(isfastsim, "METUnClustDown"),
                     ]
         else:
             mods.append(jecUncertProducer(DataDepInputs[dataType][args.era]["JECMC"]))
@@ -269,14 +298,8 @@ def main(args):
                               saveSFAndSyst=not isdata),
             DeepTopProducer(args.era, taggerWorkingDirectory, "JESUp", sampleName=args.sampleName, isFastSim=isfastsim, isData=isdata),
             DeepTopProducer(args.era, taggerWorkingDirectory, "JESDown", sampleName=args.sampleName, isFastSim=isfastsim, isData=isdata),
-            Stop0lObjectsProducer(args.era, "JESUp"),
-            Stop0lObjectsProducer(args.era, "JESDown"),
-            Stop0lObjectsProducer(args.era, "METUnClustUp"),
-            Stop0lObjectsProducer(args.era, "METUnClustDown"),
-            Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim, applyUncert="JESUp"),
-            Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim, applyUncert="JESDown"),
-            Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim, applyUncert="METUnClustUp"),
-            Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim, applyUncert="METUnClustDown"),
+            ## Needs the Stop0l variables of the DeepTopProducer for all variations
+            Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim, applyUncert=stop0lUncerts, batchSize=args.batchSize),
             PDFUncertiantyProducer(isdata, isSUSY),
             lepSFProducer(args.era),
             lepSFProducer(args.era, muonSelectionTag="Medium",
@@ -318,9 +341,25 @@ def main(args):
 
     if isfastsim:
         GetNISRJetDist(files, DataDepInputs[dataType][args.era]["nISRjets"])
-    p=PostProcessor(args.outputfile,files,cut=None, branchsel=None, outputbranchsel="keep_and_drop.txt", modules=mods,provenance=False,maxEvents=args.maxEvents)
+    ## Only read the input branches stored or used by the modules
+    branchsel = None
+    if not args.readAllBranches:
+        branchsel = writeInputBranchSel(mods, "keep_and_drop.txt", "input_branchsel.txt")
+    if args.stats:
+        mods.append(BranchReadReport())
+    if args.friend:
+        ## Only the new branches, with the index of their parent events
+        mods.insert(0, FriendIndexProducer())
+    if args.profile:
+        ## Time and memory of each module, written next to the output file
+        mods = profileModules(mods)
+
+    p=PostProcessor(args.outputfile,files,cut=None, branchsel=branchsel, outputbranchsel="keep_and_drop.txt", modules=mods,provenance=False,maxEvents=args.maxEvents,
+                    friend=args.friend, postfix=FriendPostfix if args.friend else None)
     #p=PostProcessor(args.outputfile,files,cut="MET_pt > 200", branchsel=None, outputbranchsel="keep_and_drop.txt", modules=mods,provenance=False,maxEvents=args.maxEvents)
     p.run()
+    if args.stats:
+        printObjectCacheStats()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='NanoAOD postprocessing.')
@@ -350,5 +389,26 @@ if __name__ == "__main__":
                         type=int,
                         default = -1,
                         help = 'MAximum number of events to process (Default: all events)')
+    parser.add_argument('--readAllBranches',
+                        action="store_true",
+                        help = 'Read all the input branches, instead of only those stored or used by the modules')
+    parser.add_argument('--preselect',
+                        action="store_true",
+                        help = 'Only keep the events passing the MET and number of jets cuts in any systematic variation (Default: false)')
+    parser.add_argument('--profile',
+                        action="store_true",
+                        help = 'Print and write to <output>_profile.json the time and memory used by each module (Default: false)')
+    parser.add_argument('--stats',
+                        action="store_true",
+                        help = 'Print the input bytes read and the branch sizes of each file, and the hits of the shared object caches (Default: false)')
+    parser.add_argument('--friend',
+                        action="store_true",
+                        help = 'Write only the branches produced by the modules, to a friend tree of the input (Default: false)')
+    parser.add_argument('--batchSize', type=int, default = 1000,
+                        help = 'Number of entries read at once by the columnar path of the Stop0l modules, 0 to process them event by event (Default: 1000)')
+    parser.add_argument('--effCache', type=str, default = "",
+                        help = 'Directory of the cache of the tagging efficiency tables, shared by the jobs (Default: $NANOSUSY_EFFCACHE, else none)')
+    parser.add_argument('--calibBundle', type=str, default = "",
+                        help = 'Calibration bundle of the data/ files, built with buildCalibBundle.py (Default: $NANOSUSY_CALIB, else data/calib.bundle if it exists)')
     args = parser.parse_args()
     main(args)
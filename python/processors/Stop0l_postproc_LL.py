@@ -12,6 +12,7 @@ from PhysicsTools.NanoSUSYTools.modules.qcdSFProducer import *
 from PhysicsTools.NanoSUSYTools.modules.updateEvtWeightFastsim import *
 from PhysicsTools.NanoSUSYTools.modules.SoftBDeepAK8SFProducer import SoftBDeepAK8SFProducer
 from PhysicsTools.NanoSUSYTools.modules.DeepTopProducer import *
+from PhysicsTools.NanoSUSYTools.modules.friendTree import FriendTreeReader, FriendIndexProducer, FriendPostfix, friendFiles
 
 DataDepInputs = {
     "MC": {
@@ -199,8 +200,17 @@ def main(args):
         with open(args.inputfile) as f:
             files = [line.strip() for line in f]
 
-    if process=="limits": p=PostProcessor(args.outputfile,files,cut="Pass_MET && Pass_NJets30", branchsel=None, outputbranchsel="keep_and_drop_limits.txt", modules=mods,provenance=False,maxEvents=args.maxEvents)
-    else: 		  p=PostProcessor(args.outputfile,files,cut="Pass_MET && Pass_NJets30", branchsel=None, outputbranchsel="keep_and_drop_LL.txt", modules=mods,provenance=False,maxEvents=args.maxEvents)
+    cut = "Pass_MET && Pass_NJets30"
+    friend = bool(args.friendDir)
+    if friend:
+        ## The Stop0l flags are in the friend trees, read with their parent
+        ## attached: the cut sees both, and the output is a friend tree of them
+        files = friendFiles(files, args.friendDir)
+        mods = [FriendIndexProducer(), FriendTreeReader()] + mods
+    postfix = FriendPostfix if friend else None
+
+    if process=="limits": p=PostProcessor(args.outputfile,files,cut=cut, branchsel=None, outputbranchsel="keep_and_drop_limits.txt", modules=mods,provenance=False,maxEvents=args.maxEvents,friend=friend,postfix=postfix)
+    else: 		  p=PostProcessor(args.outputfile,files,cut=cut, branchsel=None, outputbranchsel="keep_and_drop_LL.txt", modules=mods,provenance=False,maxEvents=args.maxEvents,friend=friend,postfix=postfix)
     p.run()
 
 if __name__ == "__main__":
@@ -235,5 +245,7 @@ if __name__ == "__main__":
                         help = 'MAximum number of events to process (Default: all events)')
     parser.add_argument('-p', '--process', type=str, default = "",
                         help = "Type of QCD process to do (jetres or smear)")
+    parser.add_argument('--friendDir', type=str, default = "",
+                        help = 'Directory of the friend trees of the input files, written with --friend by Stop0l_postproc.py. They are read instead of the input files, and the output is a friend tree of them (Default: none)')
     args = parser.parse_args()
     main(args)
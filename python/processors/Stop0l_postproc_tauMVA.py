@@ -30,6 +30,7 @@ from PhysicsTools.NanoSUSYTools.modules.Stop0l_trigger import Stop0l_trigger
 from PhysicsTools.NanoSUSYTools.modules.tauMVAProducer import *
 from PhysicsTools.NanoSUSYTools.modules.TauMVAObjectsProducer import *
 from PhysicsTools.NanoSUSYTools.modules.LLObjectsProducer import *
+from PhysicsTools.NanoSUSYTools.modules.friendTree import FriendTreeReader, FriendIndexProducer, FriendPostfix, friendFiles
 
 # JEC files are those recomended here (as of Mar 1, 2019)
 # https://twiki.cern.ch/twiki/bin/view/CMS/JECDataMC#Recommended_for_MC
@@ -165,7 +166,7 @@ def main(args):
 
     mods = []
     if process == "train":
-	mods.append(TauMVAObjectsProducer())
+	mods.append(TauMVAObjectsProducer(trainingFile=args.trainingFile if args.trainingFile else None))
     elif "taumva" in process:
 	#~~~~~ Different modules for Data and MC ~~~~~
 	# These modules must be run first in order to update JEC and MET approperiately for future modules 
@@ -199,7 +200,7 @@ def main(args):
             Stop0lBaselineProducer(args.era, isData=isdata, isFastSim=isfastsim),
             Stop0l_trigger(args.era),
             UpdateEvtWeight(isdata, args.crossSection, args.nEvents, args.sampleName),
-    	    tauMVAProducer(isFakeMVA=isfakemva, isEff=iseff, isData=isdata),
+    	    tauMVAProducer(isFakeMVA=isfakemva, isEff=iseff, isData=isdata, numpyTrees=args.numpyTrees),
     	]
 	if process == "taumvacompare" or process == "taumvaeff": 
 		mods.append(LLObjectsProducer(args.era, isData=isdata))
@@ -269,11 +270,25 @@ def main(args):
             files = [line.strip() for line in f]
 
     if process=="train":    
-	p=PostProcessor(args.outputfile,files,cut="Pass_MET & Pass_Baseline", branchsel=None, outputbranchsel="keep_and_drop_train.txt", typeofprocess="tau", modules=mods,provenance=False)
+	cut = "Pass_MET & Pass_Baseline"
     elif process=="taumva": 
-	p=PostProcessor(args.outputfile,files,cut="MET_pt > 150 & nJet > 3", branchsel=None, outputbranchsel="keep_and_drop_tauMVA.txt", modules=mods,provenance=False)
+	cut = "MET_pt > 150 & nJet > 3"
     elif process == "taumvacompare" or process == "taumvaeff":
-	p=PostProcessor(args.outputfile,files,cut="MET_pt > 200 & nJet > 2", branchsel=None, outputbranchsel="keep_and_drop_tauMVA.txt", modules=mods,provenance=False)
+	cut = "MET_pt > 200 & nJet > 2"
+    friend = bool(args.friendDir)
+    if friend:
+        ## The friend trees are read with their parent attached: the cut sees
+        ## the branches of both, and the output is a friend tree of them
+        files = friendFiles(files, args.friendDir)
+        mods = [FriendIndexProducer(), FriendTreeReader()] + mods
+    postfix = FriendPostfix if friend else None
+
+    if process=="train":    
+	p=PostProcessor(args.outputfile,files,cut=cut, branchsel=None, outputbranchsel="keep_and_drop_train.txt", typeofprocess="tau", modules=mods,provenance=False,friend=friend,postfix=postfix)
+    elif process=="taumva": 
+	p=PostProcessor(args.outputfile,files,cut=cut, branchsel=None, outputbranchsel="keep_and_drop_tauMVA.txt", modules=mods,provenance=False,friend=friend,postfix=postfix)
+    elif process == "taumvacompare" or process == "taumvaeff":
+	p=PostProcessor(args.outputfile,files,cut=cut, branchsel=None, outputbranchsel="keep_and_drop_tauMVA.txt", modules=mods,provenance=False,friend=friend,postfix=postfix)
     p.run()
 
 if __name__ == "__main__":
@@ -306,5 +321,11 @@ if __name__ == "__main__":
                         help = 'Maximum number of events to process (Default: all events)')
     parser.add_argument('-p', '--process', type=str, default = "",
                         help = "Type of QCD process to do (jetres or smear)")
+    parser.add_argument('--friendDir', type=str, default = "",
+                        help = 'Directory of the friend trees of the input files, written with --friend by Stop0l_postproc.py. They are read instead of the input files, and the output is a friend tree of them (Default: none)')
+    parser.add_argument('--numpyTrees', action="store_true", default = False,
+                        help = 'Evaluate the tau MVA models with NumPy instead of xgboost (Default: xgboost)')
+    parser.add_argument('--trainingFile', type=str, default = "",
+                        help = 'With -p train, write the candidates to the .npy column chunks <trainingFile>_<job>_<n>/ instead of the output tree (Default: tree)')
     args = parser.parse_args()
     main(args)
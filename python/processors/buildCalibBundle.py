@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+import argparse
+
+from PhysicsTools.NanoSUSYTools.modules.calibBundle import buildCalibBundle, DataDir, CalibBundlePath, CalibDirectories
+
+## Extract the histograms and graphs of the ROOT files of data/ into the
+## calibration bundle read by the modules. To be rerun whenever a file of data/
+## changes: the jobs read a changed file with ROOT instead of the bundle.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the calibration bundle of the data/ ROOT files.')
+    parser.add_argument('-d', '--dataDir', type=str, default = DataDir,
+                        help = 'Directory of the calibration files (Default: data/ of NanoSUSYTools)')
+    parser.add_argument('-o', '--outputfile', type=str, default = CalibBundlePath,
+                        help = 'Bundle to write (Default: $NANOSUSY_CALIB, else data/calib.bundle)')
+    parser.add_argument('--dirs', nargs='+', default = CalibDirectories,
+                        help = 'Subdirectories of the data directory to extract (Default: %s)' % " ".join(CalibDirectories))
+    args = parser.parse_args()
+    buildCalibBundle(args.dataDir, args.outputfile, args.dirs)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+import os
+import math
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
+from PhysicsTools.NanoSUSYTools.modules.Stop0lObjectsProducer import Stop0lObjectsProducer
+from PhysicsTools.NanoSUSYTools.modules.Stop0lBaselineProducer import Stop0lBaselineProducer, EventFilters, DataOnlyFilters, FullSimOnlyFilters
+
+## The columnar paths of the Stop0l modules (batchSize > 0) against their
+## per-event reference, on a synthetic NanoAOD tree run through the
+## PostProcessor. As in Stop0l_postproc.py, a previous module fills the
+## electron ID and the JES/MET variations; the input file holds stale values of
+## these branches, which the columnar paths must not read.
+##   python test/testColumnarPaths.py
+
+NEvents    = 600
+BatchSize  = 64
+MaxObjects = 16
+Uncerts    = ["nominal", "JESUp", "JESDown", "METUnClustUp", "METUnClustDown"]
+
+## Input branches of the collections as (branch, type)
+Collections = {
+    "Electron" : [("pt", "F"), ("eta", "F"), ("phi", "F"), ("cutBasedNoIso", "I"), ("miniPFRelIso_all", "F")],
+    "Muon"     : [("pt", "F"), ("eta", "F"), ("phi", "F"), ("miniPFRelIso_all", "F")],
+    "IsoTrack" : [("pt", "F"), ("phi", "F"), ("pdgId", "I"), ("pfRelIso03_chg", "F")],
+    "Tau"      : [("pt", "F"), ("eta", "F"), ("phi", "F"), ("idDecayMode", "O"), ("idMVAoldDM2017v2", "b")],
+    "Jet"      : [("pt", "F"), ("eta", "F"), ("phi", "F"), ("btagDeepB", "F"), ("jetId", "I"),
+                  ("pt_jesTotalUp", "F"), ("pt_jesTotalDown", "F")],
+    "SB"       : [("eta", "F"), ("phi", "F"), ("ntracks", "I"), ("dxy", "F"), ("dlenSig", "F"), ("DdotP", "F")],
+    "Photon"   : [("eta", "F"), ("cutBased", "I"), ("cutBasedBitmap", "I")],
+}
+JetVariations = ["jesTotalUp", "jesTotalDown"]
+METVariations = ["jesTotalUp", "jesTotalDown", "unclustEnUp", "unclustEnDown"]
+Scalars = [("MET_pt", "F"), ("MET_phi", "F"), ("CaloMET_pt", "F")] + [("MET_%s_%s" % (var, v), "F") for v in METVariations for var in ("pt", "phi")]
+Scalars += [("Flag_" + f, "O") for f in sorted(set(sum(EventFilters.values(), []) + DataOnlyFilters + FullSimOnlyFilters))]
+## Stop0l variables of the top taggers, filled before the baseline
+TopVariables = ["nTop", "nW", "nResolved", "ISRJetPt"]
+
+NumpyTypes = {"F" : np.float32, "I" : np.int32, "O" : np.bool_, "b" : np.uint8}
+
+def randomValue(br, t):
+    if t == "O":
+        return random.random() < 0.7
+    if br == "eta":
+        return random.uniform(-3, 3)
+    if br == "phi":
+        return random.uniform(-math.pi, math.pi)
+    if br == "pdgId":
+        return random.choice([11, -13, 211, -211])
+    if br == "idMVAoldDM2017v2":
+        return random.choice([0, 8, 15, 31])
+    if br == "jetId":
+        return random.choice([0, 2, 6])
+    if t == "I":
+        return random.randint(0, 4)
+    if br.startswith("pt"):
+        return random.uniform(3, 300)
+    return random.uniform(0, 1.2)
+
+def softbBoundaryPairs(event):
+    """A jet and SVs around dR = 0.4 of it, at the float32 values on both sides
+    of the boundary, where only the overlap with the jet decides SB_Stop0l"""
+    jet = dict((br, randomValue(br, t)) for br, t in Collections["Jet"])
+    jet.update(pt=50., eta=0.5, phi=0.5, pt_jesTotalUp=50., pt_jesTotalDown=50.)
+    svs = []
+    for k in xrange(4):
+        a = 2 * math.pi * k / 4 + 0.3
+        eta, phi = np.float32(0.5 + 0.4 * math.cos(a)), np.float32(0.5 + 0.4 * math.sin(a))
+        for d in (-np.inf, np.inf):
+            svs.append(dict(eta=float(np.nextafter(eta, np.float32(d))), phi=float(phi), ntracks=4, dxy=0.1, dlenSig=5., DdotP=0.99))
+        svs.append(dict(eta=float(eta), phi=float(phi), ntracks=4, dxy=0.1, dlenSig=5., DdotP=0.99))
+    event["Jet"] = [jet]
+    event["SB"]  = svs
+
+def makeEvents(seed=42):
+    random.seed(seed)
+    events = []
+    for i in xrange(NEvents):
+        event = {}
+        for coll, branches in Collections.items():
+            event[coll] = [dict((br, randomValue(br, t)) for br, t in branches) for _ in xrange(random.randint(0, 6 if coll != "Jet" else 12))]
+        for name, t in Scalars:
+            if t == "O":
+                event[name] = random.random() > 0.05
+            else:
+                event[name] = random.uniform(-math.pi, math.pi) if "phi" in name else random.uniform(0, 600)
+        if i % 50 == 7:
+            softbBoundaryPairs(event)
+        events.append(event)
+    return events
+
+def writeInput(fileName, events):
+    f = ROOT.TFile(fileName, "RECREATE")
+    tree = ROOT.TTree("Events", "Events")
+    buffers = {}
+    for coll, branches in Collections.items():
+        buffers["n" + coll] = np.zeros(1, dtype=np.int32)
+        tree.Branch("n" + coll, buffers["n" + coll], "n%s/I" % coll)
+        for br, t in branches:
+            name = coll + "_" + br
+            buffers[name] = np.zeros(MaxObjects, dtype=NumpyTypes[t])
+            tree.Branch(name, buffers[name], "%s[n%s]/%s" % (name, coll, t))
+    for name, t in Scalars:
+        buffers[name] = np.zeros(1, dtype=NumpyTypes[t])
+        tree.Branch(name, buffers[name], "%s/%s" % (name, t))
+    for event in events:
+        for coll, branches in Collections.items():
+            objects = event[coll][:MaxObjects]
+            buffers["n" + coll][0] = len(objects)
+            for br, t in branches:
+                for i, obj in enumerate(objects):
+                    buffers[coll + "_" + br][i] = obj[br]
+        for name, t in Scalars:
+            buffers[name][0] = event[name]
+        tree.Fill()
+    tree.Write()
+    f.Close()
+
+class UpstreamVariations(Module):
+    """Fills the electron ID and the JES/MET variations, as eleMiniCutID and
+    jetmetUncertainties do before the Stop0l modules, with values differing
+    from the stale ones of the input file"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.out.branch("Electron_cutBasedNoIso", "I", lenVar="nElectron")
+        for v in JetVariations:
+            self.out.branch("Jet_pt_" + v, "F", lenVar="nJet")
+        for v in METVariations:
+            self.out.branch("MET_pt_"  + v, "F")
+            self.out.branch("MET_phi_" + v, "F")
+
+    def analyze(self, event):
+        electrons = Collection(event, "Electron")
+        jets      = Collection(event, "Jet")
+        met       = Object(event, "MET")
+        self.out.fillBranch("Electron_cutBasedNoIso", [int(abs(e.eta) * 10) % 4 for e in electrons])
+        for v, scale in zip(JetVariations, (1.08, 0.92)):
+            self.out.fillBranch("Jet_pt_" + v, [j.pt * scale for j in jets])
+        for i, v in enumerate(METVariations):
+            self.out.fillBranch("MET_pt_"  + v, met.pt * (0.9 + 0.05 * i))
+            self.out.fillBranch("MET_phi_" + v, ROOT.TVector2.Phi_mpi_pi(met.phi + 0.1 * (i - 2)))
+        return True
+
+class UpstreamTopVariables(Module):
+    """Fills the Stop0l variables of the top taggers used by the baseline, as
+    TopTaggerProducer and DeepTopProducer do for each JES variation"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        for suffix in ("", "_JESUp", "_JESDown"):
+            for var in TopVariables:
+                self.out.branch("Stop0l_" + var + suffix, "F" if var == "ISRJetPt" else "I")
+
+    def analyze(self, event):
+        random.seed(event._entry)
+        for suffix in ("", "_JESUp", "_JESDown"):
+            for var in TopVariables:
+                self.out.fillBranch("Stop0l_" + var + suffix, random.uniform(100, 400) if var == "ISRJetPt" else random.choice([0, 0, 1]))
+        return True
+
+def readOutput(fileName):
+    """[{branch : value or list of values}] of the output tree"""
+    f = ROOT.TFile.Open(fileName)
+    tree = f.Get("Events")
+    names = [br.GetName() for br in tree.GetListOfBranches()]
+    entries = []
+    for i in xrange(tree.GetEntries()):
+        tree.GetEntry(i)
+        entry = {}
+        for name in names:
+            leaf = tree.GetLeaf(name)
+            if leaf.GetLeafCount():
+                entry[name] = [leaf.GetValue(k) for k in xrange(leaf.GetLen())]
+            else:
+                entry[name] = leaf.GetValue()
+        entries.append(entry)
+    f.Close()
+    return entries
+
+class ColumnarPathTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.inputFile = os.path.join(cls.workDir, "synthetic.root")
+        writeInput(cls.inputFile, makeEvents())
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir)
+
+    def process(self, name, modules):
+        outputDir = os.path.join(self.workDir, name)
+        os.mkdir(outputDir)
+        p = PostProcessor(outputDir, [self.inputFile], cut=None, branchsel=None, modules=modules, provenance=False, postfix="")
+        p.run()
+        return readOutput(os.path.join(outputDir, os.path.basename(self.inputFile)))
+
+    def compare(self, reference, columnar):
+        self.assertEqual(len(reference), len(columnar))
+        for i, (ref, col) in enumerate(zip(reference, columnar)):
+            self.assertEqual(sorted(ref.keys()), sorted(col.keys()))
+            for name in ref:
+                self.assertEqual(ref[name], col[name], "%s differs in entry %d: %s != %s" % (name, i, ref[name], col[name]))
+
+    def testObjects(self):
+        for era in ("2016", "2017"):
+            columnar = Stop0lObjectsProducer(era, Uncerts, batchSize=BatchSize)
+            reference = self.process("objects%s" % era, [UpstreamVariations(), Stop0lObjectsProducer(era, Uncerts)])
+            self.compare(reference, self.process("objectsColumnar%s" % era, [UpstreamVariations(), columnar]))
+            ## The variation independent selections not read from the event are computed per batch
+            self.assertTrue(columnar.columnGroups.batchGroups)
+            self.assertTrue(columnar.columnGroups.eventGroups)
+            ## The SVs at dR = 0.4 of a jet are rejected as in deltaR(), both sides
+            self.assertIn(False, reference[7]["SB_Stop0l"])
+            self.assertIn(True,  reference[7]["SB_Stop0l"])
+
+    def testBaseline(self):
+        for era, isData in (("2016", False), ("2018", False), ("2018", True)):
+            uncerts = None if isData else Uncerts
+            columnar = Stop0lBaselineProducer(era, isData=isData, applyUncert=uncerts, batchSize=BatchSize)
+            modules  = [UpstreamVariations(), Stop0lObjectsProducer(era, uncerts), UpstreamTopVariables()]
+            reference = self.process("baseline%s%s" % (era, isData), modules + [Stop0lBaselineProducer(era, isData=isData, applyUncert=uncerts)])
+            modules  = [UpstreamVariations(), Stop0lObjectsProducer(era, uncerts, batchSize=BatchSize), UpstreamTopVariables()]
+            self.compare(reference, self.process("baselineColumnar%s%s" % (era, isData), modules + [columnar]))
+            ## The event filter, jet ID, CaloMET and HEM flags of the nominal jets and MET are computed per batch
+            self.assertTrue(columnar.columnGroups.batchGroups)
+            self.assertTrue(columnar.columnGroups.eventGroups)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+import os
+import math
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection, Object
+from PhysicsTools.NanoSUSYTools.modules.friendTree import FriendIndexProducer, FriendTreeReader, FriendTreeName, FriendPostfix, \
+        ParentAlias, friendFiles
+from PhysicsTools.NanoSUSYTools.modules.GenPartFilter import GenPartFilter
+from PhysicsTools.NanoSUSYTools.modules.UpdateMETProducer import UpdateMETProducer
+from PhysicsTools.NanoSUSYTools.modules.updateJetIDProducer import UpdateJetID
+
+## The friend tree mode on a synthetic MC NanoAOD tree: the first stage runs
+## the modules of Stop0l_postproc.py rewriting input branches (GenPartFilter,
+## UpdateMETProducer, UpdateJetID) with --friend, and must give the values of
+## the full output. A later stage reads the friend files with a PostProcessor
+## cut on their branches, and writes a friend tree of them.
+##   python test/testFriendTrees.py
+
+NEvents    = 500
+MaxObjects = 24
+
+## Input branches of the collections as (branch, type)
+Collections = {
+    "Jet"     : [("pt", "F"), ("eta", "F"), ("phi", "F"), ("jetId", "I"), ("neHEF", "F"), ("neEmEF", "F"), ("chHEF", "F"),
+                 ("muEF", "F"), ("chEmEF", "F"), ("chHadMult", "b"), ("elMult", "b"), ("muMult", "b"), ("nConstituents", "b")],
+    "GenPart" : [("pt", "F"), ("eta", "F"), ("phi", "F"), ("mass", "F"), ("genPartIdxMother", "I"), ("pdgId", "I"),
+                 ("status", "I"), ("statusFlags", "I")],
+}
+METBranches = ["pt", "phi", "sumEt", "MetUnclustEnUpDeltaX", "MetUnclustEnUpDeltaY"]
+Scalars = [("run", "i"), ("luminosityBlock", "i"), ("event", "l")]
+Scalars += [("%s_%s" % (met, br), "F") for met in ("MET", "METFixEE2017") for br in METBranches]
+
+NumpyTypes = {"F" : np.float32, "I" : np.int32, "b" : np.uint8, "i" : np.uint32, "l" : np.uint64}
+
+## First stage branches compared with the full output, and later stage cut
+FirstStageBranches = ["MET_pt", "MET_phi", "nJet", "Jet_pt", "Jet_jetId", "nGenPart", "GenPart_pt", "GenPart_pdgId",
+                      "GenPart_genPartIdxMother", "GenPart_momPdgId", "Pass_MET", "Stop0l_nJets"]
+LaterStageCut = "Pass_MET && Stop0l_nJets >= 2"
+
+def randomObject(coll, branches, index):
+    obj = {}
+    for br, t in branches:
+        if br == "genPartIdxMother":
+            obj[br] = random.randint(-1, index - 1) if index > 1 else -1
+        elif br == "pdgId":
+            obj[br] = random.choice([1, -2, 5, 6, -6, 11, 22, 24, -24, 1000006])
+        elif br == "status":
+            obj[br] = random.choice([1, 2, 22, 23, 62])
+        elif br == "statusFlags":
+            obj[br] = random.choice([0, 0x100, 0x2000, 0x2080, 0x2100, 0x2180])
+        elif br in ("eta", "phi"):
+            obj[br] = random.uniform(-3, 3) if br == "eta" else random.uniform(-math.pi, math.pi)
+        elif t == "b":
+            obj[br] = random.randint(0, 12)
+        elif t == "I":
+            obj[br] = random.choice([0, 2, 6])
+        elif br == "pt":
+            obj[br] = random.uniform(20, 300)
+        else:
+            obj[br] = random.uniform(0, 1)
+    return obj
+
+def makeEvents(seed=7):
+    random.seed(seed)
+    events = []
+    for i in xrange(NEvents):
+        event = {"run" : 1, "luminosityBlock" : i // 100 + 1, "event" : 10000 + 3 * i}
+        for coll, branches in Collections.items():
+            event[coll] = [randomObject(coll, branches, k) for k in xrange(random.randint(0, 12 if coll == "Jet" else MaxObjects))]
+        for name, t in Scalars[3:]:
+            event[name] = random.uniform(-math.pi, math.pi) if name.endswith("_phi") else random.uniform(0, 600)
+        events.append(event)
+    return events
+
+def writeInput(fileName, events):
+    f = ROOT.TFile(fileName, "RECREATE")
+    tree = ROOT.TTree("Events", "Events")
+    buffers = {}
+    for name, t in Scalars:
+        buffers[name] = np.zeros(1, dtype=NumpyTypes[t])
+        tree.Branch(name, buffers[name], "%s/%s" % (name, t))
+    for coll, branches in Collections.items():
+        buffers["n" + coll] = np.zeros(1, dtype=np.int32)
+        tree.Branch("n" + coll, buffers["n" + coll], "n%s/I" % coll)
+        for br, t in branches:
+            name = coll + "_" + br
+            buffers[name] = np.zeros(MaxObjects, dtype=NumpyTypes[t])
+            tree.Branch(name, buffers[name], "%s[n%s]/%s" % (name, coll, t))
+    for event in events:
+        for name, t in Scalars:
+            buffers[name][0] = event[name]
+        for coll, branches in Collections.items():
+            buffers["n" + coll][0] = len(event[coll])
+            for br, t in branches:
+                for i, obj in enumerate(event[coll]):
+                    buffers[coll + "_" + br][i] = obj[br]
+        tree.Fill()
+    tree.Write()
+    f.Close()
+
+class SelectionFlags(Module):
+    """Flags of the rewritten MET and jet ID, as Stop0lBaselineProducer fills
+    them for the later stages"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.out.branch("Pass_MET",     "O")
+        self.out.branch("Stop0l_nJets", "I")
+
+    def analyze(self, event):
+        jets = Collection(event, "Jet")
+        self.out.fillBranch("Pass_MET",     Object(event, "MET").pt > 250)
+        self.out.fillBranch("Stop0l_nJets", sum(1 for j in jets if j.jetId & 2))
+        return True
+
+class JetHT(Module):
+    """A later stage variable, of the input jets and of the rewritten jet ID"""
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.out.branch("Stop0l_HT", "F")
+
+    def analyze(self, event):
+        self.out.fillBranch("Stop0l_HT", sum(j.pt for j in Collection(event, "Jet") if j.jetId & 2))
+        return True
+
+def firstStageModules():
+    """The modules of Stop0l_postproc.py rewriting input branches, for 2017 and 2018 MC"""
+    return [UpdateMETProducer("METFixEE2017"),
+            UpdateJetID("2018"),
+            GenPartFilter(statusFlags = [0x2100, 0x2080, 0x2000, 0], pdgIds = [0, 0, 22, 0], statuses = [0, 0, 1, 23]),
+            SelectionFlags()]
+
+def readEntries(fileName, treeName, names):
+    """[{branch : value or list of values}] of a tree, the branches being read
+    from its friends if it has none of that name"""
+    f = ROOT.TFile.Open(fileName)
+    tree = f.Get(treeName)
+    entries = []
+    for i in xrange(tree.GetEntries()):
+        tree.GetEntry(i)
+        entry = {}
+        for name in names:
+            leaf = tree.GetLeaf(name)
+            if leaf.GetLeafCount():
+                entry[name] = [leaf.GetValue(k) for k in xrange(leaf.GetLen())]
+            else:
+                entry[name] = leaf.GetValue()
+        entries.append(entry)
+    f.Close()
+    return entries
+
+class FriendTreeTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workDir = tempfile.mkdtemp()
+        cls.inputFile = os.path.join(cls.workDir, "synthetic.root")
+        writeInput(cls.inputFile, makeEvents())
+        cls.fullDir   = cls.process("full",   [cls.inputFile], firstStageModules())
+        cls.friendDir = cls.process("friend", [cls.inputFile], [FriendIndexProducer()] + firstStageModules(), friend=True)
+        cls.reference = readEntries(os.path.join(cls.fullDir, os.path.basename(cls.inputFile)), "Events", FirstStageBranches)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workDir)
+
+    @classmethod
+    def process(cls, name, files, modules, cut=None, friend=False):
+        outputDir = os.path.join(cls.workDir, name)
+        os.mkdir(outputDir)
+        p = PostProcessor(outputDir, files, cut=cut, branchsel=None, modules=modules, provenance=False,
+                          friend=friend, postfix=FriendPostfix if friend else "")
+        p.run()
+        return outputDir
+
+    def testFirstStage(self):
+        friendFile = friendFiles([self.inputFile], self.friendDir)[0]
+        entries = readEntries(friendFile, FriendTreeName, FirstStageBranches + ["parentEntry"])
+        self.assertEqual(len(entries), NEvents)
+        for i, (ref, entry) in enumerate(zip(self.reference, entries)):
+            self.assertEqual(entry["parentEntry"], i)
+            for name in FirstStageBranches:
+                self.assertEqual(ref[name], entry[name], "%s differs in entry %d: %s != %s" % (name, i, ref[name], entry[name]))
+        ## The rewritten branches differ from those of the parent
+        parent = readEntries(self.inputFile, "Events", ["MET_pt", "nGenPart"])
+        self.assertTrue(any(p["MET_pt"] != ref["MET_pt"] for p, ref in zip(parent, self.reference)))
+        self.assertTrue(any(p["nGenPart"] != ref["nGenPart"] for p, ref in zip(parent, self.reference)))
+        ## The parent is attached with the friend tree
+        f = ROOT.TFile.Open(friendFile)
+        self.assertTrue(f.Get(FriendTreeName).GetFriend(ParentAlias))
+        f.Close()
+
+    def testLaterStage(self):
+        modules = [FriendIndexProducer(), FriendTreeReader(), JetHT()]
+        outputDir = self.process("later", friendFiles([self.inputFile], self.friendDir), modules, cut=LaterStageCut, friend=True)
+        outputFile = friendFiles(friendFiles([self.inputFile], self.friendDir), outputDir)[0]
+        entries = readEntries(outputFile, FriendTreeName, ["parentEntry", "Stop0l_HT", "MET_pt", "Jet_pt", "Jet_jetId"])
+        selected = [i for i, ref in enumerate(self.reference) if ref["Pass_MET"] and ref["Stop0l_nJets"] >= 2]
+        self.assertTrue(0 < len(selected) < NEvents)
+        self.assertEqual([int(entry["parentEntry"]) for entry in entries], selected)
+        for i, entry in zip(selected, entries):
+            ref = self.reference[i]
+            ## The branches of the first stage and of its parent are found through the index
+            for name in ("MET_pt", "Jet_pt", "Jet_jetId"):
+                self.assertEqual(ref[name], entry[name], "%s differs in entry %d: %s != %s" % (name, i, ref[name], entry[name]))
+            ht = sum(pt for pt, jetId in zip(ref["Jet_pt"], ref["Jet_jetId"]) if int(jetId) & 2)
+            self.assertAlmostEqual(entry["Stop0l_HT"], ht, delta=1e-4 * ht)
+
+    def testSkimmedParent(self):
+        ## The NanoAOD parent has no index: a cut in the first stage raises
+        with self.assertRaises(RuntimeError):
+            self.process("skimmed", [self.inputFile], [FriendIndexProducer()] + firstStageModules(), cut="MET_pt > 300", friend=True)
+
+if __name__ == "__main__":
+    unittest.main()
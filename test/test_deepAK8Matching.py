@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import sys
+import math
+import time
+import resource
+import subprocess
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules.deepAK8Matching import minGroupMaxDR, countWithinDR, \
+        fatJetGenMatchType, fatJetGenPartCount, eventOffsets
+
+## The gen matching kernels of deepAK8Matching against the meshgrid code they
+## replaced in SoftBDeepAK8SFProducer, on random busy events: up to 7 fat jets,
+## 3 hadronic tops, 2 hadronic Ws and 30 gen partons, part of them close to the
+## fat jets.
+##   python -m pytest test/test_deepAK8Matching.py   agreement with the old code
+##   python test/test_deepAK8Matching.py             same, without pytest
+##   python test/test_deepAK8Matching.py --bench     time and peak memory
+
+NEvents = 3000
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Old code ~~~~~
+def deltaRMatch(fatJetEta, fatJetPhi, genTopDaughters_eta, genTopDaughters_phi, genWDaughters_eta, genWDaughters_phi):
+
+    matches = np.zeros(len(fatJetEta), dtype=int)
+
+    if len(genWDaughters_eta):
+
+        wEtaVals = np.array(np.meshgrid(fatJetEta, genWDaughters_eta)).T.reshape(-1,2)
+        wPhiVals = np.array(np.meshgrid(fatJetPhi, genWDaughters_phi)).T.reshape(-1,2)
+
+        ## Using ufunc for vector operation
+        deta = np.power(wEtaVals[:,0] - wEtaVals[:,1], 2)
+        dPhi = wPhiVals[:,0] - wPhiVals[:,1]
+        dR = np.sqrt((( abs(abs(dPhi)-np.pi)-np.pi )**2+(deta)**2)).reshape([-1,len(genWDaughters_eta)//2, 2])
+
+        matches[dR.max(axis=2).min(axis=1) < 0.6] = 2
+
+    if len(genTopDaughters_eta):
+
+        topEtaVals = np.array(np.meshgrid(fatJetEta, genTopDaughters_eta)).T.reshape(-1,2)
+        topPhiVals = np.array(np.meshgrid(fatJetPhi, genTopDaughters_phi)).T.reshape(-1,2)
+
+        ## Using ufunc for vector operation
+        deta = np.power(topEtaVals[:,0] - topEtaVals[:,1], 2)
+        dPhi = topPhiVals[:,0] - topPhiVals[:,1]
+        dR = np.sqrt((( abs(abs(dPhi)-np.pi)-np.pi )**2+(deta)**2)).reshape([-1,len(genTopDaughters_eta)//3, 3])
+
+        matches[dR.max(axis=2).min(axis=1) < 0.6] = 1
+
+    return matches
+
+def nGenPartMatch(fatJet_eta, fatJet_phi, genEta, genPhi):
+    """dR loop of the old SoftBDeepAK8SFProducer.nGenParts"""
+    etas = np.array(np.meshgrid(fatJet_eta, genEta)).T
+    deta = np.power(etas[:, :, 0] - etas[:, :, 1], 2)
+    phis = np.array(np.meshgrid(fatJet_phi, genPhi)).T
+    dPhi = phis[:, :, 0] - phis[:, :, 1]
+    np.subtract(dPhi, 2*math.pi, out = dPhi, where= (dPhi >=math.pi))
+    np.add(dPhi, 2*math.pi,  out =dPhi , where=(dPhi < -1*math.pi))
+    np.power(dPhi, 2, out=dPhi)
+    dR2 = np.add(deta, dPhi)
+    return (dR2 < 0.6*0.6).sum(axis=1)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Events ~~~~~
+def near(rng, eta, phi, n, spread=0.5):
+    """n (eta, phi) around a fat jet, phi wrapped into [-pi, pi)"""
+    etas = eta + rng.uniform(-spread, spread, n)
+    phis = (phi + rng.uniform(-spread, spread, n) + math.pi) % (2*math.pi) - math.pi
+    return etas, phis
+
+def makeEvents(nEvents=NEvents, seed=15):
+    """[(fatJet eta, phi, top daughters eta, phi, W daughters eta, phi, partons eta, phi)]"""
+    rng = np.random.RandomState(seed)
+    events = []
+    for i in range(nEvents):
+        nFat = rng.randint(0, 8)
+        fatEta, fatPhi = rng.uniform(-2.4, 2.4, nFat), rng.uniform(-math.pi, math.pi, nFat)
+        decays = []
+        for nDau, nMax in ((3, 3), (2, 2)):
+            etas, phis = [], []
+            for d in range(rng.randint(0, nMax + 1)):
+                if nFat and rng.uniform() < 0.6:
+                    j = rng.randint(nFat)
+                    eta, phi = near(rng, fatEta[j], fatPhi[j], nDau)
+                else:
+                    eta, phi = rng.uniform(-2.5, 2.5, nDau), rng.uniform(-math.pi, math.pi, nDau)
+                etas.append(eta)
+                phis.append(phi)
+            decays += [np.concatenate(etas) if etas else np.zeros(0), np.concatenate(phis) if phis else np.zeros(0)]
+        nPart = rng.randint(0, 31)
+        partEta, partPhi = rng.uniform(-2.5, 2.5, nPart), rng.uniform(-math.pi, math.pi, nPart)
+        if nFat:
+            eta, phi = near(rng, fatEta[0], fatPhi[0], nPart // 3, 0.8)
+            partEta[:len(eta)], partPhi[:len(phi)] = eta, phi
+        events.append((fatEta, fatPhi) + tuple(decays) + (partEta, partPhi))
+    return events
+
+def concatenate(events, k):
+    """Flat array of the k-th arrays of the events, and its offsets"""
+    arrays = [event[k] for event in events]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    np.cumsum([len(a) for a in arrays], out=offsets[1:])
+    return offsets, np.concatenate(arrays) if arrays else np.zeros(0)
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Matchings ~~~~~
+def iterOldMatching(events):
+    for event in events:
+        yield deltaRMatch(*event[:6]), nGenPartMatch(event[0], event[1], event[6], event[7])
+
+def iterEventMatching(events):
+    """One call of the kernels per event, as SoftBDeepAK8SFProducer"""
+    for fatEta, fatPhi, topEta, topPhi, wEta, wPhi, partEta, partPhi in events:
+        fatOffsets = eventOffsets(len(fatEta))
+        yield (fatJetGenMatchType(fatOffsets, fatEta, fatPhi, eventOffsets(len(topEta)), topEta, topPhi, eventOffsets(len(wEta)), wEta, wPhi),
+               fatJetGenPartCount(fatOffsets, fatEta, fatPhi, eventOffsets(len(partEta)), partEta, partPhi))
+
+def flatten(events):
+    """Flat arrays of all the events, as (offsets, eta, phi) of the fat jets,
+    top daughters, W daughters and partons"""
+    return [concatenate(events, k)[0:2] + (concatenate(events, k + 1)[1], ) for k in (0, 2, 4, 6)]
+
+def batchMatching(flat):
+    """One call of the kernels for all the events"""
+    fatJets, tops, ws, parts = flat
+    return fatJetGenMatchType(*(fatJets + tops + ws)), fatJetGenPartCount(*(fatJets + parts))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Tests ~~~~~
+_reference = {}
+
+def eventsAndReference():
+    """Events and results of the old code, made once for all the tests"""
+    if not _reference:
+        _reference["events"]  = makeEvents()
+        _reference["results"] = list(iterOldMatching(_reference["events"]))
+    return _reference["events"], _reference["results"]
+
+def compare(reference, results):
+    results = list(results)
+    assert len(results) == len(reference)
+    for i, ((refMatch, refCount), (match, count)) in enumerate(zip(reference, results)):
+        assert list(refMatch) == list(match), "FatJet_GenMatch differs in event %d" % i
+        assert list(refCount) == list(count), "FatJet_nGenPart differs in event %d" % i
+
+def test_eventMatching():
+    events, reference = eventsAndReference()
+    compare(reference, iterEventMatching(events))
+
+def test_batchMatching():
+    events, reference = eventsAndReference()
+    flat = flatten(events)
+    matches, counts = batchMatching(flat)
+    offsets = flat[0][0]
+    compare(reference, [(matches[offsets[i]:offsets[i+1]], counts[offsets[i]:offsets[i+1]]) for i in range(len(events))])
+
+def test_matchesFound():
+    ## The events have matched tops and Ws, and partons within dR
+    events, reference = eventsAndReference()
+    matches = np.concatenate([m for m, c in reference])
+    counts  = np.concatenate([c for m, c in reference])
+    assert (matches == 1).any() and (matches == 2).any()
+    assert (counts > 3).any()
+
+def test_groupBoundaries():
+    ## A decay is matched on its largest dR, the best decay is kept
+    offsets = eventOffsets(1)
+    dauEta, dauPhi = np.array([0.1, 0.2, 0.9, 0.05, 0.05]), np.zeros(5)
+    maxDR = minGroupMaxDR(offsets, np.zeros(1), np.zeros(1), eventOffsets(4), dauEta[:4], dauPhi[:4], 2)
+    assert abs(maxDR[0] - 0.2**2) < 1e-12
+    assert minGroupMaxDR(offsets, np.zeros(1), np.zeros(1), eventOffsets(0), dauEta[:0], dauPhi[:0], 3)[0] == np.inf
+    assert countWithinDR(offsets, np.zeros(1), np.zeros(1), eventOffsets(5), dauEta, dauPhi, 0.6*0.6)[0] == 4
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Benchmark ~~~~~
+def consume(results):
+    for result in results:
+        pass
+
+def variants(events, flat):
+    return [("meshgrid code",               lambda : consume(iterOldMatching(events))),
+            ("kernels, one call per event", lambda : consume(iterEventMatching(events))),
+            ("kernels, one call per batch", lambda : batchMatching(flat))]
+
+def maxRSS():
+    """Peak resident memory of the process in MB (ru_maxrss is in kB on Linux)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+def measureVariant(iVariant, nRepeat=3):
+    """Best time per event in us of a variant, and the growth in MB of the peak
+    resident memory of the process while it runs, once the events are built
+    and the kernels compiled on a few events"""
+    events = makeEvents()
+    flat   = flatten(events)
+    name, function = variants(events, flat)[iVariant]
+    variants(events[:10], flatten(events[:10]))[iVariant][1]()
+    peakBefore = maxRSS()
+    best = float("inf")
+    for i in range(nRepeat):
+        start = time.time()
+        function()
+        best = min(best, time.time() - start)
+    return name, best / len(events) * 1e6, maxRSS() - peakBefore
+
+def benchmark():
+    """Each variant is measured in a new process, so that the peak memory of
+    one does not hide that of the next"""
+    try:
+        import numba
+        numbaVersion = numba.__version__
+    except ImportError:
+        numbaVersion = "off"
+    print("python %d.%d, numpy %s, numba %s, %d events" % (sys.version_info[0], sys.version_info[1], np.__version__, numbaVersion, NEvents))
+    for iVariant in range(3):
+        output = subprocess.check_output([sys.executable, __file__, "--variant", str(iVariant)])
+        print(output.decode().rstrip())
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        benchmark()
+    elif "--variant" in sys.argv:
+        name, perEvent, peak = measureVariant(int(sys.argv[sys.argv.index("--variant") + 1]))
+        print("%-30s %8.1f us/event   peak memory growth %6.2f MB" % (name, perEvent, peak))
+    else:
+        for name, test in sorted(globals().items()):
+            if name.startswith("test_"):
+                test()
+        print("ok")
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules.trainingSample import ChunkedColumnWriter, chunkDirs, removeChunks, \
+        iterChunks, loadSample
+
+## The chunks of the training samples: written by several jobs sharing a
+## prefix, read back together, and removed without touching the directories
+## which are not chunks of the prefix.
+##   python -m pytest test/test_trainingSample.py
+##   python test/test_trainingSample.py
+
+Columns = [("pt", np.float32), ("gentaumatch", np.bool_)]
+
+def writeRows(prefix, first, nRows, chunkSize=7, jobId=None):
+    writer = ChunkedColumnWriter(prefix, Columns, chunkSize, jobId)
+    for start in range(first, first + nRows, 3):
+        pt = np.arange(start, min(start + 3, first + nRows), dtype=np.float32)
+        writer.append(pt=pt, gentaumatch=pt % 2 == 0)
+    writer.close()
+    return writer
+
+def withTempDir(test):
+    def run():
+        outDir = tempfile.mkdtemp()
+        try:
+            test(os.path.join(outDir, "train"))
+        finally:
+            shutil.rmtree(outDir)
+    run.__name__ = test.__name__
+    return run
+
+@withTempDir
+def test_jobsShareThePrefix(prefix):
+    first  = writeRows(prefix, 0, 20)
+    second = writeRows(prefix, 100, 5)
+    assert first.jobId != second.jobId
+    assert first.nChunks == 3 and second.nChunks == 1
+    assert len(chunkDirs(prefix)) == 4
+    sample = loadSample(prefix)
+    assert sorted(sample) == ["gentaumatch", "pt"]
+    assert sorted(sample["pt"].tolist()) == list(range(20)) + list(range(100, 105))
+    assert (sample["gentaumatch"] == (sample["pt"] % 2 == 0)).all()
+    assert sample["pt"].dtype == np.float32
+    chunk = next(iterChunks(prefix, ["pt"], mmap_mode="r"))
+    assert list(chunk) == ["pt"] and isinstance(chunk["pt"], np.memmap)
+
+@withTempDir
+def test_otherDirectoriesKept(prefix):
+    outDir = os.path.dirname(prefix)
+    ## Not chunks: another directory, a chunk name without manifest (e.g. of a
+    ## job which failed while writing it), a file, and a chunk of a longer prefix
+    for other in (prefix + "_2017", prefix + "_abc_0"):
+        os.mkdir(other)
+    open(prefix + "_def_1", "w").close()
+    writeRows(prefix + "_2017", 0, 4, jobId="abc")
+    others = [prefix + "_2017", prefix + "_abc_0", prefix + "_def_1", prefix + "_2017_abc_0"]
+    writeRows(prefix, 0, 10)
+    assert len(chunkDirs(prefix)) == 2
+    removeChunks(prefix)
+    assert chunkDirs(prefix) == []
+    for other in others:
+        assert os.path.exists(other)
+    assert sorted(os.listdir(prefix + "_2017_abc_0")) == ["gentaumatch.npy", "manifest.json", "pt.npy"]
+    assert loadSample(prefix + "_2017")["pt"].tolist() == [0, 1, 2, 3]
+    assert sorted(os.listdir(outDir)) == sorted(os.path.basename(other) for other in others)
+
+@withTempDir
+def test_noOverwrite(prefix):
+    writeRows(prefix, 0, 3, jobId="job1")
+    try:
+        writeRows(prefix, 10, 3, jobId="job1")
+    except OSError:
+        pass
+    else:
+        assert False, "A chunk was overwritten"
+    assert loadSample(prefix)["pt"].tolist() == [0, 1, 2]
+
+if __name__ == "__main__":
+    for name, test in sorted(globals().items()):
+        if name.startswith("test_"):
+            test()
+    print("ok")
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+from __future__ import print_function
+import os
+import sys
+import glob
+import time
+import unittest
+import numpy as np
+
+from PhysicsTools.NanoSUSYTools.modules import xgbHelper
+from PhysicsTools.NanoSUSYTools.modules.xgbHelper import TreeEnsemble, XGBModels, xgb
+
+## The NumPy evaluation of the tau MVA models (TreeEnsemble, reading the binary
+## .model files) against xgboost.Booster.predict, on the models of data/tauMVA
+## and random candidates, with missing values. Needs xgboost.
+##   python -m pytest test/test_xgbHelper.py   agreement of the margins and predictions
+##   python test/test_xgbHelper.py --bench     candidates per second of each evaluation
+
+ModelFiles = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "tauMVA", "*.model")))
+## Input variables of the models, as TauMVAObjectsProducer.TrainingFeatures
+Features = ['pt', 'abseta', 'chiso0p1', 'chiso0p2', 'chiso0p3', 'chiso0p4', 'totiso0p1', 'totiso0p2', 'totiso0p3', 'totiso0p4', 'neartrkdr', 'contjetdr', 'contjetcsv']
+NCandidates = 5000
+## Candidates per event of the benchmark
+NPerEvent = 6
+
+def makeCandidates(nCandidates=NCandidates, seed=17, missing=0.):
+    """float32 features of random candidates, a fraction missing of the values set to NaN"""
+    rng = np.random.RandomState(seed)
+    isolations = [np.minimum(rng.exponential(20, nCandidates), 700) * (rng.uniform(size=nCandidates) < 0.7) for i in range(8)]
+    x = np.column_stack([rng.uniform(10, 300, nCandidates), rng.uniform(0, 2.4, nCandidates)] + isolations +
+                        [rng.uniform(0, 0.5, nCandidates),
+                         rng.uniform(0, 0.4, nCandidates) * (rng.uniform(size=nCandidates) < 0.5),
+                         rng.uniform(0, 1, nCandidates) * (rng.uniform(size=nCandidates) < 0.5)]).astype(np.float32)
+    x[rng.uniform(size=x.shape) < missing] = np.nan
+    return x
+
+def boosterPredict(boosters, x, outputMargin=False):
+    """xgboost predictions of each model, shape (models, rows)"""
+    dmat = xgb.DMatrix(x, feature_names=Features, missing=np.nan)
+    return np.array([booster.predict(dmat, output_margin=outputMargin) for booster in boosters])
+
+@unittest.skipIf(xgb is None, "xgboost is not installed")
+class TreeEnsembleTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.ensemble = TreeEnsemble(ModelFiles)
+        cls.boosters = [xgb.Booster(params={'nthread': 1}, model_file=f) for f in ModelFiles]
+        cls.x        = makeCandidates()
+        cls.xMissing = makeCandidates(seed=18, missing=0.2)
+
+    def compareMargins(self):
+        for x in (self.x, self.xMissing):
+            self.assertTrue(np.array_equal(self.ensemble.margins(x), boosterPredict(self.boosters, x, outputMargin=True)))
+
+    def testModels(self):
+        self.assertTrue(len(ModelFiles) > 0)
+        self.assertEqual(len(self.ensemble.baseMargin), len(ModelFiles))
+
+    def testMargins(self):
+        self.compareMargins()
+
+    def testNumPyEvaluation(self):
+        ## The evaluation without numba, level by level of the trees
+        njit, sigmoid = xgbHelper.njit, xgbHelper._sigmoid
+        xgbHelper.njit, xgbHelper._sigmoid = None, xgbHelper._libmSigmoid
+        try:
+            self.compareMargins()
+            self.assertTrue(np.array_equal(self.ensemble.predict(self.xMissing), boosterPredict(self.boosters, self.xMissing)))
+        finally:
+            xgbHelper.njit, xgbHelper._sigmoid = njit, sigmoid
+
+    def testPredict(self):
+        for x in (self.x, self.xMissing):
+            self.assertTrue(np.array_equal(self.ensemble.predict(x), boosterPredict(self.boosters, x)))
+
+    def testXGBModels(self):
+        ## Both evaluations of the producers, on events of a few candidates
+        models, numpyModels = XGBModels(ModelFiles, Features), XGBModels(ModelFiles, Features, numpyTrees=True)
+        for start in range(0, 600, NPerEvent):
+            candidates = self.xMissing[start:start + (start // NPerEvent) % 8]
+            self.assertTrue(np.array_equal(models.evalBatch(candidates), numpyModels.evalBatch(candidates)))
+        self.assertEqual(numpyModels.evalBatch(self.x[:0]).shape, (len(ModelFiles), 0))
+        self.assertEqual(models.evalBatch(self.x[:0]).shape, (len(ModelFiles), 0))
+
+#~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Benchmark ~~~~~
+def measure(function, events, nRepeat=3):
+    """Best number of candidates evaluated per second"""
+    function(events[0]) # numba compilation
+    best = float("inf")
+    for i in range(nRepeat):
+        start = time.time()
+        for event in events:
+            function(event)
+        best = min(best, time.time() - start)
+    return sum(len(event) for event in events) / best
+
+def benchmark():
+    x = makeCandidates(6000, missing=0.05)
+    events = [x[i:i + NPerEvent] for i in range(0, len(x), NPerEvent)]
+    helpers = [xgbHelper.XGBHelper(f, Features) for f in ModelFiles]
+    models, numpyModels = XGBModels(ModelFiles, Features), XGBModels(ModelFiles, Features, numpyTrees=True)
+    ## A dictionary per candidate, as the producers before the batching
+    rowEval = lambda event : [[helper.eval(dict(zip(Features, row))) for helper in helpers] for row in event]
+    print("python %d.%d, xgboost %s, %d models, %d candidates per event, numba %s" % (sys.version_info[0], sys.version_info[1],
+          xgb.__version__, len(ModelFiles), NPerEvent, "on" if xgbHelper.njit else "off"))
+    for name, function in (("Booster, one DMatrix per candidate", rowEval),
+                           ("Booster, one DMatrix per event",     models.evalBatch),
+                           ("TreeEnsemble, per event",            numpyModels.evalBatch)):
+        print("%-36s %10.0f candidates/s" % (name, measure(function, events)))
+    for name, function in (("Booster, all candidates at once",      models.evalBatch),
+                           ("TreeEnsemble, all candidates at once", numpyModels.evalBatch)):
+        print("%-36s %10.0f candidates/s" % (name, measure(function, [x])))
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        if xgb is None:
+            sys.exit("xgboost is not installed")
+        benchmark()
+    else:
+        unittest.main()